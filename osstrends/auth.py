@@ -23,4 +23,10 @@ __author__ = "David Rusk <drusk@uvic.ca>"
 GH_AUTH_USERNAME = "put username here"
 GH_AUTH_TOKEN = "put access token here"
 
+# Each (username, token) pair has its own rate limit, and requests are
+# spread across all of them.  Add more pairs to increase throughput.
+GH_AUTH_CREDENTIALS = [
+    (GH_AUTH_USERNAME, GH_AUTH_TOKEN),
+]
+
 APP_SECRET_KEY = "put app secret key here"
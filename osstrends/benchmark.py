@@ -0,0 +1,116 @@
+# Copyright (C) 2014 David Rusk
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+__author__ = "David Rusk <drusk@uvic.ca>"
+
+import time
+
+from osstrends.github import GitHubSearcher
+from osstrends.locations import Location
+from osstrends.metrics import MetricsRegistry
+from osstrends.pipeline import DataPipeline
+from osstrends.ratelimit import CredentialPool
+
+
+def benchmark_locations(search_terms):
+    """
+    Creates the locations for a benchmark's search terms, e.g. those
+    passed to osstrends.fakegithub.FakeGitHub.generate.
+    """
+    return [Location(search_term.lower(), [], search_term)
+            for search_term in search_terms]
+
+
+def run_benchmark(db, fake_github, locations,
+                  num_threads=DataPipeline.DEFAULT_NUM_THREADS,
+                  autoscale=False, num_credentials=1, pace=True, cache=None,
+                  language_cache=None, **pipeline_options):
+    """
+    Runs the pipeline end to end against a fake API server and measures
+    its throughput.
+
+    Args:
+      db: osstrends.database.MongoDatabase
+        Where the pipeline saves users.  This should be a database used
+        only for benchmarking.
+      fake_github: osstrends.fakegithub.FakeGitHub
+        A started server with the users to crawl.
+      locations: list(osstrends.locations.Location)
+      num_threads: int
+      autoscale: bool
+        Passed through to the DataPipeline.
+      num_credentials: int
+        How many sets of credentials to spread requests across.  This only
+        matters if the server has a rate limit.
+      pace: bool
+        Passed through to the credentials' rate limit budgets.
+      cache: osstrends.cache.ResponseCache
+      language_cache: osstrends.cache.RepoLanguageCache
+        If provided, used by the run.  Reusing them between runs shows how
+        much a warm cache helps.
+      pipeline_options:
+        Any other arguments for the DataPipeline, e.g. write_behind.
+
+    Returns:
+      results: dict
+        "users" is the number of users whose language statistics were
+        saved, "api_calls" is the number of requests the server received,
+        "seconds" is how long the run took, "users_per_second" and
+        "api_calls_per_user" follow from them, and "api_calls_by_endpoint"
+        breaks down the requests.
+    """
+    metrics = MetricsRegistry()
+
+    credentials = CredentialPool(
+        [("benchmark{}".format(index), "token")
+         for index in xrange(num_credentials)],
+        pace=pace)
+
+    pool_size = num_threads
+    if autoscale:
+        pool_size = max(num_threads, DataPipeline.DEFAULT_MAX_THREADS)
+
+    searcher = GitHubSearcher(pool_size=pool_size, cache=cache,
+                              credentials=credentials, metrics=metrics,
+                              api_url=fake_github.url)
+
+    pipeline = DataPipeline(db, searcher, locations,
+                            num_threads=num_threads,
+                            language_cache=language_cache,
+                            autoscale=autoscale, metrics=metrics,
+                            **pipeline_options)
+
+    fake_github.reset_request_counts()
+
+    start_time = time.time()
+    pipeline.execute()
+    seconds = time.time() - start_time
+
+    users = metrics.get("pipeline_users_total").total()
+    api_calls = fake_github.num_requests()
+
+    return {
+        "users": users,
+        "api_calls": api_calls,
+        "seconds": seconds,
+        "users_per_second": users / seconds,
+        "api_calls_per_user": float(api_calls) / users if users else None,
+        "api_calls_by_endpoint": fake_github.request_counts()
+    }
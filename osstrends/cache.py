@@ -0,0 +1,375 @@
+# Copyright (C) 2014 David Rusk
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+__author__ = "David Rusk <drusk@uvic.ca>"
+
+import collections
+import json
+import os
+import threading
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+
+class ResponseCache(object):
+    """
+    Stores API responses along with their validators (ETag and
+    Last-Modified) so that repeat requests can be made conditional.
+    GitHub answers a conditional request with "304 Not Modified" when
+    nothing has changed, and those responses do not count against the
+    rate limit.
+
+    The cache is shared by all threads using a searcher, and is bounded
+    by the size of the responses it holds, with the least recently used
+    ones evicted first.  Responses vary from a few hundred bytes to pages
+    of 100 full repositories, so a bound on their number wouldn't bound
+    the memory used.
+    """
+
+    DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+    def __init__(self, filename=None, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        Constructor.
+
+        Args:
+          filename: str
+            Where the cache is persisted between runs.  If the file
+            already exists its entries are loaded.  If None, the cache is
+            only kept in memory.
+          max_bytes: int
+            The most bytes of response bodies and headers to keep.
+            Responses bigger than this aren't cached at all.
+        """
+        self.filename = filename
+        self.max_bytes = max_bytes
+
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = collections.OrderedDict()
+        self._num_bytes = 0
+        self._lock = threading.Lock()
+
+        if filename is not None and os.path.exists(filename):
+            self.load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def num_bytes(self):
+        """
+        The size of the responses held, as counted against max_bytes.
+        """
+        return self._num_bytes
+
+    def get_validators(self, url):
+        """
+        Looks up the headers needed to make a request conditional.
+
+        Args:
+          url: str
+            The full URL being requested, including query parameters.
+
+        Returns:
+          headers: dict
+            "If-None-Match" and/or "If-Modified-Since" headers.  Empty if
+            nothing is cached for the URL.
+        """
+        with self._lock:
+            entry = self._entries.get(url)
+
+        if entry is None:
+            return {}
+
+        headers = {}
+        if entry["etag"] is not None:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"] is not None:
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+        return headers
+
+    def get_response(self, url):
+        """
+        Rebuilds the cached response for a URL.  This is used when the
+        server reports that the resource has not been modified, and counts
+        as a cache hit.
+
+        Args:
+          url: str
+
+        Returns:
+          response: requests.Response
+            A response equivalent to the one originally received, or None
+            if the URL is not cached (e.g. it was evicted in the meantime).
+        """
+        with self._lock:
+            entry = self._entries.pop(url, None)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            # Re-insert to mark it as most recently used
+            self._entries[url] = entry
+            self.hits += 1
+
+        response = requests.Response()
+        response.status_code = 200
+        response.url = url
+        response.headers = CaseInsensitiveDict(entry["headers"])
+        response.encoding = "utf-8"
+        response._content = entry["body"].encode("utf-8")
+
+        return response
+
+    def store(self, url, response):
+        """
+        Caches a response if it came with validators, and counts it as a
+        cache miss.
+
+        Args:
+          url: str
+          response: requests.Response
+            A full (not 304) response to the request.
+
+        Returns: void
+        """
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+
+        with self._lock:
+            self.misses += 1
+
+            if response.status_code != 200 or (etag is None and
+                                               last_modified is None):
+                return
+
+            self._remove(url)
+
+            entry = {
+                "etag": etag,
+                "last_modified": last_modified,
+                "headers": dict(response.headers),
+                "body": response.content.decode("utf-8")
+            }
+            self._add(url, entry)
+
+    def _add(self, url, entry):
+        # The lock must be held.
+        size = _entry_size(entry)
+        if size > self.max_bytes:
+            return
+
+        self._entries[url] = entry
+        self._num_bytes += size
+
+        while self._num_bytes > self.max_bytes:
+            _, evicted_entry = self._entries.popitem(last=False)
+            self._num_bytes -= _entry_size(evicted_entry)
+
+    def _remove(self, url):
+        # The lock must be held.
+        entry = self._entries.pop(url, None)
+        if entry is not None:
+            self._num_bytes -= _entry_size(entry)
+
+    def load(self):
+        """
+        Reads the cache's entries from its file.
+        """
+        with open(self.filename, "rb") as filehandle:
+            entries = json.load(filehandle)
+
+        with self._lock:
+            self._entries = collections.OrderedDict()
+            self._num_bytes = 0
+
+            # Oldest first, so if the budget has shrunk since the file was
+            # saved the least recently used are the ones left out.
+            for url, entry in entries:
+                self._add(url, entry)
+
+    def save(self):
+        """
+        Writes the cache's entries to its file so they can be used in the
+        next run.
+        """
+        if self.filename is None:
+            return
+
+        with self._lock:
+            entries = self._entries.items()
+
+        # Write to a temporary file first so that a crash part way
+        # through doesn't destroy the previous cache.
+        temp_filename = self.filename + ".tmp"
+        with open(temp_filename, "wb") as filehandle:
+            json.dump(entries, filehandle)
+
+        os.rename(temp_filename, self.filename)
+
+
+def _entry_size(entry):
+    size = len(entry["body"])
+    for name, value in entry["headers"].iteritems():
+        size += len(name) + len(value)
+
+    return size
+
+
+class RepoLanguageCache(object):
+    """
+    Stores the language statistics of repositories by their contents
+    rather than by their location.  A repository's contents are identified
+    by its full name and when it was last pushed to, so unchanged
+    repositories don't need to be looked up again.
+
+    A fork which hasn't been pushed to since it was created has the same
+    contents as the repository it was forked from, so it is identified by
+    that source repository's full name.  Forks of the same project then
+    share a single entry.
+    """
+
+    DEFAULT_MAX_ENTRIES = 100000
+
+    def __init__(self, filename=None, max_entries=DEFAULT_MAX_ENTRIES):
+        """
+        Constructor.
+
+        Args:
+          filename: str
+            Where the cache is persisted between runs.  If the file
+            already exists its entries are loaded.  If None, the cache is
+            only kept in memory.
+          max_entries: int
+            The maximum number of repositories' statistics to keep.
+        """
+        self.filename = filename
+        self.max_entries = max_entries
+
+        self.hits = 0
+        self.misses = 0
+
+        self._language_stats = collections.OrderedDict()
+
+        # Forks never change which repository they were forked from, so
+        # these are kept regardless of max_entries.
+        self._sources = {}
+
+        self._lock = threading.Lock()
+
+        if filename is not None and os.path.exists(filename):
+            self.load()
+
+    def __len__(self):
+        return len(self._language_stats)
+
+    def get_source(self, full_name):
+        """
+        Looks up the full name of the repository a fork was created from.
+
+        Returns:
+          source_full_name: str
+            None if it isn't known.
+        """
+        with self._lock:
+            return self._sources.get(full_name)
+
+    def set_source(self, full_name, source_full_name):
+        with self._lock:
+            self._sources[full_name] = source_full_name
+
+    def get(self, full_name, pushed_at):
+        """
+        Looks up the language statistics of a repository.
+
+        Args:
+          full_name: str
+            The repository's full name, i.e. "owner/name".
+          pushed_at: str
+            When the repository was last pushed to.
+
+        Returns:
+          language_stats: dict
+            None if the statistics aren't cached.
+        """
+        key = self._key(full_name, pushed_at)
+
+        with self._lock:
+            language_stats = self._language_stats.pop(key, None)
+
+            if language_stats is None:
+                self.misses += 1
+                return None
+
+            # Re-insert to mark it as most recently used
+            self._language_stats[key] = language_stats
+            self.hits += 1
+
+            return language_stats
+
+    def put(self, full_name, pushed_at, language_stats):
+        key = self._key(full_name, pushed_at)
+
+        with self._lock:
+            self._language_stats.pop(key, None)
+            self._language_stats[key] = language_stats
+
+            while len(self._language_stats) > self.max_entries:
+                self._language_stats.popitem(last=False)
+
+    def load(self):
+        """
+        Reads the cache's entries from its file.
+        """
+        with open(self.filename, "rb") as filehandle:
+            data = json.load(filehandle)
+
+        with self._lock:
+            self._language_stats = collections.OrderedDict(
+                data["language_stats"][-self.max_entries:])
+            self._sources = data["sources"]
+
+    def save(self):
+        """
+        Writes the cache's entries to its file so they can be used in the
+        next run.
+        """
+        if self.filename is None:
+            return
+
+        with self._lock:
+            data = {
+                "language_stats": self._language_stats.items(),
+                "sources": dict(self._sources)
+            }
+
+        temp_filename = self.filename + ".tmp"
+        with open(temp_filename, "wb") as filehandle:
+            json.dump(data, filehandle)
+
+        os.rename(temp_filename, self.filename)
+
+    def _key(self, full_name, pushed_at):
+        return "{}@{}".format(full_name, pushed_at)
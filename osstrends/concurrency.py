@@ -0,0 +1,216 @@
+# Copyright (C) 2014 David Rusk
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+__author__ = "David Rusk <drusk@uvic.ca>"
+
+import logging
+import math
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class MovingAverage(object):
+    """
+    An exponentially weighted moving average which can be updated from
+    several threads, e.g. of the time taken by API requests.
+    """
+
+    def __init__(self, weight=0.1):
+        """
+        Constructor.
+
+        Args:
+          weight: float
+            How much each new sample counts compared to the previous
+            average, between 0 and 1.
+        """
+        self.weight = weight
+
+        self._average = None
+        self._lock = threading.Lock()
+
+    def record(self, value):
+        with self._lock:
+            if self._average is None:
+                self._average = float(value)
+            else:
+                self._average += self.weight * (value - self._average)
+
+    def value(self):
+        """
+        Returns the current average, or None if nothing has been recorded.
+        """
+        with self._lock:
+            return self._average
+
+
+class ConcurrencyLimit(object):
+    """
+    A semaphore whose size can be changed while threads are waiting on it.
+    Lowering the limit doesn't interrupt the threads already holding it;
+    they just aren't let back in until enough others have left.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+
+        self._active = 0
+        self._condition = threading.Condition()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def acquire(self):
+        with self._condition:
+            while self._active >= self.limit:
+                self._condition.wait()
+
+            self._active += 1
+
+    def release(self):
+        with self._condition:
+            self._active -= 1
+            self._condition.notify()
+
+    def resize(self, limit):
+        with self._condition:
+            self.limit = limit
+            self._condition.notify_all()
+
+
+class ConcurrencyController(object):
+    """
+    Chooses how many worker threads should be making requests at once.
+
+    The number of workers grows additively while there is a backlog of
+    work and shrinks multiplicatively when requests start taking much
+    longer than usual (AIMD), since that is a sign of the API struggling
+    rather than of a lack of workers.  It is also capped using Little's
+    law: with requests taking W seconds each and the rate limit allowing
+    R requests per second until it resets, no more than R * W requests
+    need to be in flight to use up the budget.  Extra workers would only
+    wait for their turn.
+    """
+
+    DEFAULT_MIN_CONCURRENCY = 1
+    DEFAULT_MAX_CONCURRENCY = 50
+
+    def __init__(self, initial, min_concurrency=DEFAULT_MIN_CONCURRENCY,
+                 max_concurrency=DEFAULT_MAX_CONCURRENCY, increase_step=1,
+                 decrease_factor=0.75, latency_tolerance=2.0, headroom=1.5):
+        """
+        Constructor.
+
+        Args:
+          initial: int
+            The number of workers to start with.
+          min_concurrency: int
+          max_concurrency: int
+            Bounds on the number of workers.
+          increase_step: int
+            How many workers are added at each adjustment while there is
+            a backlog.
+          decrease_factor: float
+            What the number of workers is multiplied by when latency rises.
+          latency_tolerance: float
+            How many times the baseline latency requests can take before
+            the number of workers is cut.
+          headroom: float
+            How far above the Little's law estimate the number of workers
+            may go, to absorb variation in latency.
+        """
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.headroom = headroom
+
+        self.concurrency = self._clamp(initial)
+
+        # The latency requests take when the API isn't under strain.
+        self._baseline_latency = None
+
+    def adjust(self, latency, queue_depth, request_rate):
+        """
+        Chooses the number of workers for the next interval.
+
+        Args:
+          latency: float
+            The recent average time taken by an API request in seconds, or
+            None if no requests have been made yet.
+          queue_depth: int
+            The number of tasks waiting for a worker.
+          request_rate: float
+            How many requests per second the remaining rate limit budget
+            allows until it resets, or None if it isn't known.
+
+        Returns:
+          concurrency: int
+            The number of workers which should be active.
+        """
+        concurrency = self.concurrency
+
+        if latency is not None:
+            if self._baseline_latency is None:
+                self._baseline_latency = latency
+            else:
+                # Drift up slowly so one unusually fast interval doesn't
+                # hold the baseline down forever.
+                self._baseline_latency = min(latency,
+                                             self._baseline_latency * 1.05)
+
+        if (latency is not None and
+                latency > self._baseline_latency * self.latency_tolerance):
+            concurrency = int(concurrency * self.decrease_factor)
+        elif queue_depth > concurrency:
+            concurrency += self.increase_step
+        elif queue_depth < concurrency:
+            # Workers beyond the backlog would just be idle.
+            concurrency = max(concurrency - self.increase_step, queue_depth)
+
+        if latency is not None and request_rate is not None:
+            concurrency = min(concurrency, int(math.ceil(
+                request_rate * latency * self.headroom)))
+
+        concurrency = self._clamp(concurrency)
+
+        if concurrency != self.concurrency:
+            logger.info(
+                "Concurrency changed from %d to %d (latency: %s, queue "
+                "depth: %d, request rate: %s)" % (
+                    self.concurrency, concurrency, _format(latency),
+                    queue_depth, _format(request_rate)))
+            self.concurrency = concurrency
+
+        return concurrency
+
+    def _clamp(self, concurrency):
+        return max(self.min_concurrency,
+                   min(concurrency, self.max_concurrency))
+
+
+def _format(value):
+    return "unknown" if value is None else "%.2f" % value
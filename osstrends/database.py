@@ -21,10 +21,42 @@
 __author__ = "David Rusk <drusk@uvic.ca>"
 
 import collections
+import functools
+import re
+import time
 
 import pymongo
 from werkzeug.security import generate_password_hash, check_password_hash
 
+from osstrends.metrics import MetricsRegistry
+
+
+def timed_write(method):
+    """
+    Records how long a write to the database takes in the database's
+    metrics, labelled by the method's name.
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._write_seconds.time(operation=method.__name__):
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+def _escape_key(key):
+    """
+    Makes a string usable as a field name in an update.  Field names can't
+    contain "." or start with "$", and language names such as "ASP.NET"
+    can.
+    """
+    return key.replace(u".", u"\uff0e").replace(u"$", u"\uff04")
+
+
+def _unescape_key(key):
+    return key.replace(u"\uff0e", u".").replace(u"\uff04", u"$")
+
 
 class MongoDatabase(object):
     """
@@ -35,45 +67,181 @@ class MongoDatabase(object):
 
     USERS_COLLECTION = "users"
     ADMIN_COLLECTION = "admins"
+    JOBS_COLLECTION = "jobs"
+    CHECKPOINTS_COLLECTION = "checkpoints"
+    AGGREGATIONS_COLLECTION = "language_aggregations"
+    WORKERS_COLLECTION = "workers"
+    DEAD_LETTERS_COLLECTION = "dead_letters"
+    REPO_STATS_COLLECTION = "repo_language_stats"
+    LOCATION_STATS_COLLECTION = "location_stats"
+
+    JOB_PENDING = "pending"
+    JOB_LEASED = "leased"
+    JOB_DONE = "done"
+    JOB_FAILED = "failed"
 
     ADMIN_USERNAME_KEY = "username"
     ADMIN_PASSWORD_KEY = "password"
 
     USERID_KEY = "login"
     NORMALIZED_LOCATION_KEY = "location_normalized"
+    FETCHED_AT_KEY = "fetched_at"
     LANGUAGES_KEY = "languages"
+    LANGUAGE_LIST_KEY = "language_list"
     TOTAL_CODE_SIZE_KEY = "total_code_size"
 
-    def __init__(self, db_name=DEFAULT_DB_NAME, host="localhost", port=27017):
+    # The fields of users which get_users searches.
+    USER_SEARCH_FIELDS = [USERID_KEY, "name", "company"]
+
+    def __init__(self, db_name=DEFAULT_DB_NAME, host="localhost", port=27017,
+                 metrics=None):
         self._client = pymongo.MongoClient(
             "mongodb://{host}:{port}".format(host=host, port=port)
         )
         self._db = self._client[db_name]
 
+        if metrics is None:
+            metrics = MetricsRegistry()
+        self.metrics = metrics
+
+        self._write_seconds = metrics.histogram(
+            "db_write_seconds",
+            "Time taken by writes to the database, by operation.")
+
     def _get_users_collection(self):
         return self._db[self.USERS_COLLECTION]
 
     def _get_admin_collection(self):
         return self._db[self.ADMIN_COLLECTION]
 
+    def _get_jobs_collection(self):
+        return self._db[self.JOBS_COLLECTION]
+
+    def _get_checkpoints_collection(self):
+        return self._db[self.CHECKPOINTS_COLLECTION]
+
+    def _get_aggregations_collection(self):
+        return self._db[self.AGGREGATIONS_COLLECTION]
+
+    def _get_workers_collection(self):
+        return self._db[self.WORKERS_COLLECTION]
+
+    def _get_dead_letters_collection(self):
+        return self._db[self.DEAD_LETTERS_COLLECTION]
+
+    def _get_repo_stats_collection(self):
+        return self._db[self.REPO_STATS_COLLECTION]
+
+    def _get_location_stats_collection(self):
+        return self._db[self.LOCATION_STATS_COLLECTION]
+
     def delete_users(self):
         self._get_users_collection().drop()
+        self._get_location_stats_collection().drop()
+
+    def ensure_indexes(self):
+        """
+        Creates the indexes the queries on users and on the crawl queue rely
+        on, if they don't exist yet.  Duplicate users have to be removed
+        first (see remove_duplicate_users) for the index on their login to
+        be created.
+
+        Users are indexed by location and by language separately rather
+        than by both together, since MongoDB can't index two arrays in one
+        compound index.  A query on both uses whichever is more selective.
+        """
+        users = self._get_users_collection()
+        users.ensure_index(self.USERID_KEY, unique=True)
+        users.ensure_index(self.NORMALIZED_LOCATION_KEY)
+        users.ensure_index("{}.name".format(self.LANGUAGE_LIST_KEY))
+
+        # For pages of a location's users in the orders they're usually
+        # shown in, with ties broken by login.
+        users.ensure_index([(self.NORMALIZED_LOCATION_KEY, pymongo.ASCENDING),
+                            ("name", pymongo.ASCENDING),
+                            (self.USERID_KEY, pymongo.ASCENDING)])
+        users.ensure_index([(self.NORMALIZED_LOCATION_KEY, pymongo.ASCENDING),
+                            (self.TOTAL_CODE_SIZE_KEY, pymongo.DESCENDING),
+                            (self.USERID_KEY, pymongo.DESCENDING)])
+
+        self._get_repo_stats_collection().ensure_index(
+            [("owner", pymongo.ASCENDING), ("name", pymongo.ASCENDING)])
 
-    def get_user(self, userid):
+        self._ensure_job_indexes()
+
+    def _ensure_job_indexes(self):
+        # Done jobs stay in the queue until the next crawl, so without
+        # these every lease and count would scan all of the crawl's jobs.
+        jobs = self._get_jobs_collection()
+        jobs.ensure_index([("state", pymongo.ASCENDING),
+                           ("lease_expires", pymongo.ASCENDING)])
+        jobs.ensure_index([("state", pymongo.ASCENDING),
+                           ("priority", pymongo.DESCENDING)])
+
+    def remove_duplicate_users(self):
+        """
+        Users used to be able to be saved more than once.  This merges each
+        user's locations into the copy fetched most recently and removes
+        the others.
+
+        Returns:
+          num_removed: int
+        """
+        users = self._get_users_collection()
+
+        if "{}_1".format(self.USERID_KEY) in users.index_information():
+            # The unique index keeps out duplicates.
+            return 0
+
+        duplicates = users.aggregate([
+            {"$group": {"_id": "$" + self.USERID_KEY,
+                        "count": {"$sum": 1}}},
+            {"$match": {"count": {"$gt": 1}}}
+        ])["result"]
+
+        num_removed = 0
+        for duplicate in duplicates:
+            copies = list(users.find(
+                {self.USERID_KEY: duplicate["_id"]},
+                fields=[self.FETCHED_AT_KEY, self.NORMALIZED_LOCATION_KEY]
+            ).sort(self.FETCHED_AT_KEY, pymongo.DESCENDING))
+
+            locations = []
+            for copy in copies:
+                copy_locations = copy.get(self.NORMALIZED_LOCATION_KEY) or []
+                if isinstance(copy_locations, basestring):
+                    copy_locations = [copy_locations]
+
+                locations.extend(location for location in copy_locations
+                                 if location not in locations)
+
+            users.update({"_id": copies[0]["_id"]},
+                         {"$set": {self.NORMALIZED_LOCATION_KEY: locations}})
+            users.remove({"_id": {"$in": [copy["_id"]
+                                          for copy in copies[1:]]}})
+            num_removed += len(copies) - 1
+
+        return num_removed
+
+    def get_user(self, userid, fields=None):
         """
         Retrieve user information object for the specified user.
 
         Args:
           userid: str
             The user's login id.
+          fields: list(str)
+            If provided, only these fields of the user (and their _id) are
+            retrieved.
 
         Returns:
             user: http://developer.github.com/v3/users/
         """
         return self._get_users_collection().find_one(
-            {self.USERID_KEY: userid}
+            {self.USERID_KEY: userid}, fields=fields
         )
 
+    @timed_write
     def insert_user(self, user, normalized_location):
         """
         Adds a user to the database, or updates the existing entry with
@@ -84,19 +252,135 @@ class MongoDatabase(object):
             Contains the user data.
           normalized_location: str
             Normalized version of the user's location which will be used
-            in database lookups.
+            in database lookups.  A user can be in several locations, so
+            this is added to the locations they already have.
 
         Returns: void
         """
-        user[self.NORMALIZED_LOCATION_KEY] = normalized_location
+        user = dict(user)
+        user.pop(self.NORMALIZED_LOCATION_KEY, None)
+        user[self.FETCHED_AT_KEY] = time.time()
 
-        self._get_users_collection().update(
-            {self.USERID_KEY: user[self.USERID_KEY]},
-            {"$set": user},
+        self._update_user(
+            user[self.USERID_KEY],
+            {"$set": user,
+             "$addToSet": {
+                 self.NORMALIZED_LOCATION_KEY: normalized_location}},
+            locations=[normalized_location],
             upsert=True
         )
 
-    def get_users(self, location=None, language=None):
+    @timed_write
+    def touch_user(self, userid, normalized_location):
+        """
+        Records that a user's details were fetched again and found to be
+        unchanged, and adds the location they were found in.
+        """
+        self._update_user(
+            userid,
+            {"$set": {self.FETCHED_AT_KEY: time.time()},
+             "$addToSet": {
+                 self.NORMALIZED_LOCATION_KEY: normalized_location}},
+            locations=[normalized_location]
+        )
+
+    def _update_user(self, userid, update, languages=None, locations=(),
+                     upsert=False):
+        """
+        Applies an update to a user, and updates the statistics of their
+        locations by any change to the user's languages or locations.
+
+        Args:
+          userid: str
+          update: dict
+            The update to apply to the user's document.
+          languages: dict
+            The user's new language statistics, or None if the update
+            doesn't change them.
+          locations: list(str)
+            Locations the update adds to the user.
+          upsert: bool
+            Add the user if they aren't in the database yet.
+        """
+        old_user = self._get_users_collection().find_and_modify(
+            {self.USERID_KEY: userid}, update, upsert=upsert, new=False,
+            fields=[self.LANGUAGES_KEY, self.NORMALIZED_LOCATION_KEY])
+
+        if old_user is None and not upsert:
+            # The user isn't in the database, so nothing was updated.
+            return
+
+        self._update_location_stats([(old_user, languages, locations)])
+
+    def get_user_refresh_info(self):
+        """
+        Summarizes how up to date each user's data is, for deciding which
+        users to refresh first.
+
+        Returns:
+          refresh_info: dict
+            Keyed by userid.  Values are dicts with the time the user was
+            last "fetched_at" (None if unknown), when they were last
+            "active_at" on GitHub (the later of their last update and their
+            last push to a repository, as an ISO 8601 string, or None) and
+            their "locations".
+        """
+        last_pushes = self._get_repo_stats_collection().aggregate([
+            {"$group": {"_id": "$owner",
+                        "pushed_at": {"$max": "$pushed_at"}}}
+        ])["result"]
+        last_push_by_user = {result["_id"]: result["pushed_at"]
+                             for result in last_pushes}
+
+        refresh_info = {}
+        for user in self._get_users_collection().find(
+                fields=[self.USERID_KEY, self.FETCHED_AT_KEY, "updated_at",
+                        self.NORMALIZED_LOCATION_KEY]):
+            userid = user[self.USERID_KEY]
+
+            # ISO 8601 times in UTC compare correctly as strings.
+            active_at = max(user.get("updated_at"),
+                            last_push_by_user.get(userid))
+
+            refresh_info[userid] = {
+                self.FETCHED_AT_KEY: user.get(self.FETCHED_AT_KEY),
+                "active_at": active_at,
+                "locations": user.get(self.NORMALIZED_LOCATION_KEY, [])
+            }
+
+        return refresh_info
+
+    @timed_write
+    def add_user_location(self, userid, normalized_location):
+        """
+        Adds another location to a user which is already in the database.
+        """
+        self._update_user(
+            userid,
+            {"$addToSet": {
+                self.NORMALIZED_LOCATION_KEY: normalized_location}},
+            locations=[normalized_location]
+        )
+
+    def convert_user_locations_to_lists(self):
+        """
+        Users used to be in a single location, stored as a string.  This
+        converts those locations to lists of locations so that more can be
+        added.
+        """
+        users = self._get_users_collection()
+
+        # $type 2 is a string
+        for user in users.find({self.NORMALIZED_LOCATION_KEY: {"$type": 2}},
+                               fields=[self.NORMALIZED_LOCATION_KEY]):
+            users.update(
+                {"_id": user["_id"]},
+                {"$set": {self.NORMALIZED_LOCATION_KEY:
+                          [user[self.NORMALIZED_LOCATION_KEY]]}}
+            )
+
+    def get_users(self, location=None, language=None, fields=None,
+                  search=None, sort=None, skip=0, limit=0):
         """
         Lookup users by location and/or language from the database.
 
@@ -105,6 +389,19 @@ class MongoDatabase(object):
             Find users from this location.  Must be normalized.
           language: str
             Only return users who have code in this programming language.
+          fields: list(str)
+            If provided, only these fields of each user (and their _id) are
+            retrieved.
+          search: str
+            Only return users with this text in one of USER_SEARCH_FIELDS,
+            ignoring case.
+          sort: list((str, int))
+            Fields to sort by and their directions, e.g.
+            [("name", pymongo.ASCENDING)].
+          skip: int
+            The number of users to skip, for paging through them.
+          limit: int
+            The most users to return.  0 means no limit.
 
         Returns:
           users: list(dict)
@@ -113,16 +410,37 @@ class MongoDatabase(object):
             Returns an empty list if there are no users for that
             location/language.
         """
+        cursor = self._get_users_collection().find(
+            self._users_query(location, language, search), fields=fields,
+            sort=sort, skip=skip, limit=limit)
+
+        return list(cursor)
+
+    def count_users(self, location=None, language=None, search=None):
+        """
+        Counts the users get_users would return for the same arguments,
+        without retrieving them.
+        """
+        return self._get_users_collection().find(
+            self._users_query(location, language, search)).count()
+
+    def _users_query(self, location, language, search):
         query = {}
 
         if location is not None:
             query[self.NORMALIZED_LOCATION_KEY] = location
 
         if language is not None:
-            key = "%s.%s" % (self.LANGUAGES_KEY, language)
-            query[key] = {"$exists": True}
+            # Matches any element of the list, so it can use the index on
+            # the languages' names.
+            query["{}.name".format(self.LANGUAGE_LIST_KEY)] = language
+
+        if search:
+            pattern = re.compile(re.escape(search), re.IGNORECASE)
+            query["$or"] = [{field: pattern}
+                            for field in self.USER_SEARCH_FIELDS]
 
-        return list(self._get_users_collection().find(query))
+        return query
 
     def get_user_language_stats(self, userid):
         """
@@ -137,8 +455,48 @@ class MongoDatabase(object):
             Keys are the language names, values are the number of bytes
             written in that language.
         """
-        return self.get_user(userid)[self.LANGUAGES_KEY]
+        return self.get_user(userid, fields=[self.LANGUAGES_KEY])[
+            self.LANGUAGES_KEY]
 
+    @classmethod
+    def language_stats_fields(cls, language_stats):
+        """
+        Builds the fields a user's language statistics are stored in.
+        Along with the statistics keyed by language, they are stored as a
+        list of {"name": language, "bytes": size} so that the database can
+        aggregate over languages, and as the user's total code size.
+
+        Args:
+          language_stats: dict
+
+        Returns:
+          fields: dict
+        """
+        return {
+            cls.LANGUAGES_KEY: language_stats,
+            cls.LANGUAGE_LIST_KEY: [
+                {"name": language, "bytes": size}
+                for language, size in sorted(language_stats.iteritems())
+            ],
+            cls.TOTAL_CODE_SIZE_KEY: sum(language_stats.values())
+        }
+
+    def convert_language_stats_to_lists(self):
+        """
+        Adds the list form of their language statistics to users saved
+        before it was stored.
+        """
+        users = self._get_users_collection()
+
+        for user in users.find({self.LANGUAGES_KEY: {"$exists": True},
+                                self.LANGUAGE_LIST_KEY: {"$exists": False}},
+                               fields=[self.LANGUAGES_KEY]):
+            users.update(
+                {"_id": user["_id"]},
+                {"$set": self.language_stats_fields(user[self.LANGUAGES_KEY])}
+            )
+
+    @timed_write
     def insert_user_language_stats(self, userid, language_stats):
         """
         Insert language statistics data for a user into the database.
@@ -152,13 +510,210 @@ class MongoDatabase(object):
 
         Returns: void
         """
-        self._get_users_collection().update(
-            {self.USERID_KEY: userid},
-            {"$set": {self.LANGUAGES_KEY: language_stats,
-                      self.TOTAL_CODE_SIZE_KEY: sum(language_stats.values())}},
+        self._update_user(
+            userid,
+            {"$set": self.language_stats_fields(language_stats)},
+            languages=language_stats,
+            upsert=True
+        )
+
+    @timed_write
+    def bulk_update_users(self, updates):
+        """
+        Applies updates to many users in one round trip.  The updates are
+        unordered, so one failing doesn't stop the others from being
+        applied.
+
+        Args:
+          updates: dict
+            Keyed by userid.  Values are dicts with the "fields" to set on
+            the user, and the "locations" to add to them.  Users who
+            aren't in the database yet are added.
+
+        Returns: void
+
+        Raises:
+          pymongo.errors.BulkWriteError if any of the updates failed.  The
+          locations' statistics are still updated for the users whose
+          updates were applied, so retrying all of the updates is safe.
+        """
+        if not updates:
+            return
+
+        users = self._get_users_collection()
+
+        # Bulk updates can't return the documents they change, so the
+        # users are read first to work out the changes to their locations'
+        # statistics.
+        old_users = {
+            user[self.USERID_KEY]: user
+            for user in users.find(
+                {self.USERID_KEY: {"$in": list(updates)}},
+                fields=[self.USERID_KEY, self.LANGUAGES_KEY,
+                        self.NORMALIZED_LOCATION_KEY])
+        }
+
+        bulk = users.initialize_unordered_bulk_op()
+
+        # The userid of each of the bulk operations, in order.
+        operation_userids = []
+
+        for userid, update in updates.iteritems():
+            document = {}
+
+            if update["fields"]:
+                document["$set"] = update["fields"]
+
+            if update["locations"]:
+                document["$addToSet"] = {self.NORMALIZED_LOCATION_KEY: {
+                    "$each": list(update["locations"])}}
+
+            if document:
+                bulk.find({self.USERID_KEY: userid}).upsert().update_one(
+                    document)
+                operation_userids.append(userid)
+
+        bulk_error = None
+        failed_userids = set()
+        if operation_userids:
+            try:
+                bulk.execute()
+            except pymongo.errors.BulkWriteError as error:
+                # The other updates were applied, so their changes to the
+                # statistics must be too: when the updates are retried
+                # the users will already have their new languages.
+                bulk_error = error
+                failed_userids = set(
+                    operation_userids[write_error["index"]]
+                    for write_error in error.details.get("writeErrors", []))
+
+        self._update_location_stats([
+            (old_users.get(userid),
+             update["fields"].get(self.LANGUAGES_KEY),
+             update["locations"])
+            for userid, update in updates.iteritems()
+            if userid not in failed_userids
+        ])
+
+        if bulk_error is not None:
+            raise bulk_error
+
+    def _update_location_stats(self, changes):
+        """
+        Applies changes to users' languages and locations to the
+        statistics of the locations they are in.
+
+        The statistics are changed by the difference between each user's
+        old and new languages with $inc, so writes which happen between a
+        user being read and the statistics being updated, or a crash in
+        between, can throw them off.  verify_location_stats finds those
+        errors and rebuild_location_stats corrects them.
+
+        Args:
+          changes: list((dict, dict, list))
+            Each user's document as it was before (None if they weren't in
+            the database), their new language statistics (None if they
+            didn't change) and the locations added to them.
+
+        Returns: void
+        """
+        increments = collections.defaultdict(dict)
+
+        for old_user, languages, added_locations in changes:
+            old_user = old_user or {}
+            old_languages = old_user.get(self.LANGUAGES_KEY) or {}
+            old_locations = old_user.get(self.NORMALIZED_LOCATION_KEY) or []
+            if isinstance(old_locations, basestring):
+                old_locations = [old_locations]
+
+            if languages is None:
+                languages = old_languages
+
+            for location in set(old_locations) | set(added_locations):
+                # A location the user wasn't in before gets all of their
+                # languages.
+                before = (old_languages if location in old_locations
+                          else {})
+
+                location_increments = increments[location]
+                for language in set(before) | set(languages):
+                    key = _escape_key(language)
+                    old_size = before.get(language)
+                    new_size = languages.get(language)
+
+                    size_change = (new_size or 0) - (old_size or 0)
+                    developer_change = ((new_size is not None) -
+                                        (old_size is not None))
+
+                    for field, change in (("bytes", size_change),
+                                          ("developers", developer_change)):
+                        if change != 0:
+                            path = u"{}.{}".format(field, key)
+                            location_increments[path] = (
+                                location_increments.get(path, 0) + change)
+
+        for location, location_increments in increments.iteritems():
+            if location_increments:
+                self._get_location_stats_collection().update(
+                    {"_id": location}, {"$inc": location_increments},
+                    upsert=True)
+
+    def get_user_repo_stats(self, userid):
+        """
+        Retrieves the language statistics saved for each of a user's
+        repositories.
+
+        Args:
+          userid: str
+
+        Returns:
+          repo_stats: dict
+            Keys are repository names.  Values are dicts with the
+            "pushed_at" time the statistics were looked up for, and the
+            "languages" themselves.
+        """
+        return {
+            repo["name"]: {"pushed_at": repo["pushed_at"],
+                           self.LANGUAGES_KEY: repo[self.LANGUAGES_KEY]}
+            for repo in self._get_repo_stats_collection().find(
+                {"owner": userid})
+        }
+
+    @timed_write
+    def set_user_repo_stats(self, userid, repo_name, pushed_at,
+                            language_stats):
+        """
+        Saves the language statistics of one of a user's repositories, as
+        they counted towards the user's totals.
+
+        Args:
+          userid: str
+          repo_name: str
+          pushed_at: str
+            When the repository was last pushed to.  If it hasn't been
+            pushed to since, the statistics are still up to date.
+          language_stats: dict
+
+        Returns: void
+        """
+        self._get_repo_stats_collection().update(
+            {"_id": "{}/{}".format(userid, repo_name)},
+            {"$set": {"owner": userid,
+                      "name": repo_name,
+                      "pushed_at": pushed_at,
+                      self.LANGUAGES_KEY: language_stats}},
             upsert=True
         )
 
+    @timed_write
+    def remove_user_repo_stats(self, userid, repo_names):
+        """
+        Removes the saved statistics of repositories which no longer
+        count towards a user's totals, e.g. because they were deleted.
+        """
+        self._get_repo_stats_collection().remove(
+            {"owner": userid, "name": {"$in": repo_names}})
+
     def get_location_language_stats(self, location_normalized):
         """
         Retrieves programming language statistics for a location which are
@@ -175,16 +730,496 @@ class MongoDatabase(object):
             Keys are the language name, values are the number of developers
             in the location with code in that language.
         """
-        language_bytes = collections.defaultdict(int)
-        developer_counts = collections.defaultdict(int)
+        location_stats = self._get_location_stats_collection().find_one(
+            {"_id": location_normalized})
+
+        if location_stats is None:
+            # Not built yet
+            return self._aggregate_location_language_stats(
+                location_normalized)
 
-        for user in self.get_users(location=location_normalized):
-            for language, count in user[self.LANGUAGES_KEY].iteritems():
-                language_bytes[language] += count
-                developer_counts[language] += 1
+        language_bytes = {}
+        developer_counts = {}
+        for key, developers in location_stats.get("developers",
+                                                  {}).iteritems():
+            # Languages nobody uses anymore are left at 0.
+            if developers > 0:
+                language = _unescape_key(key)
+                language_bytes[language] = location_stats["bytes"].get(key, 0)
+                developer_counts[language] = developers
 
         return language_bytes, developer_counts
 
+    def _aggregate_location_language_stats(self, location_normalized):
+        """
+        Sums up a location's language statistics from its users' documents,
+        like get_location_language_stats but without using the saved
+        statistics.
+        """
+        # Summed by the database so that the users' documents don't all
+        # have to be sent over and decoded.
+        result = self._get_users_collection().aggregate([
+            {"$match": {self.NORMALIZED_LOCATION_KEY: location_normalized}},
+            {"$project": {self.LANGUAGE_LIST_KEY: 1}},
+            {"$unwind": "$" + self.LANGUAGE_LIST_KEY},
+            {"$group": {
+                "_id": "${}.name".format(self.LANGUAGE_LIST_KEY),
+                "bytes": {"$sum": "${}.bytes".format(self.LANGUAGE_LIST_KEY)},
+                "developers": {"$sum": 1}
+            }}
+        ])["result"]
+
+        language_bytes = {}
+        developer_counts = {}
+        for language in result:
+            language_bytes[language["_id"]] = language["bytes"]
+            developer_counts[language["_id"]] = language["developers"]
+
+        return language_bytes, developer_counts
+
+    def _aggregate_all_location_stats(self):
+        """
+        Sums up the language statistics of every location from the users'
+        documents.
+
+        Returns:
+          location_stats: dict
+            Keyed by location, values are documents as they are stored in
+            the location statistics collection.
+        """
+        result = self._get_users_collection().aggregate([
+            {"$project": {self.NORMALIZED_LOCATION_KEY: 1,
+                          self.LANGUAGE_LIST_KEY: 1}},
+            {"$unwind": "$" + self.NORMALIZED_LOCATION_KEY},
+            {"$unwind": "$" + self.LANGUAGE_LIST_KEY},
+            {"$group": {
+                "_id": {
+                    "location": "$" + self.NORMALIZED_LOCATION_KEY,
+                    "language": "${}.name".format(self.LANGUAGE_LIST_KEY)
+                },
+                "bytes": {"$sum": "${}.bytes".format(self.LANGUAGE_LIST_KEY)},
+                "developers": {"$sum": 1}
+            }}
+        ])["result"]
+
+        location_stats = {}
+        for group in result:
+            location = group["_id"]["location"]
+            key = _escape_key(group["_id"]["language"])
+
+            stats = location_stats.setdefault(
+                location, {"_id": location, "bytes": {}, "developers": {}})
+            stats["bytes"][key] = group["bytes"]
+            stats["developers"][key] = group["developers"]
+
+        return location_stats
+
+    def rebuild_location_stats(self):
+        """
+        Replaces the saved statistics of every location with ones summed up
+        from the users' documents, correcting any errors in them.
+
+        Returns: void
+        """
+        location_stats = self._aggregate_all_location_stats()
+        collection = self._get_location_stats_collection()
+
+        for location, stats in location_stats.iteritems():
+            collection.update({"_id": location}, stats, upsert=True)
+
+        collection.remove({"_id": {"$nin": list(location_stats)}})
+
+    def verify_location_stats(self):
+        """
+        Compares the saved statistics of every location with ones summed up
+        from the users' documents.
+
+        Returns:
+          locations: list(str)
+            The locations whose saved statistics are wrong or missing.
+        """
+        def used_languages(stats):
+            return {
+                key: (stats["bytes"].get(key, 0), developers)
+                for key, developers in stats.get("developers", {}).iteritems()
+                if developers > 0
+            }
+
+        expected = self._aggregate_all_location_stats()
+        saved = {stats["_id"]: used_languages(stats)
+                 for stats in self._get_location_stats_collection().find()}
+
+        return sorted(
+            location
+            for location in set(expected) | set(saved)
+            if used_languages(expected.get(location, {})) !=
+            saved.get(location, {})
+        )
+
+    @timed_write
+    def insert_job(self, job):
+        """
+        Adds a job to the crawl queue as pending, unless a job with the same
+        id has already been added.
+
+        Args:
+          job: dict
+            Must contain an "_id" which identifies the work being done, so
+            that queueing the same work twice doesn't duplicate it.
+
+        Returns: void
+        """
+        fields = dict(job)
+        job_id = fields.pop("_id")
+        fields.update({"state": self.JOB_PENDING, "lease_expires": None,
+                       "not_before": None})
+
+        self._get_jobs_collection().update(
+            {"_id": job_id},
+            {"$setOnInsert": fields},
+            upsert=True
+        )
+
+    @timed_write
+    def lease_job(self, lease_seconds, worker_id=None, by_priority=False):
+        """
+        Claims a pending job, or one whose lease has expired.  The claim
+        is atomic, so a job is never handed out twice at the same time,
+        even to workers in different processes or on different hosts.
+        Jobs released to be retried later aren't claimed until then.
+
+        Args:
+          lease_seconds: int
+            How long the job is reserved for.  If it hasn't been completed,
+            released or renewed by then it is handed out again.
+          worker_id: str
+            Identifies the worker holding the lease.
+          by_priority: bool
+            If True, the job with the highest "priority" field is leased
+            first.  Otherwise jobs are leased in no particular order.
+
+        Returns:
+          job: dict
+            None if there are no jobs available.
+        """
+        now = time.time()
+
+        sort = None
+        if by_priority:
+            sort = [("priority", pymongo.DESCENDING)]
+
+        return self._get_jobs_collection().find_and_modify(
+            query={"$or": [
+                # Also matches jobs without a not_before time.
+                {"state": self.JOB_PENDING,
+                 "not_before": {"$not": {"$gt": now}}},
+                {"state": self.JOB_LEASED, "lease_expires": {"$lt": now}}
+            ]},
+            update={"$set": {"state": self.JOB_LEASED,
+                             "lease_expires": now + lease_seconds,
+                             "worker": worker_id}},
+            sort=sort,
+            new=True
+        )
+
+    def renew_leases(self, job_ids, worker_id, lease_seconds):
+        """
+        Extends the leases a worker holds on jobs it is still processing.
+        Leases which have since been given to another worker are left
+        alone.
+
+        Args:
+          job_ids: list
+          worker_id: str
+          lease_seconds: int
+            How long from now the leases are extended to.
+
+        Returns: void
+        """
+        self._get_jobs_collection().update(
+            {"_id": {"$in": job_ids},
+             "state": self.JOB_LEASED,
+             "worker": worker_id},
+            {"$set": {"lease_expires": time.time() + lease_seconds}},
+            multi=True
+        )
+
+    def reclaim_expired_jobs(self):
+        """
+        Returns jobs whose leases have expired to the queue, since the
+        workers holding them have presumably died.
+
+        Returns: int
+          The number of jobs reclaimed.
+        """
+        result = self._get_jobs_collection().update(
+            {"state": self.JOB_LEASED, "lease_expires": {"$lt": time.time()}},
+            {"$set": {"state": self.JOB_PENDING, "lease_expires": None}},
+            multi=True
+        )
+
+        return result["n"]
+
+    @timed_write
+    def complete_job(self, job_id):
+        self._set_job_state(job_id, self.JOB_DONE)
+
+    @timed_write
+    def release_job(self, job_id, attempts=0, not_before=None):
+        """
+        Returns a leased job to the queue so it can be tried again.
+
+        Args:
+          job_id:
+          attempts: int
+            The number of times the job has failed so far.
+          not_before: float
+            If provided, the job isn't leased again until this time.
+
+        Returns: void
+        """
+        self._get_jobs_collection().update(
+            {"_id": job_id},
+            {"$set": {"state": self.JOB_PENDING,
+                      "lease_expires": None,
+                      "attempts": attempts,
+                      "not_before": not_before}}
+        )
+
+    @timed_write
+    def requeue_job(self, job):
+        """
+        Adds a job to the crawl queue as pending, replacing any job with the
+        same id even if it was already completed.
+
+        Args:
+          job: dict
+            Must contain an "_id", as for insert_job.
+
+        Returns: void
+        """
+        fields = dict(job)
+        job_id = fields.pop("_id")
+        fields.update({"state": self.JOB_PENDING,
+                       "lease_expires": None,
+                       "not_before": None,
+                       "attempts": 0})
+
+        self._get_jobs_collection().update(
+            {"_id": job_id},
+            {"$set": fields},
+            upsert=True
+        )
+
+    @timed_write
+    def fail_job(self, job_id):
+        self._set_job_state(job_id, self.JOB_FAILED)
+
+    def _set_job_state(self, job_id, state):
+        self._get_jobs_collection().update(
+            {"_id": job_id},
+            {"$set": {"state": state, "lease_expires": None}}
+        )
+
+    def release_leased_jobs(self):
+        """
+        Returns all leased jobs to the queue.  Used when resuming a crawl
+        whose workers have all stopped.
+        """
+        self._get_jobs_collection().update(
+            {"state": self.JOB_LEASED},
+            {"$set": {"state": self.JOB_PENDING, "lease_expires": None}},
+            multi=True
+        )
+
+    def count_jobs(self, states):
+        """
+        Counts the jobs in the crawl queue.
+
+        Args:
+          states: list(str)
+            Only count jobs in one of these states.
+
+        Returns: int
+        """
+        return self._get_jobs_collection().find(
+            {"state": {"$in": states}}).count()
+
+    def record_worker_heartbeat(self, worker_id):
+        """
+        Records that a worker is still alive.
+        """
+        self._get_workers_collection().update(
+            {"_id": worker_id},
+            {"$set": {"last_heartbeat": time.time()}},
+            upsert=True
+        )
+
+    def get_active_workers(self, max_age):
+        """
+        Lists the workers which have recorded a heartbeat recently.
+
+        Args:
+          max_age: float
+            How many seconds ago the last heartbeat can have been.
+
+        Returns:
+          worker_ids: list(str)
+        """
+        return [worker["_id"] for worker in
+                self._get_workers_collection().find(
+                    {"last_heartbeat": {"$gte": time.time() - max_age}})]
+
+    @timed_write
+    def set_checkpoint(self, name, value):
+        """
+        Records the progress of a crawl so it can be resumed.
+        """
+        self._get_checkpoints_collection().update(
+            {"_id": name},
+            {"$set": {"value": value}},
+            upsert=True
+        )
+
+    def get_checkpoint(self, name):
+        """
+        Returns the value of a checkpoint, or None if it hasn't been set.
+        """
+        checkpoint = self._get_checkpoints_collection().find_one(
+            {"_id": name})
+
+        return None if checkpoint is None else checkpoint["value"]
+
+    @timed_write
+    def start_language_aggregation(self, userid, repo_names):
+        """
+        Starts summing up the language statistics of a user's
+        repositories.  Nothing happens if this user's statistics are
+        already being summed up.
+
+        Args:
+          userid: str
+          repo_names: list(str)
+            The repositories whose statistics are being waited on.
+
+        Returns: bool
+          True if the aggregation was started.
+        """
+        result = self._get_aggregations_collection().update(
+            {"_id": userid},
+            {"$setOnInsert": {"pending": repo_names, self.LANGUAGES_KEY: {}}},
+            upsert=True
+        )
+
+        return not result["updatedExisting"]
+
+    def get_pending_repos(self, userid):
+        """
+        Returns the names of the repositories a user's language
+        aggregation is still waiting on, or an empty list if there isn't
+        one.
+        """
+        aggregation = self._get_aggregations_collection().find_one(
+            {"_id": userid}, fields=["pending"])
+
+        if aggregation is None:
+            return []
+
+        return aggregation["pending"]
+
+    @timed_write
+    def add_repo_language_stats(self, userid, repo_name, language_stats):
+        """
+        Adds the language statistics of one repository to its owner's
+        aggregation.  Adding the same repository twice has no effect.
+
+        Args:
+          userid: str
+          repo_name: str
+          language_stats: dict
+            Keys are the language names, values are the number of bytes
+            written in that language.
+
+        Returns:
+          user_language_stats: dict
+            The total for all of the user's repositories if this was the
+            last one being waited on, otherwise None.
+        """
+        update = {"$pull": {"pending": repo_name}}
+        if language_stats:
+            # Escaped so that e.g. "ASP.NET" isn't taken as a nested field.
+            update["$inc"] = {
+                u"{}.{}".format(self.LANGUAGES_KEY,
+                                _escape_key(language)): size
+                for language, size in language_stats.iteritems()
+            }
+
+        aggregation = self._get_aggregations_collection().find_and_modify(
+            query={"_id": userid, "pending": repo_name},
+            update=update,
+            new=True
+        )
+
+        if aggregation is None or aggregation["pending"]:
+            return None
+
+        self._get_aggregations_collection().remove(
+            {"_id": userid, "pending": []})
+
+        return {_unescape_key(language): size
+                for language, size in
+                aggregation[self.LANGUAGES_KEY].iteritems()}
+
+    @timed_write
+    def insert_dead_letter(self, job, error, attempts):
+        """
+        Records a job which was given up on, so that it can be inspected
+        and replayed later.  Dead letters are kept between crawls.
+
+        Args:
+          job: dict
+            The job, as it would be stored in the crawl queue.
+          error: str
+            A description of the last error the job failed with.
+          attempts: int
+            How many times the job was tried.
+
+        Returns: void
+        """
+        self._get_dead_letters_collection().update(
+            {"_id": job["_id"]},
+            {"$set": {"job": job,
+                      "error": error,
+                      "attempts": attempts,
+                      "failed_at": time.time()}},
+            upsert=True
+        )
+
+    def get_dead_letters(self):
+        """
+        Returns: list(dict)
+          The jobs which were given up on, oldest first.  Each has the
+          "job" itself, the "error" it last failed with, the number of
+          "attempts" made and when it "failed_at".
+        """
+        return list(self._get_dead_letters_collection().find(
+            sort=[("failed_at", pymongo.ASCENDING)]))
+
+    def remove_dead_letter(self, dead_letter_id):
+        self._get_dead_letters_collection().remove({"_id": dead_letter_id})
+
+    def reset_crawl_state(self):
+        """
+        Removes the crawl queue, checkpoints and unfinished aggregations
+        so that the next crawl starts from the beginning.
+        """
+        self._get_jobs_collection().drop()
+        self._get_checkpoints_collection().drop()
+        self._get_aggregations_collection().drop()
+
+        # Dropping the queue dropped its indexes too.
+        self._ensure_job_indexes()
+
     def is_admin_initialized(self):
         """
         Checks if the administrator account has been created.
@@ -0,0 +1,172 @@
+# Copyright (C) 2014 David Rusk
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+__author__ = "David Rusk <drusk@uvic.ca>"
+
+import pymongo
+
+from osstrends.database import MongoDatabase
+
+DEFAULT_PAGE_SIZE = 10
+
+# Larger pages are cut down, so a request's cost stays bounded.
+MAX_PAGE_SIZE = 100
+
+# The fields shown in each column of the user tables.  The last column is
+# the amount of code, which depends on whether the table is for a language.
+USER_COLUMNS = ["name", MongoDatabase.USERID_KEY, "company"]
+
+
+def _int_arg(args, name, default):
+    try:
+        return int(args.get(name, default))
+    except ValueError:
+        raise ValueError("{} must be an integer".format(name))
+
+
+class TableRequest(object):
+    """
+    The page, order and search a table using server-side processing asks
+    for, so that the browser only receives the rows it displays.  Follows
+    the protocol of DataTables 1.9
+    (http://legacy.datatables.net/usage/server-side).
+    """
+
+    def __init__(self, echo=0, start=0, length=DEFAULT_PAGE_SIZE,
+                 sort_column=0, ascending=True, search=""):
+        self.echo = echo
+        self.start = start
+        self.length = length
+        self.sort_column = sort_column
+        self.ascending = ascending
+        self.search = search
+
+    @classmethod
+    def from_args(cls, args):
+        """
+        Reads a request from the query string parameters DataTables sends.
+        Only the first sort column is used.
+
+        Args:
+          args: dict-like
+
+        Returns:
+          request: TableRequest
+
+        Raises:
+          ValueError if a parameter is invalid.
+        """
+        length = _int_arg(args, "iDisplayLength", DEFAULT_PAGE_SIZE)
+        if length < 0 or length > MAX_PAGE_SIZE:
+            # -1 asks for every row.
+            length = MAX_PAGE_SIZE
+
+        return cls(echo=_int_arg(args, "sEcho", 0),
+                   start=max(_int_arg(args, "iDisplayStart", 0), 0),
+                   length=length,
+                   sort_column=_int_arg(args, "iSortCol_0", 0),
+                   ascending=args.get("sSortDir_0", "asc") != "desc",
+                   search=args.get("sSearch", "").strip())
+
+    def response(self, num_total, num_filtered, rows):
+        """
+        Builds the reply to the request, to be sent as JSON.
+
+        Args:
+          num_total: int
+            The number of rows in the table before searching.
+          num_filtered: int
+            The number of rows matching the search.
+          rows: list(list)
+            The cells of the rows on the requested page.
+
+        Returns:
+          response: dict
+        """
+        return {
+            # Sent back so DataTables can ignore replies which arrive out
+            # of order.
+            "sEcho": self.echo,
+            "iTotalRecords": num_total,
+            "iTotalDisplayRecords": num_filtered,
+            "aaData": rows
+        }
+
+
+def code_size_field(language=None):
+    """
+    Returns the field holding a user's amount of code in a language, or in
+    total if language is None.
+    """
+    if language is None:
+        return MongoDatabase.TOTAL_CODE_SIZE_KEY
+
+    return "{}.{}".format(MongoDatabase.LANGUAGES_KEY, language)
+
+
+def get_users_page(db, request, location, language=None):
+    """
+    Retrieves the page of a location's users a table asks for.
+
+    Args:
+      db: osstrends.database.MongoDatabase
+      request: TableRequest
+      location: str
+        Must be normalized.
+      language: str
+        If provided, only users with code in this language are included.
+
+    Returns:
+      num_total: int
+        The number of users in the table.
+      num_filtered: int
+        The number of them matching the search.
+      users: list(dict)
+        The users on the page, with only the fields shown in the table.
+    """
+    columns = USER_COLUMNS + [code_size_field(language)]
+
+    sort_column = request.sort_column
+    if not 0 <= sort_column < len(columns):
+        sort_column = 0
+
+    direction = pymongo.ASCENDING if request.ascending else pymongo.DESCENDING
+
+    # The login breaks ties, so that pages don't overlap.  It is sorted in
+    # the same direction, so that the indexes for the tables can be read
+    # either forwards or backwards.
+    sort = [(columns[sort_column], direction)]
+    if columns[sort_column] != MongoDatabase.USERID_KEY:
+        sort.append((MongoDatabase.USERID_KEY, direction))
+
+    num_total = db.count_users(location=location, language=language)
+
+    num_filtered = num_total
+    if request.search:
+        num_filtered = db.count_users(location=location, language=language,
+                                      search=request.search)
+
+    # For a language, only that language's size is read out of the user's
+    # language statistics.
+    users = db.get_users(location=location, language=language, fields=columns,
+                         search=request.search, sort=sort,
+                         skip=request.start, limit=request.length)
+
+    return num_total, num_filtered, users
@@ -0,0 +1,125 @@
+# Copyright (C) 2014 David Rusk
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+__author__ = "David Rusk <drusk@uvic.ca>"
+
+import hashlib
+import math
+import struct
+import threading
+
+
+class SeenSet(object):
+    """
+    Remembers which keys have been seen, e.g. which users have already been
+    queued during a crawl.  Safe to share between threads.
+    """
+
+    def __init__(self):
+        self._keys = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._keys
+
+    def add(self, key):
+        """
+        Marks a key as seen.
+
+        Returns: bool
+          True if the key had not been seen before.
+        """
+        with self._lock:
+            if key in self._keys:
+                return False
+
+            self._keys.add(key)
+            return True
+
+
+class BloomFilter(object):
+    """
+    A drop-in replacement for SeenSet which uses a small, fixed amount of
+    memory regardless of how many keys are added, for very large crawls.
+    In exchange, a key which has not been seen is occasionally reported
+    as seen (a false positive), but a key which has been seen is never
+    reported as new.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        """
+        Constructor.
+
+        Args:
+          capacity: int
+            The number of keys expected to be added.
+          error_rate: float
+            The chance of a false positive once capacity keys have been
+            added.
+        """
+        self.capacity = capacity
+        self.error_rate = error_rate
+
+        # The optimal sizes for the expected number of keys.
+        self.num_bits = int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, int(round(
+            float(self.num_bits) / capacity * math.log(2))))
+
+        self._bits = bytearray((self.num_bits + 7) // 8)
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return all(self._bits[bit // 8] & (1 << (bit % 8))
+                       for bit in self._bit_positions(key))
+
+    def add(self, key):
+        """
+        Marks a key as seen.
+
+        Returns: bool
+          True if the key had not been seen before (barring false
+          positives).
+        """
+        is_new = False
+
+        with self._lock:
+            for bit in self._bit_positions(key):
+                mask = 1 << (bit % 8)
+
+                if not self._bits[bit // 8] & mask:
+                    self._bits[bit // 8] |= mask
+                    is_new = True
+
+        return is_new
+
+    def _bit_positions(self, key):
+        # Two independent hashes are combined to simulate as many as are
+        # needed (Kirsch and Mitzenmacher's double hashing).
+        digest = hashlib.sha1(key.encode("utf-8")).digest()
+        hash1, hash2 = struct.unpack("<QQ", digest[:16])
+
+        return [(hash1 + i * hash2) % self.num_bits
+                for i in xrange(self.num_hashes)]
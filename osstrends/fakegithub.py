@@ -0,0 +1,511 @@
+# Copyright (C) 2014 David Rusk
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+__author__ = "David Rusk <drusk@uvic.ca>"
+
+import BaseHTTPServer
+import collections
+import datetime
+import hashlib
+import json
+import math
+import random
+import re
+import socket
+import SocketServer
+import threading
+import time
+import urllib
+import urlparse
+
+from osstrends.github import endpoint_name
+
+LANGUAGES = ["Python", "Java", "JavaScript", "C", "C++", "Ruby", "Go",
+             "Shell", "PHP", "Haskell"]
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                           BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, *args, **kwargs):
+        BaseHTTPServer.HTTPServer.__init__(self, *args, **kwargs)
+
+        # Open keep-alive connections, each with a thread waiting on it.
+        self._connections = set()
+        self._connections_lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        with self._connections_lock:
+            self._connections.add(request)
+
+        SocketServer.ThreadingMixIn.process_request(self, request,
+                                                    client_address)
+
+    def shutdown_request(self, request):
+        with self._connections_lock:
+            self._connections.discard(request)
+
+        BaseHTTPServer.HTTPServer.shutdown_request(self, request)
+
+    def close_connections(self, timeout=1):
+        """
+        Closes the open connections and waits for their threads to finish.
+        """
+        with self._connections_lock:
+            connections = list(self._connections)
+
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                # Already closed by the client
+                pass
+
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            with self._connections_lock:
+                if not self._connections:
+                    return
+
+            time.sleep(0.01)
+
+
+class _FakeGitHubRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Keeps connections open between requests, as GitHub does.
+    protocol_version = "HTTP/1.1"
+
+    # Responses are written in one piece.  Writing the headers and body
+    # separately makes each request wait on a delayed ACK, which would
+    # swamp the latencies being simulated.
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        status, headers, body = self.server.fake_github.respond(
+            self.path, self.headers)
+
+        self.send_response(status)
+        for name, value in headers.iteritems():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeGitHub(object):
+    """
+    A local stand-in for the parts of the GitHub API used by
+    osstrends.github.GitHubSearcher, so that the pipeline can be run and
+    benchmarked without GitHub.  Point a searcher at it with
+    GitHubSearcher(api_url=fake_github.url).
+
+    It serves users, repositories and language statistics added with
+    add_user, either recorded from GitHub (like those in tests/data) or
+    made up by generate.  Like GitHub, it paginates results, only returns
+    the first 1000 results of a search, answers conditional requests with
+    "304 Not Modified" and reports rate limits in X-RateLimit headers.  It
+    can also be slowed down and made to fail some requests.
+    """
+
+    SEARCH_RESULT_LIMIT = 1000
+    DEFAULT_PAGE_SIZE = 30
+
+    def __init__(self, latency=0, latency_jitter=0, error_rate=0,
+                 rate_limit=None, rate_limit_window=3600, host="127.0.0.1",
+                 port=0, seed=None):
+        """
+        Constructor.
+
+        Args:
+          latency: float
+            Seconds to wait before answering each request.
+          latency_jitter: float
+            Up to this many more seconds are added to each request's
+            latency at random.
+          error_rate: float
+            The fraction of requests answered with "502 Bad Gateway".
+          rate_limit: int
+            The number of requests each set of credentials may make per
+            window, or None for no limit.  Search requests have a limit of
+            their own.
+          rate_limit_window: int
+            Seconds until a rate limit resets.
+          host: str
+          port: int
+            Where to listen.  The default port of 0 picks a free one.
+          seed: int
+            Makes the errors, latencies and generated data repeatable.
+        """
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.rate_limit_window = rate_limit_window
+
+        self._random = random.Random(seed)
+
+        self._users = collections.OrderedDict()
+        self._repos = {}
+        self._repo_languages = {}
+        self._repo_sources = {}
+
+        # Keyed by (credentials, bucket), values are [remaining, reset]
+        self._rate_limits = {}
+
+        self._request_counts = collections.defaultdict(int)
+        self._lock = threading.Lock()
+
+        self._server = _ThreadingHTTPServer((host, port),
+                                            _FakeGitHubRequestHandler)
+        self._server.fake_github = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return "http://{}:{}".format(host, port)
+
+    def start(self):
+        """
+        Starts serving requests from a background thread.
+        """
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        kwargs={"poll_interval": 0.1})
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.close_connections()
+        self._server.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def add_user(self, user, repos=(), repo_languages=None,
+                 repo_sources=None):
+        """
+        Adds a user for the API to serve.
+
+        Args:
+          user: dict
+            As returned for /users/:login.  Searches find the user by its
+            "location" and "created_at".
+          repos: list(dict)
+            As returned for /users/:login/repos.
+          repo_languages: dict
+            Keyed by repository name, values are the language statistics
+            returned for /repos/:owner/:repo/languages.  Repositories
+            without any have none.
+          repo_sources: dict
+            Keyed by repository name, values are the full names of the
+            repositories forks were created from.
+        """
+        login = user["login"]
+
+        self._users[login] = user
+        self._repos[login] = list(repos)
+
+        for repo_name, language_stats in (repo_languages or {}).iteritems():
+            self._repo_languages["{}/{}".format(login, repo_name)] = (
+                language_stats)
+
+        for repo_name, source in (repo_sources or {}).iteritems():
+            self._repo_sources["{}/{}".format(login, repo_name)] = source
+
+    def generate(self, locations, users_per_location, repos_per_user,
+                 fork_fraction=0.2):
+        """
+        Makes up users for the API to serve.
+
+        Args:
+          locations: list(str)
+            The search terms the users are found by.
+          users_per_location: int
+          repos_per_user: int
+          fork_fraction: float
+            The fraction of repositories which are forks.  Half of the
+            forks haven't been pushed to since they were created.
+        """
+        start_date = datetime.date(2008, 1, 1)
+        num_days = (datetime.date(2014, 1, 1) - start_date).days
+
+        for location in locations:
+            prefix = re.sub(r"\W", "", location.lower())
+
+            for user_index in xrange(users_per_location):
+                login = "{}-{}".format(prefix, user_index)
+                created_at = start_date + datetime.timedelta(
+                    days=self._random.randrange(num_days))
+
+                user = {
+                    "login": login,
+                    "name": "User {} of {}".format(user_index, location),
+                    "location": location,
+                    "created_at": created_at.isoformat() + "T00:00:00Z",
+                    "updated_at": "2014-01-01T00:00:00Z",
+                    "public_repos": repos_per_user
+                }
+
+                repos = []
+                repo_languages = {}
+                repo_sources = {}
+                for repo_index in xrange(repos_per_user):
+                    name = "repo-{}".format(repo_index)
+                    fork = self._random.random() < fork_fraction
+
+                    repo_created_at = "2014-01-01T00:00:00Z"
+                    pushed_at = "2014-02-01T00:00:00Z"
+                    if fork and self._random.random() < 0.5:
+                        pushed_at = repo_created_at
+
+                    repos.append({
+                        "name": name,
+                        "full_name": "{}/{}".format(login, name),
+                        "fork": fork,
+                        "created_at": repo_created_at,
+                        "pushed_at": pushed_at
+                    })
+
+                    repo_languages[name] = {
+                        language: self._random.randint(100, 100000)
+                        for language in self._random.sample(
+                            LANGUAGES, self._random.randint(1, 3))
+                    }
+
+                    if fork:
+                        repo_sources[name] = "upstream/{}".format(name)
+
+                self.add_user(user, repos, repo_languages, repo_sources)
+
+    def request_counts(self):
+        """
+        Returns:
+          counts: dict
+            The number of requests received for each endpoint (see
+            osstrends.github.endpoint_name).
+        """
+        with self._lock:
+            return dict(self._request_counts)
+
+    def num_requests(self):
+        return sum(self.request_counts().itervalues())
+
+    def reset_request_counts(self):
+        with self._lock:
+            self._request_counts.clear()
+
+    def respond(self, url, headers):
+        """
+        Answers a request.
+
+        Args:
+          url: str
+            The path and query string requested.
+          headers: dict-like
+            The request's headers.
+
+        Returns:
+          status: int
+          headers: dict
+          body: str
+        """
+        parsed_url = urlparse.urlparse(url)
+        path = parsed_url.path
+        query = dict(urlparse.parse_qsl(parsed_url.query))
+
+        with self._lock:
+            self._request_counts[endpoint_name(path)] += 1
+
+        delay = self.latency
+        if self.latency_jitter:
+            delay += self._random.uniform(0, self.latency_jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+        if self.error_rate and self._random.random() < self.error_rate:
+            return 502, {}, json.dumps({"message": "Server Error"})
+
+        status, body, links = self._route(path, query)
+        body = json.dumps(body)
+
+        response_headers = {"Content-Type": "application/json"}
+
+        if status == 200:
+            etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+            response_headers["ETag"] = etag
+
+            if headers.get("If-None-Match") == etag:
+                # Not modified responses don't count against the rate
+                # limit.
+                return 304, response_headers, ""
+
+        if self.rate_limit is not None:
+            bucket = "search" if path.startswith("/search") else "core"
+            remaining, reset_time = self._use_rate_limit(
+                headers.get("Authorization"), bucket)
+
+            response_headers["X-RateLimit-Limit"] = str(self.rate_limit)
+            response_headers["X-RateLimit-Remaining"] = str(max(remaining,
+                                                                0))
+            response_headers["X-RateLimit-Reset"] = str(reset_time)
+
+            if remaining < 0:
+                return 403, response_headers, json.dumps(
+                    {"message": "API rate limit exceeded"})
+
+        if links:
+            response_headers["Link"] = ", ".join(
+                '<{}{}?{}>; rel="{}"'.format(self.url, path,
+                                             urllib.urlencode(
+                                                 sorted(link_query.items())),
+                                             rel)
+                for rel, link_query in links)
+
+        return status, response_headers, body
+
+    def _use_rate_limit(self, credentials, bucket):
+        """
+        Counts a request against the rate limit of its credentials.
+
+        Returns:
+          remaining: int
+            The requests left in the window, negative if the request was
+            over the limit.
+          reset_time: int
+        """
+        now = int(time.time())
+
+        with self._lock:
+            key = (credentials, bucket)
+            state = self._rate_limits.get(key)
+
+            if state is None or state[1] <= now:
+                state = [self.rate_limit, now + self.rate_limit_window]
+                self._rate_limits[key] = state
+
+            state[0] -= 1
+
+            return state[0], state[1]
+
+    def _route(self, path, query):
+        """
+        Returns:
+          status: int
+          body: JSON-serializable
+          links: list((str, dict))
+            The rel and query parameters of each pagination link.
+        """
+        parts = path.strip("/").split("/")
+
+        if parts == ["search", "users"]:
+            return self._search_users(query)
+
+        if len(parts) == 2 and parts[0] == "users":
+            if parts[1] not in self._users:
+                return self._not_found()
+
+            return 200, self._users[parts[1]], []
+
+        if len(parts) == 3 and parts[0] == "users" and parts[2] == "repos":
+            if parts[1] not in self._users:
+                return self._not_found()
+
+            return self._paginate(self._repos[parts[1]], query)
+
+        if len(parts) in (3, 4) and parts[0] == "repos":
+            full_name = "{}/{}".format(parts[1], parts[2])
+            if full_name not in self._repo_languages:
+                return self._not_found()
+
+            if len(parts) == 4 and parts[3] == "languages":
+                return 200, self._repo_languages[full_name], []
+
+            if len(parts) == 3:
+                repo = {"full_name": full_name,
+                        "name": parts[2],
+                        "fork": full_name in self._repo_sources}
+                if repo["fork"]:
+                    repo["source"] = {
+                        "full_name": self._repo_sources[full_name]}
+
+                return 200, repo, []
+
+        if parts == ["rate_limit"]:
+            return 200, {"resources": {}}, []
+
+        return self._not_found()
+
+    def _not_found(self):
+        return 404, {"message": "Not Found"}, []
+
+    def _search_users(self, query):
+        location = None
+        created_range = None
+
+        for qualifier in query.get("q", "").split(" "):
+            if qualifier.startswith("location:"):
+                location = qualifier[len("location:"):].lower()
+            elif qualifier.startswith("created:"):
+                created_range = qualifier[len("created:"):].split("..")
+
+        matches = []
+        for user in self._users.itervalues():
+            if location not in (user.get("location") or "").lower():
+                continue
+
+            created_date = user.get("created_at", "")[:10]
+            if created_range is not None and not (
+                    created_range[0] <= created_date <= created_range[1]):
+                continue
+
+            matches.append({"login": user["login"]})
+
+        status, items, links = self._paginate(
+            matches[:self.SEARCH_RESULT_LIMIT], query)
+
+        if status != 200:
+            return status, items, links
+
+        return 200, {"total_count": len(matches), "items": items}, links
+
+    def _paginate(self, items, query):
+        per_page = int(query.get("per_page", self.DEFAULT_PAGE_SIZE))
+        page = int(query.get("page", 1))
+        num_pages = max(int(math.ceil(float(len(items)) / per_page)), 1)
+
+        if page > num_pages and page > 1:
+            return 422, {"message": "Page out of range"}, []
+
+        links = []
+        if page < num_pages:
+            links.append(("next", dict(query, page=page + 1)))
+            links.append(("last", dict(query, page=num_pages)))
+
+        start = (page - 1) * per_page
+        return 200, items[start:start + per_page], links
@@ -21,11 +21,49 @@
 __author__ = "David Rusk <drusk@uvic.ca>"
 
 import collections
+import datetime
+import logging
+import math
+import re
+import threading
+import time
 import urlparse
+from multiprocessing.pool import ThreadPool
 
 import requests
+from requests.adapters import HTTPAdapter
 
 from osstrends import auth
+from osstrends.concurrency import MovingAverage
+from osstrends.metrics import MetricsRegistry
+from osstrends.ratelimit import CORE_BUCKET, SEARCH_BUCKET, CredentialPool
+from osstrends.recording import RecordingAdapter, ReplayAdapter
+
+logger = logging.getLogger(__name__)
+
+# Requests are labelled in the metrics by which endpoint they were sent to
+# rather than by URL, so that all users' requests are counted together.
+ENDPOINTS = [
+    ("search_users", re.compile(r"^/search/users$")),
+    ("user", re.compile(r"^/users/[^/]+$")),
+    ("user_repos", re.compile(r"^/users/[^/]+/repos$")),
+    ("repo", re.compile(r"^/repos/[^/]+/[^/]+$")),
+    ("repo_languages", re.compile(r"^/repos/[^/]+/[^/]+/languages$")),
+    ("rate_limit", re.compile(r"^/rate_limit$"))
+]
+
+
+def endpoint_name(path):
+    """
+    Returns the name of the API endpoint a URL path belongs to, e.g.
+    "user_repos" for "/users/drusk/repos", or "other" if it isn't one used
+    by the application.
+    """
+    for name, pattern in ENDPOINTS:
+        if pattern.match(path):
+            return name
+
+    return "other"
 
 
 class RateLimitException(Exception):
@@ -41,6 +79,29 @@ class RateLimitException(Exception):
         return "Rate limit exceeded.  Resets at %d" % self.reset_time
 
 
+class GitHubApiException(Exception):
+    """
+    The API answered a request with an error.
+    """
+
+    def __init__(self, status_code, url):
+        super(GitHubApiException, self).__init__()
+        self.status_code = status_code
+        self.url = url
+
+    @property
+    def transient(self):
+        """
+        True if the request might succeed if it is tried again later, as
+        with server errors.  Errors such as "404 Not Found" for a deleted
+        account or "451 Unavailable For Legal Reasons" are permanent.
+        """
+        return self.status_code >= 500 or self.status_code == 429
+
+    def __str__(self):
+        return "GitHub API returned %d for %s" % (self.status_code, self.url)
+
+
 class GitHubSearcher(object):
     """
     Performs searches on the GitHub API.
@@ -49,6 +110,96 @@ class GitHubSearcher(object):
     GH_API_URL_BASE = "https://api.github.com"
     GH_SEARCH_HEADERS = {"Accept": "application/vnd.github.preview"}
 
+    # The search API never returns more than this many results for one
+    # query, regardless of pagination.
+    GH_SEARCH_RESULT_LIMIT = 1000
+    GH_SEARCH_PAGE_SIZE = 100
+    GH_REPOS_PAGE_SIZE = 100
+
+    # No accounts were created before GitHub launched.
+    GH_LAUNCH_DATE = datetime.date(2007, 10, 1)
+
+    DEFAULT_POOL_SIZE = 10
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, cache=None,
+                 credentials=None, metrics=None, api_url=GH_API_URL_BASE,
+                 recorder=None, replay=None):
+        """
+        Constructor.
+
+        Args:
+          pool_size: int
+            The maximum number of keep-alive connections held open to the
+            API.  This should match the number of threads making requests
+            through this searcher, since each request in flight holds a
+            connection until its response has been read.
+          cache: osstrends.cache.ResponseCache
+            If provided, responses are cached and requests for URLs that
+            were seen before are made conditional.
+          credentials: osstrends.ratelimit.CredentialPool
+            The credentials to authenticate with, each of which paces its
+            requests to stay within its rate limit.  All threads using
+            this searcher share them.  Defaults to the credentials in
+            osstrends.auth.
+          metrics: osstrends.metrics.MetricsRegistry
+            Where the number and latency of requests to each endpoint, and
+            the time spent waiting on the rate limit, are recorded.
+            Defaults to a registry of the searcher's own.
+          api_url: str
+            Where the API is, e.g. a osstrends.fakegithub.FakeGitHub
+            server's URL for benchmarking.
+          recorder: osstrends.recording.TrafficRecorder
+            If provided, every request and its response are written to
+            it.
+          replay: osstrends.recording.TrafficReplay
+            If provided, requests are answered from recorded traffic
+            instead of being sent.
+        """
+        self.api_url = api_url
+        self.pool_size = pool_size
+        self.cache = cache
+
+        if credentials is None:
+            credentials = CredentialPool(auth.GH_AUTH_CREDENTIALS)
+        self.credentials = credentials
+
+        # How long recent requests have taken to be answered.
+        self.latency = MovingAverage()
+
+        if metrics is None:
+            metrics = MetricsRegistry()
+        self.metrics = metrics
+
+        self._requests = metrics.counter(
+            "github_requests_total",
+            "API requests sent, by endpoint and response status.")
+        self._request_seconds = metrics.histogram(
+            "github_request_seconds",
+            "Time taken for API requests to be answered, by endpoint.")
+        self._rate_limit_wait_seconds = metrics.counter(
+            "github_rate_limit_wait_seconds_total",
+            "Time requests spent waiting for the rate limit, by bucket.")
+
+        # Created the first time requests are fanned out.
+        self._thread_pool = None
+        self._thread_pool_lock = threading.Lock()
+
+        # One session is shared by all threads so that connections (and
+        # their TLS handshakes) are reused between requests.  Blocking
+        # makes threads wait for a free connection instead of opening
+        # extra ones that get thrown away afterwards.
+        if replay is not None:
+            self._adapter = ReplayAdapter(replay)
+        elif recorder is not None:
+            self._adapter = RecordingAdapter(recorder, pool_maxsize=pool_size,
+                                             pool_block=True)
+        else:
+            self._adapter = HTTPAdapter(pool_maxsize=pool_size,
+                                        pool_block=True)
+        self._session = requests.Session()
+        self._session.mount("https://", self._adapter)
+        self._session.mount("http://", self._adapter)
+
     def search_user(self, userid):
         """
         Retrieve the GitHub user object for the user with the specified userid.
@@ -62,31 +213,68 @@ class GitHubSearcher(object):
         """
         return self._gh_http_get("/users/{}".format(userid)).json()
 
-    def search_users_by_location(self, location):
+    def search_users_by_location(self, location, sharded=False):
         """
         Search for GitHub users who list their location.
 
         Args:
           location: str
             The location value to look for.
+          sharded: bool
+            See iter_users_by_location.
 
         Returns:
           users: list of JSON objects with data for users who matched the
           location.  Note that this does NOT contain all the user
           information available with a direct user lookup.
         """
+        return list(self.iter_users_by_location(location, sharded=sharded))
+
+    def iter_users_by_location(self, location, sharded=False):
+        """
+        Search for GitHub users who list their location, yielding them as
+        each page of results arrives rather than waiting for all of them.
+
+        Args:
+          location: str
+            The location value to look for.
+          sharded: bool
+            The search API only returns the first 1000 results of a query.
+            If True, locations with more users than that are split into
+            several queries by account creation date, each of which is
+            under the limit, and their pages are fetched concurrently.
+
+        Returns:
+          users: generator of JSON objects with data for users who matched
+          the location.  Note that this does NOT contain all the user
+          information available with a direct user lookup.
+        """
+        if not sharded:
+            for page in self._iter_user_search_pages(location):
+                for user in page["items"]:
+                    yield user
+
+            return
+
+        # Shards don't overlap, but results can shift between pages while
+        # they are being read.
+        seen_userids = set()
+        for page in self._iter_user_search_pages_sharded(location):
+            for user in page["items"]:
+                if user["login"] not in seen_userids:
+                    seen_userids.add(user["login"])
+                    yield user
+
+    def _iter_user_search_pages(self, location):
         response = self._gh_http_get("/search/users",
                                      params={
                                          "q": "location:{}".format(location),
                                          # use max page size to reduce API calls needed
-                                         "per_page": 100
+                                         "per_page": self.GH_SEARCH_PAGE_SIZE
                                      }
         )
 
-        def parse_users(response):
-            return response.json()["items"]
-
-        users = parse_users(response)
+        yield response.json()
 
         while True:
             try:
@@ -96,9 +284,77 @@ class GitHubSearcher(object):
                 break
 
             response = self._gh_http_get(next_url)
-            users.extend(parse_users(response))
+            yield response.json()
+
+    def _iter_user_search_pages_sharded(self, location):
+        remaining_pages = []
+
+        for query, first_page in self._split_user_search(location):
+            yield first_page
+
+            num_results = min(first_page["total_count"],
+                              self.GH_SEARCH_RESULT_LIMIT)
+            num_pages = int(math.ceil(
+                float(num_results) / self.GH_SEARCH_PAGE_SIZE))
+
+            remaining_pages.extend(
+                (query, page) for page in xrange(2, num_pages + 1))
+
+        for page in self._imap_concurrently(
+                lambda query_and_page: self._search_users_page(
+                    *query_and_page),
+                remaining_pages):
+            yield page
+
+    def _split_user_search(self, location, start=None, end=None):
+        """
+        Splits a location search into queries over disjoint account
+        creation date ranges, halving the ranges until each query has no
+        more results than the search API will return.
+
+        Returns:
+          shards: generator of (str, dict)
+            Each shard's query, along with the first page of its results
+            which had to be read to find out how many results it has.
+        """
+        query = "location:{}".format(location)
+        if start is not None:
+            query += " created:{}..{}".format(start.isoformat(),
+                                              end.isoformat())
+
+        first_page = self._search_users_page(query, 1)
+
+        if first_page["total_count"] <= self.GH_SEARCH_RESULT_LIMIT:
+            yield query, first_page
+            return
+
+        if start is None:
+            start = self.GH_LAUNCH_DATE
+            end = datetime.date.today()
+
+        if start >= end:
+            logger.warn("Query '%s' has %d results, only %d can be read" % (
+                query, first_page["total_count"],
+                self.GH_SEARCH_RESULT_LIMIT))
+            yield query, first_page
+            return
+
+        middle = start + (end - start) / 2
+
+        for shard in self._split_user_search(location, start, middle):
+            yield shard
 
-        return users
+        for shard in self._split_user_search(
+                location, middle + datetime.timedelta(days=1), end):
+            yield shard
+
+    def _search_users_page(self, query, page):
+        return self._gh_http_get("/search/users",
+                                 params={
+                                     "q": query,
+                                     "per_page": self.GH_SEARCH_PAGE_SIZE,
+                                     "page": page
+                                 }).json()
 
     def search_repos_by_user(self, userid):
         """
@@ -109,13 +365,40 @@ class GitHubSearcher(object):
             The user's login id.
 
         Returns:
-          repo_names: list(str)
-            A list of the repository names, not the full name.  That is, not
-            prepended with "userid/"
+          repos: list(dict)
+            Repository objects described at
+            http://developer.github.com/v3/repos/ including metadata such
+            as "name" (not prepended with "userid/"), "full_name", "fork",
+            "size", "pushed_at" and "language".
         """
-        response = self._gh_http_get("/users/{}/repos".format(userid))
+        url = "/users/{}/repos".format(userid)
+
+        response = self._gh_http_get(url, params={
+            "per_page": self.GH_REPOS_PAGE_SIZE
+        })
+        repos = response.json()
+
+        try:
+            last_url = response.links["last"]["url"]
+        except KeyError:
+            # Everything fit on the first page
+            return repos
 
-        return [repo["name"] for repo in response.json()]
+        query = urlparse.parse_qs(urlparse.urlparse(last_url).query)
+        num_pages = int(query["page"][0])
+
+        # The last page's number says how many pages there are, so they
+        # can all be requested at once instead of following each one's
+        # "next" link in turn.
+        for page in self._map_concurrently(
+                lambda page: self._gh_http_get(url, params={
+                    "per_page": self.GH_REPOS_PAGE_SIZE,
+                    "page": page
+                }).json(),
+                range(2, num_pages + 1)):
+            repos.extend(page)
+
+        return repos
 
     def get_repo_language_stats(self, owner, repo_name):
         """
@@ -154,7 +437,7 @@ class GitHubSearcher(object):
         user_stats = collections.defaultdict(int)
 
         for repo in self.search_repos_by_user(userid):
-            repo_stats = self.get_repo_language_stats(userid, repo)
+            repo_stats = self.get_repo_language_stats(userid, repo["name"])
 
             for language, size in repo_stats.iteritems():
                 user_stats[language] += size
@@ -194,12 +477,80 @@ class GitHubSearcher(object):
     def rate_limit(self):
         """
         Convenience method for checking the rate limit.  Normally the
-        application will use exceptions when the rate limit is reached in
-        order to handle back-off.
+        application relies on the rate limit budgets of its credentials,
+        which are kept up to date from the headers of every response.
         http://developer.github.com/v3/rate_limit/
         """
         return self._gh_http_get("/rate_limit").json()
 
+    def connection_stats(self):
+        """
+        Reports how well HTTP connections are being reused.
+
+        Returns:
+          stats: dict
+            "requests" is the number of HTTP requests sent, "connections"
+            is the number of new connections that had to be opened, and
+            "reused" is the number of requests sent on a connection that
+            was already open.
+        """
+        num_requests = 0
+        num_connections = 0
+
+        if not isinstance(self._adapter, HTTPAdapter):
+            # Replayed requests don't use connections.
+            return {"requests": 0, "connections": 0, "reused": 0}
+
+        pools = self._adapter.poolmanager.pools
+        for key in pools.keys():
+            try:
+                pool = pools[key]
+            except KeyError:
+                # Evicted by another thread since keys() was called
+                continue
+
+            num_requests += pool.num_requests
+            num_connections += pool.num_connections
+
+        return {
+            "requests": num_requests,
+            "connections": num_connections,
+            "reused": max(num_requests - num_connections, 0)
+        }
+
+    def _map_concurrently(self, function, items):
+        """
+        Applies a function to each item using the searcher's thread pool,
+        so that the requests it makes overlap.  The function must not use
+        _map_concurrently itself, or it could end up waiting on the
+        threads that are busy running it.
+
+        Returns:
+          results: list
+            The results in the same order as the items.
+        """
+        if len(items) <= 1:
+            return map(function, items)
+
+        return self._get_thread_pool().map(function, items)
+
+    def _imap_concurrently(self, function, items):
+        """
+        Like _map_concurrently, but returns an iterator over the results in
+        the order they finish.
+        """
+        if len(items) <= 1:
+            return iter(map(function, items))
+
+        return self._get_thread_pool().imap_unordered(function, items)
+
+    def _get_thread_pool(self):
+        with self._thread_pool_lock:
+            if self._thread_pool is None:
+                self._thread_pool = ThreadPool(self.pool_size)
+
+            return self._thread_pool
+
     def _gh_http_get(self, url, params=None, headers=None):
         """
         Performs an HTTP request for the specified GitHub API endpoint.
@@ -215,23 +566,97 @@ class GitHubSearcher(object):
 
         Returns:
           A requests response object.
+
+        Raises:
+          RateLimitException if the rate limit has been used up, or
+          GitHubApiException if the API returned any other error.
         """
-        if not url.startswith(self.GH_API_URL_BASE):
-            url = self.GH_API_URL_BASE + url
+        if not url.startswith(self.api_url):
+            url = self.api_url + url
 
         parsed_url = urlparse.urlparse(url)
 
+        headers = dict(headers) if headers is not None else {}
+
         if parsed_url.path.startswith("/search"):
-            if headers is None:
-                headers = {}
             headers.update(self.GH_SEARCH_HEADERS)
 
-        response = requests.get(url,
-                                params=params,
-                                headers=self.GH_SEARCH_HEADERS,
-                                auth=(auth.GH_AUTH_USERNAME, auth.GH_AUTH_TOKEN))
+        if self.cache is not None:
+            # The full URL, including the query string, identifies the
+            # cached response.
+            url = requests.Request("GET", url, params=params).prepare().url
+            params = None
+
+            headers.update(self.cache.get_validators(url))
+
+        response = self._send(url, params, headers)
+
+        if response.status_code == 304:
+            # Not modified responses don't use up any of the rate limit.
+            cached_response = self.cache.get_response(url)
 
-        if response.headers["X-RateLimit-Remaining"] == "0":
-            raise RateLimitException(int(response.headers["X-RateLimit-Reset"]))
+            if cached_response is not None:
+                return cached_response
+
+            # The entry was evicted while the request was in flight, so
+            # ask again without the validators.
+            for header in ("If-None-Match", "If-Modified-Since"):
+                headers.pop(header, None)
+
+            response = self._send(url, params, headers)
+
+        if self.cache is not None:
+            self.cache.store(url, response)
+
+        if response.status_code >= 400:
+            raise GitHubApiException(response.status_code, url)
 
         return response
+
+    def _send(self, url, params, headers):
+        path = urlparse.urlparse(url).path
+        if path.startswith("/search"):
+            bucket = SEARCH_BUCKET
+        else:
+            bucket = CORE_BUCKET
+
+        endpoint = endpoint_name(path)
+
+        while True:
+            wait_start_time = time.time()
+            credential = self.credentials.acquire(bucket)
+            start_time = time.time()
+
+            self._rate_limit_wait_seconds.inc(start_time - wait_start_time,
+                                              bucket=bucket)
+
+            try:
+                response = self._session.get(url,
+                                             params=params,
+                                             headers=headers,
+                                             auth=credential)
+            except Exception:
+                self.credentials.release(credential, bucket)
+                self._requests.inc(endpoint=endpoint, status="error")
+                raise
+
+            latency = time.time() - start_time
+            self.latency.record(latency)
+            self._request_seconds.observe(latency, endpoint=endpoint)
+            self._requests.inc(endpoint=endpoint,
+                               status=response.status_code)
+
+            self.credentials.update(credential, bucket, response.headers)
+
+            if not (response.status_code == 403 and
+                    response.headers.get("X-RateLimit-Remaining") == "0"):
+                return response
+
+            if not self.credentials.has_budget(bucket):
+                raise RateLimitException(
+                    int(response.headers["X-RateLimit-Reset"]))
+
+            # Other credentials still have budget, so fail over to them
+            # instead of waiting.
+            logger.info("Rate limit exceeded for %s, switching credentials"
+                        % credential[0])
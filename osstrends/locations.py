@@ -32,11 +32,15 @@ def path(filename):
 
 
 class Location(object):
-    def __init__(self, normalized, stopwords, search_term):
+    def __init__(self, normalized, stopwords, search_term, priority=1.0):
         self.normalized = normalized
         self.stopwords = stopwords
         self.search_term = search_term
 
+        # How important keeping the location's data fresh is, relative to
+        # other locations.
+        self.priority = priority
+
     def __repr__(self):
         return self.normalized
 
@@ -51,7 +55,8 @@ def load_locations(filename="locations.json"):
                     Location(
                         json_object["normalized"],
                         json_object["stopwords"],
-                        json_object["search_term"]
+                        json_object["search_term"],
+                        json_object.get("priority", 1.0)
                     )
                 )
 
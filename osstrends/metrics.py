@@ -0,0 +1,414 @@
+# Copyright (C) 2014 David Rusk
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+__author__ = "David Rusk <drusk@uvic.ca>"
+
+import BaseHTTPServer
+import bisect
+import os
+import threading
+import time
+
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+
+# Upper bounds in seconds, suited to API requests and database writes.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60)
+
+
+def _label_key(labels):
+    return tuple(sorted((name, str(value))
+                        for name, value in labels.iteritems()))
+
+
+def _format_labels(label_key):
+    if not label_key:
+        return ""
+
+    return "{%s}" % ",".join(
+        '%s="%s"' % (name, value.replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in label_key)
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+
+    return repr(float(value))
+
+
+class _Timer(object):
+    """
+    Observes how long its block takes in a histogram.
+    """
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start_time = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.time() - self.start_time, **self.labels)
+
+
+class Counter(object):
+    """
+    A total which only goes up, e.g. the number of requests sent.  Each
+    combination of label values is counted separately.
+    """
+
+    type = COUNTER
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(_label_key(labels), 0)
+
+    def total(self):
+        """
+        Returns the sum over all label values.
+        """
+        with self._lock:
+            return sum(self._values.itervalues())
+
+    def samples(self):
+        """
+        Returns:
+          samples: list((str, tuple, float))
+            The name, labels and value of each line of the family's text
+            exposition.
+        """
+        with self._lock:
+            return [(self.name, key, value)
+                    for key, value in sorted(self._values.iteritems())]
+
+
+class Gauge(Counter):
+    """
+    A value which can go up and down, e.g. the depth of the work queue.
+    """
+
+    type = GAUGE
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[_label_key(labels)] = value
+
+
+class Histogram(object):
+    """
+    Counts observations, e.g. of request latency, in buckets so that their
+    distribution can be estimated.  Each combination of label values has
+    its own buckets.
+    """
+
+    type = HISTOGRAM
+
+    def __init__(self, name, description, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+        # Keyed by labels, values are [bucket counts, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = [[0] * len(self.buckets), 0.0]
+
+            counts, _ = self._values[key]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key][1] += value
+
+    def time(self, **labels):
+        """
+        Returns a context manager which observes how long its block takes.
+        """
+        return _Timer(self, labels)
+
+    def count(self, **labels):
+        with self._lock:
+            if _label_key(labels) not in self._values:
+                return 0
+
+            return sum(self._values[_label_key(labels)][0])
+
+    def sum(self, **labels):
+        with self._lock:
+            if _label_key(labels) not in self._values:
+                return 0.0
+
+            return self._values[_label_key(labels)][1]
+
+    def label_keys(self):
+        with self._lock:
+            return sorted(self._values)
+
+    def quantile(self, q, **labels):
+        """
+        Estimates a quantile of the observations by interpolating within
+        the bucket it falls in, as Prometheus' histogram_quantile does.
+
+        Args:
+          q: float
+            Between 0 and 1, e.g. 0.95 for the 95th percentile.
+
+        Returns:
+          value: float
+            None if nothing has been observed.  If the quantile falls in
+            the last bucket, the largest finite bucket bound.
+        """
+        with self._lock:
+            if _label_key(labels) not in self._values:
+                return None
+
+            counts = list(self._values[_label_key(labels)][0])
+
+        total = sum(counts)
+        if total == 0:
+            return None
+
+        rank = q * total
+        cumulative = 0
+        for index, count in enumerate(counts):
+            if cumulative + count >= rank and count > 0:
+                upper = self.buckets[index]
+                if upper == float("inf"):
+                    return self.buckets[-2]
+
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                return lower + (upper - lower) * (rank - cumulative) / count
+
+            cumulative += count
+
+        return self.buckets[-2]
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.iteritems())
+
+        samples = []
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append((self.name + "_bucket",
+                                key + (("le", _format_value(bound)),),
+                                cumulative))
+
+            samples.append((self.name + "_sum", key, total))
+            samples.append((self.name + "_count", key, cumulative))
+
+        return samples
+
+
+class MetricsRegistry(object):
+    """
+    Holds the metrics of a crawl so they can be exported in Prometheus'
+    text format, either written to a file for node_exporter's textfile
+    collector or served over HTTP (see MetricsServer), and summarized in
+    the log at the end of a run.
+
+    Metrics are declared by whichever components record them.  Declaring
+    a metric which already exists returns the existing one, so components
+    sharing a registry can declare the same metrics.
+    """
+
+    def __init__(self, labels=None):
+        """
+        Constructor.
+
+        Args:
+          labels: dict
+            Added to every sample when exported, e.g. to tell apart the
+            metrics of worker processes on the same host.
+        """
+        self.labels = labels or {}
+        self.start_time = time.time()
+
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name, description):
+        return self._declare(Counter, name, description)
+
+    def gauge(self, name, description):
+        return self._declare(Gauge, name, description)
+
+    def histogram(self, name, description, buckets=DEFAULT_BUCKETS):
+        return self._declare(Histogram, name, description, buckets)
+
+    def get(self, name):
+        """
+        Returns the metric with the given name, or None if it hasn't been
+        declared.
+        """
+        with self._lock:
+            return self._metrics.get(name)
+
+    def _declare(self, metric_class, name, description, *args):
+        with self._lock:
+            metric = self._metrics.get(name)
+
+            if metric is None:
+                metric = metric_class(name, description, *args)
+                self._metrics[name] = metric
+            elif not isinstance(metric, metric_class):
+                raise ValueError("{} is already declared as a {}".format(
+                    name, metric.type))
+
+            return metric
+
+    def _sorted_metrics(self):
+        with self._lock:
+            return [self._metrics[name] for name in sorted(self._metrics)]
+
+    def render(self):
+        """
+        Returns the metrics in Prometheus' text exposition format.
+        """
+        constant_labels = _label_key(self.labels)
+
+        lines = []
+        for metric in self._sorted_metrics():
+            lines.append("# HELP {} {}".format(metric.name,
+                                               metric.description))
+            lines.append("# TYPE {} {}".format(metric.name, metric.type))
+
+            for name, key, value in metric.samples():
+                lines.append("{}{} {}".format(
+                    name, _format_labels(constant_labels + key),
+                    _format_value(value)))
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, filename):
+        """
+        Writes the metrics to a file.  The file is replaced in one step so
+        that a collector never reads it half written.
+        """
+        temp_filename = filename + ".tmp"
+        with open(temp_filename, "wb") as filehandle:
+            filehandle.write(self.render())
+
+        os.rename(temp_filename, filename)
+
+    def summary(self):
+        """
+        Summarizes the metrics for the log at the end of a run: the total
+        and rate per minute of each counter, the current value of each
+        gauge, and the count, mean and estimated 50th and 95th percentiles
+        of each histogram.
+
+        Returns:
+          lines: list(str)
+        """
+        elapsed_minutes = max(time.time() - self.start_time, 1) / 60.0
+
+        lines = []
+        for metric in self._sorted_metrics():
+            if metric.type == HISTOGRAM:
+                for key in metric.label_keys():
+                    labels = dict(key)
+                    count = metric.count(**labels)
+                    lines.append(
+                        "{}{}: count {}, mean {:.3f}, p50 {:.3f}, "
+                        "p95 {:.3f}".format(
+                            metric.name, _format_labels(key), count,
+                            metric.sum(**labels) / count,
+                            metric.quantile(0.5, **labels),
+                            metric.quantile(0.95, **labels)))
+            else:
+                for name, key, value in metric.samples():
+                    line = "{}{}: {:g}".format(name, _format_labels(key),
+                                               value)
+                    if metric.type == COUNTER:
+                        line += " ({:.1f}/min)".format(
+                            value / elapsed_minutes)
+
+                    lines.append(line)
+
+        return lines
+
+
+class _MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        body = self.server.registry.render()
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes would otherwise be written to stderr.
+        pass
+
+
+class MetricsServer(object):
+    """
+    Serves a registry's metrics at http://host:port/metrics for Prometheus
+    to scrape, from a background thread.
+    """
+
+    def __init__(self, registry, port, host="127.0.0.1"):
+        self._server = BaseHTTPServer.HTTPServer((host, port),
+                                                 _MetricsRequestHandler)
+        self._server.registry = registry
+
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -20,24 +20,195 @@
 
 __author__ = "David Rusk <drusk@uvic.ca>"
 
+import collections
 import logging
 import Queue
+import random
 import threading
 import time
 
+import requests
+from pymongo.errors import AutoReconnect
+
+from osstrends.cache import RepoLanguageCache, ResponseCache
+from osstrends.concurrency import ConcurrencyController, ConcurrencyLimit
 from osstrends.database import MongoDatabase
-from osstrends.github import GitHubSearcher, RateLimitException
+from osstrends.dedup import SeenSet
+from osstrends.github import (GitHubApiException, GitHubSearcher,
+                              RateLimitException)
 from osstrends.locations import load_locations
+from osstrends.metrics import MetricsRegistry, MetricsServer
+from osstrends.ratelimit import CORE_BUCKET
+from osstrends.recording import TrafficRecorder, TrafficReplay
+from osstrends.scheduler import PriorityWorkQueue, StalenessPriority
+from osstrends.workqueue import MongoWorkQueue, RetryTimer
+from osstrends.writebuffer import UserWriteBuffer
 
 logger = logging.getLogger(__name__)
 
+# Each location is searched as one task, and each user is processed in
+# stages so that the requests for a single user can be spread across the
+# worker threads.
+LOCATION_STAGE = "location"
+USER_STAGE = "user"
+USER_LOCATION_STAGE = "user_location"
+REPOS_STAGE = "repos"
+REPO_LANGUAGES_STAGE = "repo_languages"
+
+# The fields of users' details which are needed to show them in the web
+# application and to refresh them, for saving only part of the details.
+DEFAULT_USER_FIELDS = ["login", "name", "company", "location", "html_url",
+                       "updated_at"]
+
+# The fields the pipeline itself reads back, which are always saved.
+REQUIRED_USER_FIELDS = ["login", "location", "updated_at"]
+
+
+class Task(object):
+    """
+    A unit of work for the pipeline's worker threads: searching a location
+    or one stage of processing a user.
+    """
+
+    def __init__(self, stage, userid, *args):
+        """
+        Constructor.
+
+        Args:
+          stage: str
+            Which stage of processing the task performs.
+          userid: str
+            The login id of the user being processed, or None for a
+            location search.
+          args:
+            Passed to the stage's processing method.
+        """
+        self.stage = stage
+        self.userid = userid
+        self.args = args
+
+        # The number of times the task has failed.
+        self.attempts = 0
+
+        # If set, the task isn't to be tried again before this time.
+        self.not_before = None
+
+    def __repr__(self):
+        if self.userid is None:
+            return "{} task for {}".format(self.stage, self.args[0])
+
+        return "{} task for {}".format(self.stage, self.userid)
+
+
+class LanguageAggregator(object):
+    """
+    Sums up each user's language statistics as the tasks for their
+    repositories finish.
+    """
+
+    def __init__(self):
+        # Keyed by userid.
+        self._pending_repos = {}
+        self._language_stats = {}
+        self._lock = threading.Lock()
+
+    def start(self, userid, repo_names):
+        """
+        Starts waiting for the statistics of a user's repositories.
+
+        Args:
+          userid: str
+          repo_names: list(str)
+
+        Returns: bool
+          True if the aggregation was started, False if the user's
+          statistics were already being waited on.
+        """
+        with self._lock:
+            if userid in self._pending_repos:
+                return False
+
+            self._pending_repos[userid] = set(repo_names)
+            self._language_stats[userid] = collections.defaultdict(int)
+
+            return True
+
+    def pending(self, userid):
+        """
+        Returns the names of the user's repositories still being waited
+        on.
+        """
+        with self._lock:
+            return set(self._pending_repos.get(userid, ()))
+
+    def add(self, userid, repo_name, repo_stats):
+        """
+        Adds the statistics for one of the user's repositories.
+
+        Returns:
+          language_stats: dict
+            The user's total statistics if this was the last repository
+            being waited on, otherwise None.
+        """
+        with self._lock:
+            pending_repos = self._pending_repos[userid]
+            if repo_name not in pending_repos:
+                return None
+
+            pending_repos.remove(repo_name)
+
+            language_stats = self._language_stats[userid]
+            for language, size in repo_stats.iteritems():
+                language_stats[language] += size
+
+            if pending_repos:
+                return None
+
+            del self._pending_repos[userid]
+            del self._language_stats[userid]
+
+            return dict(language_stats)
+
+
+class DurableLanguageAggregator(object):
+    """
+    Sums up each user's language statistics in the database, so that the
+    repositories already counted aren't lost if the crawl is interrupted.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def start(self, userid, repo_names):
+        return self.db.start_language_aggregation(userid, repo_names)
+
+    def pending(self, userid):
+        return set(self.db.get_pending_repos(userid))
+
+    def add(self, userid, repo_name, repo_stats):
+        return self.db.add_repo_language_stats(userid, repo_name, repo_stats)
+
 
 class DataPipeline(object):
     """
     The main pipeline for acquiring the application's data.
     """
 
-    def __init__(self, db, searcher, locations, num_threads=10):
+    DEFAULT_NUM_THREADS = 10
+    DEFAULT_MAX_THREADS = ConcurrencyController.DEFAULT_MAX_CONCURRENCY
+    DEFAULT_AUTOSCALE_INTERVAL = 10
+    DEFAULT_METRICS_INTERVAL = 15
+
+    FINISHED_CHECKPOINT = "finished"
+
+    def __init__(self, db, searcher, locations,
+                 num_threads=DEFAULT_NUM_THREADS, language_cache=None,
+                 fork_weight=1.0, resolve_fork_sources=False, durable=False,
+                 autoscale=False, max_threads=DEFAULT_MAX_THREADS,
+                 autoscale_interval=DEFAULT_AUTOSCALE_INTERVAL,
+                 seen_users=None, incremental=False, prioritize=False,
+                 write_behind=False, metrics=None, metrics_filename=None,
+                 metrics_interval=DEFAULT_METRICS_INTERVAL, user_fields=None):
         """
         Constructor.
 
@@ -47,19 +218,190 @@ class DataPipeline(object):
             data.
           locations: list(str)
             The locations to be included in the data retrieval.
+          num_threads: int
+            The number of worker threads making requests through the
+            searcher.  If autoscaling, this is only the starting number.
+            The locations are searched by the worker threads too, and the
+            users found are queued as soon as they are found.
+          language_cache: osstrends.cache.RepoLanguageCache
+            If provided, repositories' language statistics are looked up
+            here first, and forks which haven't been pushed to share the
+            statistics of the repository they were forked from, if the
+            cache knows which one that is.
+          fork_weight: float
+            How much a forked repository's code counts towards its owner's
+            language statistics.  1.0 counts it fully, and 0 leaves forks
+            out completely (without looking up their languages at all).
+          resolve_fork_sources: bool
+            If True, the repository a fork which hasn't been pushed to was
+            created from is looked up when the language cache doesn't
+            know it.  The lookup costs as much as looking up the fork's
+            languages, so this only saves requests when many forks share
+            sources and the cache is kept between runs.
+          durable: bool
+            If True, the work queue and partial results are kept in the
+            database so that an interrupted run can be resumed.
+          autoscale: bool
+            If True, the number of active worker threads is adjusted while
+            the pipeline runs, based on how long requests are taking, how
+            much work is waiting and how much of the rate limit is left.
+            See osstrends.concurrency.ConcurrencyController.
+          max_threads: int
+            The most worker threads autoscaling may use.  The searcher's
+            connection pool should be at least this big.
+          autoscale_interval: float
+            Seconds between adjustments of the number of worker threads.
+          seen_users: osstrends.dedup.SeenSet
+            Remembers which users have been queued during the run, so
+            that each is only fetched once even if they are found several
+            times or in several locations.  Defaults to an empty SeenSet.
+            A osstrends.dedup.BloomFilter uses much less memory for very
+            large runs, but occasionally skips a user.
+          incremental: bool
+            If True, the data saved by previous runs is refreshed rather
+            than retrieved again.  Repositories which haven't been pushed
+            to since their language statistics were saved reuse those
+            statistics, and users whose details haven't been updated
+            aren't rewritten.  Repositories' statistics are only saved
+            for reuse by incremental runs, so the first one looks them
+            all up.
+          prioritize: bool
+            If True, tasks are done in order of how likely the users' saved
+            data is to be out of date (see
+            osstrends.scheduler.StalenessPriority) instead of the order
+            the users were found in.
+          write_behind: bool
+            If True, users are saved to the database in bulk from a
+            background thread instead of by the worker threads (see
+            osstrends.writebuffer.UserWriteBuffer).  This is faster, but if
+            the process dies the last few seconds of writes are lost, even
+            though a durable pipeline's jobs for them are done.
+          metrics: osstrends.metrics.MetricsRegistry
+            Where the number, outcome and duration of tasks, the users
+            finished and the work queue's depth are recorded.  Should be
+            shared with the searcher and database so that all of the run's
+            metrics are exported together.  Defaults to a registry of the
+            pipeline's own.
+          metrics_filename: str
+            If provided, the metrics are written to this file in
+            Prometheus' text format while the pipeline runs, e.g. for
+            node_exporter's textfile collector.
+          metrics_interval: float
+            Seconds between samples of the work queue's depth, and between
+            writes of the metrics file.
+          user_fields: list(str)
+            If provided, only these fields of the users' details retrieved
+            from GitHub are saved, along with REQUIRED_USER_FIELDS, e.g.
+            DEFAULT_USER_FIELDS.  The rest, such as the many API URLs, are
+            left out to save space.  Otherwise all of them are saved.
         """
         self.db = db
         self.searcher = searcher
         self.locations = locations
 
-        self._work_queue = Queue.Queue()
+        self.durable = durable
+        self.incremental = incremental
+
+        self.user_fields = None
+        if user_fields is not None:
+            self.user_fields = set(user_fields) | set(REQUIRED_USER_FIELDS)
+
+        # Where users are read from and written to.
+        self._write_buffer = None
+        self._users = db
+        if write_behind:
+            self._write_buffer = UserWriteBuffer(db)
+            self._users = self._write_buffer
+
+        if seen_users is None:
+            seen_users = SeenSet()
+        self._seen_users = seen_users
+
+        self._staleness = None
+        priority_function = None
+        if prioritize:
+            self._staleness = StalenessPriority(locations)
+            priority_function = self._task_priority
+
+        if durable:
+            self._work_queue = MongoWorkQueue(
+                db, self._task_to_document, self._document_to_task,
+                priority_function=priority_function)
+            self._aggregator = DurableLanguageAggregator(db)
+        elif prioritize:
+            self._work_queue = PriorityWorkQueue(priority_function)
+            self._aggregator = LanguageAggregator()
+        else:
+            self._work_queue = Queue.Queue()
+            self._aggregator = LanguageAggregator()
+
+        # The durable queue holds back tasks waiting to be retried itself.
+        self._retry_timer = None
+        if not durable:
+            self._retry_timer = RetryTimer(self._work_queue)
+
         self._workers = []
 
+        self._stages = {
+            LOCATION_STAGE: self.process_location,
+            USER_STAGE: self.process_user,
+            USER_LOCATION_STAGE: self.process_user_location,
+            REPOS_STAGE: self.process_repos,
+            REPO_LANGUAGES_STAGE: self.process_repo_languages
+        }
+
         self.num_threads = num_threads
+        self.language_cache = language_cache
+        self.fork_weight = fork_weight
+        self.resolve_fork_sources = resolve_fork_sources
+
+        self.autoscale = autoscale
+        self.autoscale_interval = autoscale_interval
+
+        if metrics is None:
+            metrics = MetricsRegistry()
+        self.metrics = metrics
+        self.metrics_filename = metrics_filename
+        self.metrics_interval = metrics_interval
+
+        self._users_finished = metrics.counter(
+            "pipeline_users_total",
+            "Users whose language statistics have been saved.")
+        self._queue_depth = metrics.gauge(
+            "pipeline_queue_depth", "Tasks waiting in the work queue.")
+        self._worker_threads = metrics.gauge(
+            "pipeline_worker_threads",
+            "Worker threads allowed to run at once.")
+
+        if autoscale:
+            self._controller = ConcurrencyController(
+                num_threads, max_concurrency=max_threads)
+            self._concurrency_limit = ConcurrencyLimit(
+                self._controller.concurrency)
+        else:
+            self._controller = None
+            self._concurrency_limit = None
 
     def _initialize_workers(self):
-        for _ in xrange(self.num_threads):
-            worker = WorkerThread(self._work_queue, self.process_user)
+        if self._controller is None:
+            self._add_workers(self.num_threads)
+            return
+
+        logger.info("Starting with {} worker threads, autoscaling up to "
+                    "{}".format(self._controller.concurrency,
+                                self._controller.max_concurrency))
+        self._add_workers(self._controller.concurrency)
+
+        autoscaler = threading.Thread(target=self._autoscale)
+        autoscaler.daemon = True
+        autoscaler.start()
+
+    def _add_workers(self, num_workers):
+        for _ in xrange(num_workers):
+            worker = WorkerThread(self._work_queue, self.run_task,
+                                  self._concurrency_limit, self.dead_letter,
+                                  metrics=self.metrics,
+                                  retry_timer=self._retry_timer)
 
             # Kill threads once the rest of the program has finished.
             worker.daemon = True
@@ -67,16 +409,267 @@ class DataPipeline(object):
             self._workers.append(worker)
             worker.start()
 
-    def execute(self):
+    def _autoscale(self):
+        while True:
+            time.sleep(self.autoscale_interval)
+
+            try:
+                self.adjust_concurrency()
+            except Exception as error:
+                logger.error("Failed to adjust concurrency: {}".format(
+                    error))
+
+    def adjust_concurrency(self):
+        """
+        Resizes the pool of active worker threads based on the searcher's
+        recent latency, the work queue's depth and the remaining rate
+        limit budget.
+
+        Returns:
+          concurrency: int
+            The number of worker threads now allowed to run at once.
+        """
+        concurrency = self._controller.adjust(
+            self.searcher.latency.value(),
+            self._work_queue.qsize(),
+            self.searcher.credentials.request_rate(CORE_BUCKET))
+
+        self._concurrency_limit.resize(concurrency)
+
+        # Threads are never stopped, only held back by the limit, so they
+        # are only started when the limit goes past all previous ones.
+        if concurrency > len(self._workers):
+            self._add_workers(concurrency - len(self._workers))
+
+        return concurrency
+
+    def _start_metrics_reporter(self):
+        reporter = threading.Thread(target=self._report_metrics_periodically)
+        reporter.daemon = True
+        reporter.start()
+
+    def _report_metrics_periodically(self):
+        while True:
+            time.sleep(self.metrics_interval)
+
+            try:
+                self.report_metrics()
+            except Exception as error:
+                logger.error("Failed to report metrics: {}".format(error))
+
+    def report_metrics(self):
+        """
+        Samples the work queue's depth and the number of worker threads,
+        and writes the metrics file if there is one.
+        """
+        self._queue_depth.set(self._work_queue.qsize())
+
+        if self._concurrency_limit is not None:
+            self._worker_threads.set(self._concurrency_limit.limit)
+        else:
+            self._worker_threads.set(len(self._workers))
+
+        if self.metrics_filename is not None:
+            self.metrics.write(self.metrics_filename)
+
+    def _finish_run(self):
+        """
+        Saves any buffered writes, then reports the run's final metrics.
+        """
+        try:
+            self._close_write_buffer()
+        finally:
+            self.report_metrics()
+
+            logger.info("Connection stats: {}".format(
+                self.searcher.connection_stats()))
+
+            logger.info("Metrics summary:")
+            for line in self.metrics.summary():
+                logger.info("  {}".format(line))
+
+    def prepare_database(self):
+        """
+        Brings data saved by older versions up to date and creates any
+        missing indexes before a crawl starts.
+        """
+        self.db.convert_user_locations_to_lists()
+        self.db.convert_language_stats_to_lists()
+
+        num_removed = self.db.remove_duplicate_users()
+        if num_removed:
+            logger.info("Removed {} duplicate users".format(num_removed))
+
+        self.db.ensure_indexes()
+        self.check_location_stats()
+
+    def check_location_stats(self):
+        """
+        Rebuilds the locations' saved language statistics if they no
+        longer match the users', e.g. because a previous run crashed
+        between saving a user and updating their locations.
+        """
+        mismatched = self.db.verify_location_stats()
+
+        if mismatched:
+            logger.warn("Rebuilding location statistics, {} locations were "
+                        "out of date".format(len(mismatched)))
+            self.db.rebuild_location_stats()
+
+    def execute(self, resume=False, replay_dead_letters=False):
         """
         Runs the pipeline.
+
+        Args:
+          resume: bool
+            If True, a durable pipeline continues from where the last run
+            stopped instead of starting over.  Locations which were
+            completely searched are not searched again, and the jobs left
+            in the queue are finished.
+          replay_dead_letters: bool
+            If True, the tasks previously given up on are tried again.
+        """
+        locations = self.locations
+
+        self.prepare_database()
+
+        if self.durable:
+            if resume:
+                # The workers holding leases from the last run are gone.
+                self.db.release_leased_jobs()
+
+                locations = [location for location in locations
+                             if not self.db.get_checkpoint(
+                                 self._search_checkpoint(location))]
+
+                logger.info("Resuming, {} locations left to search".format(
+                    len(locations)))
+            else:
+                self.db.reset_crawl_state()
+
+        # Loaded first, since replayed tasks are prioritized too.
+        self._load_refresh_info()
+
+        if replay_dead_letters:
+            self.replay_dead_letters()
+
+        self._initialize_workers()
+        self._start_metrics_reporter()
+
+        try:
+            # Searches are tasks like any other, so that one which fails is
+            # retried or given up on rather than ending the run.
+            for location in locations:
+                self.queue_task(Task(LOCATION_STAGE, None, location))
+
+            self._work_queue.join()
+        finally:
+            self._finish_run()
+
+    def coordinate(self, resume=False, poll_interval=30,
+                   replay_dead_letters=False):
+        """
+        Runs a crawl whose work is done by worker processes, possibly on
+        other hosts, which share this pipeline's database (see work).  The
+        coordinator queues a search job for each location, so locations
+        are divided between the workers as they become free, then waits
+        for all of the crawl's jobs to be done while returning the jobs of
+        workers which have died to the queue.
+
+        Args:
+          resume: bool
+            If True, continue the last crawl instead of starting over.
+          poll_interval: float
+            Seconds between checks on the crawl's progress.
+          replay_dead_letters: bool
+            If True, the tasks previously given up on are tried again.
+        """
+        if not self.durable:
+            raise ValueError("Only a durable pipeline can be distributed.")
+
+        locations = self.locations
+
+        self.prepare_database()
+
+        if resume:
+            locations = [location for location in locations
+                         if not self.db.get_checkpoint(
+                             self._search_checkpoint(location))]
+        else:
+            self.db.reset_crawl_state()
+
+        self.db.set_checkpoint(self.FINISHED_CHECKPOINT, False)
+
+        for location in locations:
+            self.queue_task(Task(LOCATION_STAGE, None, location))
+
+        if replay_dead_letters:
+            self._load_refresh_info()
+            self.replay_dead_letters()
+
+        while True:
+            num_reclaimed = self.db.reclaim_expired_jobs()
+            if num_reclaimed > 0:
+                logger.warn("Reclaimed {} jobs with expired leases".format(
+                    num_reclaimed))
+
+            num_jobs = self.db.count_jobs([self.db.JOB_PENDING,
+                                           self.db.JOB_LEASED])
+            if num_jobs == 0:
+                break
+
+            num_workers = len(self.db.get_active_workers(
+                MongoWorkQueue.DEFAULT_LEASE_SECONDS))
+            logger.info("{} jobs left, {} workers active".format(
+                num_jobs, num_workers))
+
+            time.sleep(poll_interval)
+
+        self.db.set_checkpoint(self.FINISHED_CHECKPOINT, True)
+        logger.info("Crawl finished")
+
+    def work(self, poll_interval=30):
+        """
+        Processes jobs from the database's shared queue until the
+        coordinator reports that the crawl is finished.  Any number of
+        processes can do this at once.  The coordinator should be started
+        first, since it marks the previous crawl's queue as unfinished.
+
+        Args:
+          poll_interval: float
+            Seconds between checks on whether the crawl is finished.
         """
+        if not self.durable:
+            raise ValueError("Only a durable pipeline can be distributed.")
+
+        self._load_refresh_info()
         self._initialize_workers()
+        self._start_metrics_reporter()
 
-        for location in self.locations:
-            self.process_location(location)
+        try:
+            while not self.db.get_checkpoint(self.FINISHED_CHECKPOINT):
+                time.sleep(poll_interval)
+        finally:
+            self._finish_run()
+
+    def _close_write_buffer(self):
+        if self._write_buffer is not None:
+            self._write_buffer.close()
+
+    def _load_refresh_info(self):
+        if self._staleness is not None:
+            self._staleness.load(self.db.get_user_refresh_info())
+
+    def _task_priority(self, task):
+        if task.stage == LOCATION_STAGE:
+            # The searches find the users to be prioritized.
+            return float("inf")
+
+        location = None
+        if task.stage in (USER_STAGE, USER_LOCATION_STAGE):
+            location = task.args[-1]
 
-        self._work_queue.join()
+        return self._staleness.score(task.userid, location)
 
     def process_location(self, location):
         """
@@ -87,28 +680,113 @@ class DataPipeline(object):
         """
         logger.info("Starting to process location: {}".format(location))
 
-        users = self.searcher.search_users_by_location(location.search_term)
+        users = self.searcher.iter_users_by_location(location.search_term,
+                                                     sharded=True)
+
+        # Users are queued as each page of search results arrives so the
+        # workers can start on them while the search continues.
+        for user in users:
+            self.queue_user(user, location)
 
         logger.debug("Got users for location: {}".format(
             location.search_term))
 
-        for user in users:
-            self.queue_user(user, location)
+        if self.durable:
+            self.db.set_checkpoint(self._search_checkpoint(location), True)
+
+    def _search_checkpoint(self, location):
+        return "searched:{}".format(location.normalized)
 
     def queue_user(self, user, location):
-        self._work_queue.put((user, location))
+        """
+        Queues a user found by a location search, unless they have already
+        been queued during this run.  A user who was already queued for a
+        different location is not fetched again, just added to this
+        location.
+        """
+        userid = user["login"]
+
+        if not self._seen_users.add(u"{}:{}".format(userid,
+                                                    location.normalized)):
+            # Found again in the same location, e.g. by overlapping
+            # searches.
+            return
+
+        if self._seen_users.add(userid):
+            self.queue_task(Task(USER_STAGE, userid, user, location))
+        else:
+            self.queue_task(Task(USER_LOCATION_STAGE, userid, userid,
+                                 location))
+
+    def queue_task(self, task):
+        self._work_queue.put(task)
+
+    def run_task(self, task):
+        """
+        Performs a task taken from the work queue.
+        """
+        self._stages[task.stage](*task.args)
 
     def process_user(self, user, location):
         """
         The location-based search does not return very much information
         about the user.  This method gets the full details about the user
-        and saves them to the database.
+        and saves them to the database, then queues the lookup of their
+        repositories.
         """
         userid = user["login"]
 
         full_user_details = self.searcher.search_user(userid)
 
-        raw_location = full_user_details["location"]
+        if not self._in_location(full_user_details, location):
+            return
+
+        saved_user = None
+        if self.incremental:
+            saved_user = self._users.get_user(userid, fields=["updated_at"])
+
+        if (saved_user is not None and saved_user.get("updated_at") ==
+                full_user_details.get("updated_at")):
+            self._users.touch_user(userid, location.normalized)
+        else:
+            self._users.insert_user(self._slim_user(full_user_details),
+                                    location.normalized)
+
+        logger.debug("Retrieved user info for {}".format(userid))
+
+        # The user may have been fetched again from another location after
+        # not being saved yet, but their repositories are only needed once.
+        if self._seen_users.add(u"{}:{}".format(REPOS_STAGE, userid)):
+            self.queue_task(Task(REPOS_STAGE, userid, userid))
+
+    def process_user_location(self, userid, location):
+        """
+        Adds another location to a user who was already fetched during this
+        run, using the details saved in the database instead of fetching
+        them again.
+        """
+        user = self._users.get_user(userid, fields=["location"])
+
+        if user is None or "location" not in user:
+            # The user hasn't been saved yet, or didn't belong in the other
+            # locations they were found in.
+            self.process_user({"login": userid}, location)
+            return
+
+        if self._in_location(user, location):
+            self._users.add_user_location(userid, location.normalized)
+
+    def _slim_user(self, user):
+        if self.user_fields is None:
+            return user
+
+        return {field: value for field, value in user.iteritems()
+                if field in self.user_fields}
+
+    def _in_location(self, user, location):
+        # The location may have been removed since the search was done.
+        raw_location = user.get("location") or ""
+
         for stopword in location.stopwords:
             if stopword.lower() in raw_location.lower():
                 logger.info("Found stopword (%s) in location '%s'" % (
@@ -116,53 +794,427 @@ class DataPipeline(object):
 
                 # This is needed because searching for "Victoria" will return users from
                 # Victoria BC, but also from Victoria the Australian state.
-                return
-
-        self.db.insert_user(full_user_details, location.normalized)
+                return False
 
-        logger.debug("Retrieved user info for {}".format(userid))
+        return True
 
+    def process_repos(self, userid):
+        """
+        Looks up a user's repositories and queues a task to get the
+        language statistics of each one.
+        """
         logger.debug(
             "Starting collection of language stats for user: {}".format(
                 userid))
 
-        language_stats = self.searcher.get_user_language_stats(userid)
-        self.db.insert_user_language_stats(userid, language_stats)
+        repos = self.searcher.search_repos_by_user(userid)
+
+        if self.fork_weight == 0:
+            repos = [repo for repo in repos if not repo["fork"]]
+
+        saved_repo_stats = {}
+        if self.incremental:
+            saved_repo_stats = self.db.get_user_repo_stats(userid)
+
+            repo_names = set(repo["name"] for repo in repos)
+            removed_repo_names = [repo_name for repo_name in saved_repo_stats
+                                  if repo_name not in repo_names]
+            if removed_repo_names:
+                self.db.remove_user_repo_stats(userid, removed_repo_names)
+
+        if not repos:
+            self._save_language_stats(userid, {})
+            return
+
+        repo_names = [repo["name"] for repo in repos]
+        if not self._aggregator.start(userid, repo_names):
+            # e.g. a durable run stopped partway through queueing the
+            # tasks below.  Queueing the tasks of the repositories still
+            # being waited on again makes sure they all get done.
+            pending = self._aggregator.pending(userid)
+            logger.info("Already collecting language stats for user: {}, "
+                        "{} repositories left".format(userid, len(pending)))
+
+            for repo_name in pending.difference(repo_names):
+                # Deleted since the aggregation was started
+                self._add_repo_language_stats(userid, repo_name, {})
+
+            repos = [repo for repo in repos if repo["name"] in pending]
+
+        for repo in repos:
+            saved_stats = saved_repo_stats.get(repo["name"])
+
+            if (saved_stats is not None and
+                    saved_stats["pushed_at"] == repo.get("pushed_at")):
+                # Nothing has been pushed since the statistics were saved.
+                self._add_repo_language_stats(
+                    userid, repo["name"],
+                    saved_stats[MongoDatabase.LANGUAGES_KEY])
+            else:
+                self.queue_task(Task(REPO_LANGUAGES_STAGE, userid, userid,
+                                     repo))
+
+    def process_repo_languages(self, userid, repo):
+        """
+        Gets the language statistics for one of a user's repositories.
+        Once all of the user's repositories are done their statistics are
+        saved to the database.
+        """
+        repo_stats = self._get_repo_language_stats(userid, repo)
+
+        if repo.get("fork") and self.fork_weight != 1:
+            repo_stats = {language: int(size * self.fork_weight)
+                          for language, size in repo_stats.iteritems()}
+
+        if self.incremental:
+            # Saved so that the next incremental run can reuse them.  A
+            # full run doesn't pay for the extra write per repository.
+            self.db.set_user_repo_stats(userid, repo["name"],
+                                        repo.get("pushed_at"), repo_stats)
+
+        self._add_repo_language_stats(userid, repo["name"], repo_stats)
+
+    def _add_repo_language_stats(self, userid, repo_name, repo_stats):
+        language_stats = self._aggregator.add(userid, repo_name, repo_stats)
+        if language_stats is None:
+            # Still waiting on other repositories
+            return
+
+        self._save_language_stats(userid, language_stats)
+
+    def _save_language_stats(self, userid, language_stats):
+        self._users.insert_user_language_stats(userid, language_stats)
+        self._users_finished.inc()
 
         logger.info(
             "Finished processing user: {}".format(userid))
 
+    def _get_repo_language_stats(self, userid, repo):
+        if self.language_cache is None:
+            return self.searcher.get_repo_language_stats(userid,
+                                                         repo["name"])
+
+        full_name = repo["full_name"]
+        pushed_at = repo["pushed_at"]
+
+        if repo["fork"] and pushed_at <= repo["created_at"]:
+            # Nothing has been pushed to the fork, so its contents are
+            # those of its source repository at the time of the last push.
+            source_full_name = self.language_cache.get_source(full_name)
+
+            if source_full_name is None and self.resolve_fork_sources:
+                source_full_name = "/".join(
+                    self.searcher.resolve_repo_to_source(userid,
+                                                         repo["name"]))
+                self.language_cache.set_source(full_name, source_full_name)
+
+            if source_full_name is not None:
+                full_name = source_full_name
+
+        repo_stats = self.language_cache.get(full_name, pushed_at)
+
+        if repo_stats is None:
+            repo_stats = self.searcher.get_repo_language_stats(userid,
+                                                               repo["name"])
+            self.language_cache.put(full_name, pushed_at, repo_stats)
+
+        return repo_stats
+
+    def dead_letter(self, task, error):
+        """
+        Records a task which has been given up on in the database, where it
+        can be inspected and replayed (see replay_dead_letters).
+
+        Args:
+          task: Task
+          error: Exception
+            The last error the task failed with.
+        """
+        self.db.insert_dead_letter(self._task_to_document(task),
+                                   "{}: {}".format(type(error).__name__,
+                                                   error),
+                                   task.attempts)
+
+        if task.stage == REPO_LANGUAGES_STAGE:
+            # Count the repository as empty so that its owner's other
+            # repositories still get saved.
+            _, repo = task.args
+            self._add_repo_language_stats(task.userid, repo["name"], {})
+
+    def replay_dead_letters(self):
+        """
+        Queues the tasks which were given up on to be tried again, for
+        example once the cause of their failure has been fixed.
+
+        Returns:
+          num_replayed: int
+        """
+        dead_letters = self.db.get_dead_letters()
+
+        for dead_letter in dead_letters:
+            document = dead_letter["job"]
+
+            if document["stage"] == REPO_LANGUAGES_STAGE:
+                # A repository only counts as part of its owner's totals,
+                # so all of the owner's repositories are looked up again.
+                task = Task(REPOS_STAGE, document["userid"],
+                            document["userid"])
+            else:
+                task = self._document_to_task(document)
+
+            if self.durable:
+                # The job is still in the queue as failed, so it has to be
+                # replaced rather than added.  It is given a priority the
+                # same way MongoWorkQueue.put would.
+                document = self._task_to_document(task)
+                if self._staleness is not None:
+                    document["priority"] = self._task_priority(task)
+
+                self.db.requeue_job(document)
+            else:
+                self.queue_task(task)
+
+            self.db.remove_dead_letter(dead_letter["_id"])
+
+        logger.info("Replayed {} dead letters".format(len(dead_letters)))
+
+        return len(dead_letters)
+
+    # Only the repository fields used by the pipeline are stored in the
+    # durable queue.
+    STORED_REPO_FIELDS = ["name", "full_name", "fork", "pushed_at",
+                          "created_at"]
+
+    def _task_to_document(self, task):
+        if task.stage == LOCATION_STAGE:
+            location, = task.args
+            return {"_id": "{}:{}".format(task.stage, location.normalized),
+                    "stage": task.stage,
+                    "userid": None,
+                    "location": location.normalized}
+        elif task.stage == USER_STAGE:
+            _, location = task.args
+            return {"_id": "{}:{}:{}".format(task.stage, task.userid,
+                                             location.normalized),
+                    "stage": task.stage,
+                    "userid": task.userid,
+                    "location": location.normalized}
+        elif task.stage == USER_LOCATION_STAGE:
+            _, location = task.args
+            return {"_id": "{}:{}:{}".format(task.stage, task.userid,
+                                             location.normalized),
+                    "stage": task.stage,
+                    "userid": task.userid,
+                    "location": location.normalized}
+        elif task.stage == REPOS_STAGE:
+            return {"_id": "{}:{}".format(task.stage, task.userid),
+                    "stage": task.stage,
+                    "userid": task.userid}
+        else:
+            _, repo = task.args
+            return {"_id": "{}:{}/{}".format(task.stage, task.userid,
+                                             repo["name"]),
+                    "stage": task.stage,
+                    "userid": task.userid,
+                    "repo": {field: repo.get(field)
+                             for field in self.STORED_REPO_FIELDS}}
+
+    def _document_to_task(self, document):
+        stage = document["stage"]
+        userid = document["userid"]
+
+        if stage == LOCATION_STAGE:
+            return Task(stage, None, self._get_location(document["location"]))
+        elif stage == USER_STAGE:
+            location = self._get_location(document["location"])
+            return Task(stage, userid, {"login": userid}, location)
+        elif stage == USER_LOCATION_STAGE:
+            location = self._get_location(document["location"])
+            return Task(stage, userid, userid, location)
+        elif stage == REPOS_STAGE:
+            return Task(stage, userid, userid)
+        else:
+            return Task(stage, userid, userid, document["repo"])
+
+    def _get_location(self, normalized):
+        for location in self.locations:
+            if location.normalized == normalized:
+                return location
+
+        raise ValueError("Unknown location: {}".format(normalized))
+
+
+# Errors which may go away if the task is tried again later.  Any other
+# error, such as a deleted account or unexpected data, will just happen
+# again.
+TRANSIENT_ERRORS = (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout,
+                    AutoReconnect)
+
+
+def is_transient(error):
+    if isinstance(error, GitHubApiException):
+        return error.transient
+
+    return isinstance(error, TRANSIENT_ERRORS)
+
 
 class WorkerThread(threading.Thread):
-    def __init__(self, work_queue, work_function):
+    DEFAULT_MAX_ATTEMPTS = 5
+
+    def __init__(self, work_queue, work_function, concurrency_limit=None,
+                 dead_letter_function=None,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS, metrics=None,
+                 retry_timer=None):
+        """
+        Constructor.
+
+        Args:
+          work_queue: Queue.Queue or osstrends.workqueue.MongoWorkQueue
+          work_function: function
+            Performs a task taken from the queue.
+          concurrency_limit: osstrends.concurrency.ConcurrencyLimit
+            If provided, the thread only takes work while it holds a place
+            within the limit.
+          dead_letter_function: function
+            Called with a task and the error it failed with when the task
+            is given up on.
+          max_attempts: int
+            How many times a task failing with a transient error is tried
+            before it is given up on.  Tasks failing with other errors are
+            given up on right away.
+          metrics: osstrends.metrics.MetricsRegistry
+            Where the outcome and duration of each task, and the time spent
+            sleeping until the rate limit resets, are recorded.
+          retry_timer: osstrends.workqueue.RetryTimer
+            Holds back tasks waiting to be retried after failing, for work
+            queues which can't (such as Queue.Queue).  If None, tasks are
+            put straight back on the work queue with their not_before
+            time, which the queue must respect.
+        """
         super(WorkerThread, self).__init__()
 
         self.work_queue = work_queue
         self.work_function = work_function
+        self.concurrency_limit = concurrency_limit
+        self.dead_letter_function = dead_letter_function
+        self.max_attempts = max_attempts
+        self.retry_timer = retry_timer
 
         # Wait a few extra seconds past the designated API reset time
         self.sleep_buffer = 10
 
+        # Retries are delayed by up to backoff_base * 2 ** (attempts - 1)
+        # seconds, but never more than backoff_cap.
+        self.backoff_base = 2
+        self.backoff_cap = 300
+
+        if metrics is None:
+            metrics = MetricsRegistry()
+
+        self._tasks = metrics.counter(
+            "pipeline_tasks_total",
+            "Task attempts, by stage and outcome (done, retried, failed or "
+            "rate_limited).")
+        self._task_seconds = metrics.histogram(
+            "pipeline_task_seconds",
+            "Time taken by task attempts, by stage.")
+        self._rate_limit_sleep_seconds = metrics.counter(
+            "pipeline_rate_limit_sleep_seconds_total",
+            "Time worker threads spent sleeping until the rate limit "
+            "reset.")
+
     def run(self):
         while True:
-            user, location = self.work_queue.get()
-            self.process(user, location)
+            if self.concurrency_limit is None:
+                self.process(self.work_queue.get())
+            else:
+                with self.concurrency_limit:
+                    self.process(self.work_queue.get())
+
+    def process(self, task):
+        outcome = self._attempt(task)
+        self._tasks.inc(stage=task.stage, outcome=outcome)
+
+    def _attempt(self, task):
+        """
+        Performs a task, dealing with any error it fails with.
 
-    def process(self, user, location):
+        Returns:
+          outcome: str
+            "done", "retried", "failed" or "rate_limited".
+        """
         try:
-            self.work_function(user, location)
+            # Only the work itself is timed, not the waits before retries.
+            with self._task_seconds.time(stage=task.stage):
+                self.work_function(task)
+
             self.work_queue.task_done()
+            return "done"
         except RateLimitException as error:
             logger.warn(str(error))
-            self.requeue(user, location)
+            self.requeue(task)
+
+            sleep_start_time = time.time()
             self.sleep_until(error.reset_time + self.sleep_buffer)
+            self._rate_limit_sleep_seconds.inc(time.time() - sleep_start_time)
+
+            return "rate_limited"
         except Exception as error:
-            logger.error(error)
-            self.requeue(user, location)
+            task.attempts += 1
+
+            if not is_transient(error):
+                logger.error("{} failed permanently: {}".format(task, error))
+                self.give_up(task, error)
+                return "failed"
+            elif task.attempts >= self.max_attempts:
+                logger.error("{} failed {} times, giving up: {}".format(
+                    task, task.attempts, error))
+                self.give_up(task, error)
+                return "failed"
+            else:
+                delay = self.backoff(task.attempts)
+                logger.warn("{} failed, retrying in {:.1f} seconds: "
+                            "{}".format(task, delay, error))
+
+                # The thread goes on to other tasks rather than waiting.
+                task.not_before = time.time() + delay
+                self.requeue(task)
+                return "retried"
+
+    def backoff(self, attempts):
+        """
+        Chooses how long to wait before retrying a task.  The delay grows
+        exponentially with the number of attempts, and is randomized so
+        that tasks which failed together don't all retry together.
+        """
+        return random.uniform(0, min(self.backoff_cap,
+                                     self.backoff_base * 2 ** (attempts - 1)))
+
+    def give_up(self, task, error):
+        if self.dead_letter_function is not None:
+            try:
+                self.dead_letter_function(task, error)
+            except Exception as dead_letter_error:
+                logger.error("Failed to record dead letter for {}: "
+                             "{}".format(task, dead_letter_error))
+
+        # The durable queue records the job as failed rather than done.
+        task_failed = getattr(self.work_queue, "task_failed", None)
+        if task_failed is not None:
+            task_failed()
+        else:
+            self.work_queue.task_done()
+
+    def requeue(self, task):
+        if task.not_before is not None and self.retry_timer is not None:
+            # Put back on the queue, and marked done, once it may be tried
+            # again.
+            self.retry_timer.put(task)
+            return
 
-    def requeue(self, user, location):
         # Put it back on the queue
-        self.work_queue.put((user, location))
+        self.work_queue.put(task)
 
         # Mark the current attempt done even though it failed.  Otherwise
         # the number of puts will become larger than the number of calls
@@ -174,8 +1226,207 @@ class WorkerThread(threading.Thread):
         time.sleep(wakeup_time - time.time())
 
 
-def execute():
+def _create_pipeline(num_threads, cache_filename, language_cache_filename,
+                     fork_weight, durable, autoscale=False,
+                     incremental=False, prioritize=False, write_behind=False,
+                     metrics_filename=None, metrics_labels=None,
+                     recorder=None, replay=None, user_fields=None,
+                     resolve_fork_sources=False):
+    # Shared so that all of the run's metrics are exported together.
+    metrics = MetricsRegistry(labels=metrics_labels)
+
+    cache = None
+    if cache_filename is not None:
+        cache = ResponseCache(cache_filename)
+
+    language_cache = RepoLanguageCache(language_cache_filename)
+
+    # Size the connection pool to match the workers sharing it.
+    pool_size = num_threads
+    if autoscale:
+        pool_size = max(num_threads, DataPipeline.DEFAULT_MAX_THREADS)
+    searcher = GitHubSearcher(pool_size=pool_size, cache=cache,
+                              metrics=metrics, recorder=recorder,
+                              replay=replay)
+
+    return DataPipeline(MongoDatabase(metrics=metrics), searcher,
+                        load_locations(),
+                        num_threads=num_threads,
+                        language_cache=language_cache,
+                        fork_weight=fork_weight,
+                        resolve_fork_sources=resolve_fork_sources,
+                        durable=durable,
+                        autoscale=autoscale,
+                        incremental=incremental,
+                        prioritize=prioritize,
+                        write_behind=write_behind,
+                        metrics=metrics,
+                        metrics_filename=metrics_filename,
+                        user_fields=user_fields)
+
+
+def _start_metrics_server(pipeline, port):
+    if port is None:
+        return None
+
+    server = MetricsServer(pipeline.metrics, port)
+    server.start()
+    logger.info("Serving metrics at http://localhost:{}/metrics".format(
+        server.port))
+
+    return server
+
+
+def _stop_metrics_server(server):
+    if server is not None:
+        server.stop()
+
+
+def _save_caches(pipeline):
+    cache = pipeline.searcher.cache
+    if cache is not None:
+        logger.info("Response cache hits: %d, misses: %d" % (
+            cache.hits, cache.misses))
+        cache.save()
+
+    language_cache = pipeline.language_cache
+    logger.info("Language cache hits: %d, misses: %d" % (
+        language_cache.hits, language_cache.misses))
+    language_cache.save()
+
+
+def execute(num_threads=DataPipeline.DEFAULT_NUM_THREADS, cache_filename=None,
+            language_cache_filename=None, fork_weight=1.0, durable=False,
+            resume=False, autoscale=False, replay_dead_letters=False,
+            incremental=False, prioritize=False, write_behind=False,
+            metrics_filename=None, metrics_port=None, record_filename=None,
+            replay_filename=None, replay_latency=False, user_fields=None,
+            resolve_fork_sources=False):
     """
     Executes the data pipeline with default parameters.
+
+    Args:
+      num_threads: int
+        The number of worker threads.
+      cache_filename: str
+        If provided, API responses are cached in this file so that the
+        next run can make conditional requests for them.
+      language_cache_filename: str
+        If provided, repositories' language statistics are cached in this
+        file for the next run.
+      fork_weight: float
+        How much forked repositories count towards their owner's language
+        statistics.
+      durable: bool
+        Keep the work queue in the database so the run can be resumed.
+      resume: bool
+        Continue the last durable run instead of starting a new one.
+      autoscale: bool
+        Adjust the number of worker threads while running, starting from
+        num_threads.
+      replay_dead_letters: bool
+        Try the tasks given up on in previous runs again.
+      incremental: bool
+        Refresh the data saved by previous runs instead of retrieving it
+        all again.
+      prioritize: bool
+        Refresh the users whose data is most likely to be out of date
+        first.
+      write_behind: bool
+        Save users to the database in bulk from a background thread.
+      metrics_filename: str
+        If provided, the run's metrics are written to this file in
+        Prometheus' text format while it runs.
+      metrics_port: int
+        If provided, the run's metrics are served over HTTP on this port
+        at /metrics while it runs.
+      record_filename: str
+        If provided, every API request and response is written to this
+        file (see osstrends.recording.TrafficRecorder).
+      replay_filename: str
+        If provided, the API traffic recorded in this file is served back
+        instead of sending requests to GitHub.
+      replay_latency: bool
+        If True, replayed responses take as long as they did when they
+        were recorded.
+      user_fields: list(str)
+        If provided, only these fields of users' details are saved (see
+        DataPipeline).
+      resolve_fork_sources: bool
+        Look up which repositories unchanged forks were created from, so
+        they can share cached language statistics (see DataPipeline).
+    """
+    recorder = None
+    if record_filename is not None:
+        recorder = TrafficRecorder(record_filename)
+
+    replay = None
+    if replay_filename is not None:
+        replay = TrafficReplay(replay_filename, latency=replay_latency)
+
+    pipeline = _create_pipeline(num_threads, cache_filename,
+                                language_cache_filename, fork_weight, durable,
+                                autoscale, incremental, prioritize,
+                                write_behind, metrics_filename,
+                                recorder=recorder, replay=replay,
+                                user_fields=user_fields,
+                                resolve_fork_sources=resolve_fork_sources)
+    server = _start_metrics_server(pipeline, metrics_port)
+    try:
+        pipeline.execute(resume=resume,
+                         replay_dead_letters=replay_dead_letters)
+    finally:
+        _stop_metrics_server(server)
+
+        if recorder is not None:
+            recorder.close()
+
+        # Even an interrupted run's responses are worth keeping.
+        _save_caches(pipeline)
+
+
+def rebuild_location_stats():
+    """
+    Recomputes every location's saved language statistics from the users
+    in the database.
+    """
+    MongoDatabase().rebuild_location_stats()
+
+
+def coordinate(resume=False, replay_dead_letters=False, prioritize=False):
+    """
+    Runs the coordinator of a crawl carried out by separate worker
+    processes.  See DataPipeline.coordinate.  prioritize must match the
+    workers' so that the jobs the coordinator queues are ordered with
+    theirs.
+    """
+    # The coordinator doesn't make any API requests itself.
+    _create_pipeline(1, None, None, 1.0, True,
+                     prioritize=prioritize).coordinate(
+        resume=resume, replay_dead_letters=replay_dead_letters)
+
+
+def work(num_threads=DataPipeline.DEFAULT_NUM_THREADS, cache_filename=None,
+         language_cache_filename=None, fork_weight=1.0, autoscale=False,
+         incremental=False, prioritize=False, write_behind=False,
+         metrics_filename=None, metrics_port=None, metrics_labels=None,
+         user_fields=None, resolve_fork_sources=False):
+    """
+    Runs a worker process for a crawl started by a coordinator.  See
+    DataPipeline.work.  The arguments are the same as for execute; cache
+    files, metrics files and metrics ports must not be shared with other
+    processes.  metrics_labels are added to every metric, to tell the
+    workers apart.
     """
-    DataPipeline(MongoDatabase(), GitHubSearcher(), load_locations()).execute()
+    pipeline = _create_pipeline(num_threads, cache_filename,
+                                language_cache_filename, fork_weight, True,
+                                autoscale, incremental, prioritize,
+                                write_behind, metrics_filename,
+                                metrics_labels, user_fields=user_fields,
+                                resolve_fork_sources=resolve_fork_sources)
+    server = _start_metrics_server(pipeline, metrics_port)
+    try:
+        pipeline.work()
+    finally:
+        _stop_metrics_server(server)
+        _save_caches(pipeline)
@@ -0,0 +1,363 @@
+# Copyright (C) 2014 David Rusk
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+__author__ = "David Rusk <drusk@uvic.ca>"
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+CORE_BUCKET = "core"
+SEARCH_BUCKET = "search"
+
+
+class RateLimitBucket(object):
+    """
+    The state of one of GitHub's rate limits, as reported by the headers
+    of the most recent responses.
+    """
+
+    def __init__(self):
+        # None until the first response has been seen, or once the reset
+        # time has passed and the new budget isn't known yet.
+        self.remaining = None
+        self.reset_time = None
+
+        # Requests which have been allowed but whose responses haven't
+        # been seen yet.
+        self.in_flight = 0
+
+        # The earliest time the next request may start when pacing.
+        self.next_request_time = 0
+
+    def available(self):
+        return self.remaining - self.in_flight
+
+
+class RateLimitBudget(object):
+    """
+    Shares GitHub's rate limits between all of the threads making requests.
+
+    Every response updates the budget from its X-RateLimit headers, and
+    every request waits for the budget's permission before being sent.
+    Requests are spread evenly over the time left until the limit resets
+    rather than being sent in a burst, and once the budget is used up all
+    threads wait together until the reset.
+
+    The "core" and "search" limits are tracked separately since GitHub
+    counts them separately.
+    """
+
+    def __init__(self, pace=True, sleep_buffer=10):
+        """
+        Constructor.
+
+        Args:
+          pace: bool
+            If True, requests are spaced evenly over the rate limit
+            window.  If False they are sent as fast as possible until
+            the budget runs out.
+          sleep_buffer: int
+            Seconds to wait past the reset time reported by GitHub.
+        """
+        self.pace = pace
+        self.sleep_buffer = sleep_buffer
+
+        self._buckets = {
+            CORE_BUCKET: RateLimitBucket(),
+            SEARCH_BUCKET: RateLimitBucket()
+        }
+        self._lock = threading.Lock()
+
+    def remaining(self, bucket_name):
+        """
+        Returns the number of requests left in the current window, or None
+        if it isn't known yet.
+        """
+        with self._lock:
+            bucket = self._buckets[bucket_name]
+
+            if bucket.remaining is None:
+                return None
+
+            return bucket.available()
+
+    def request_rate(self, bucket_name, now):
+        """
+        Returns how many requests per second the remaining budget allows
+        until the limit resets, or None if it isn't known yet.
+        """
+        with self._lock:
+            bucket = self._buckets[bucket_name]
+
+            if bucket.remaining is None or bucket.reset_time <= now:
+                return None
+
+            return (float(max(bucket.available(), 0)) /
+                    (bucket.reset_time - now))
+
+    def acquire(self, bucket_name):
+        """
+        Blocks until a request may be made.  Each call must be followed by
+        a call to either update or release once the request is done.
+
+        Args:
+          bucket_name: str
+            Which rate limit the request counts against.
+
+        Returns: void
+        """
+        while True:
+            wait_time = self.reserve(bucket_name, time.time())
+
+            if wait_time is None:
+                return
+
+            self.sleep(wait_time)
+
+    def reserve(self, bucket_name, now):
+        """
+        Tries to reserve part of the budget for a request.
+
+        Args:
+          bucket_name: str
+          now: float
+            The current time.
+
+        Returns:
+          wait_time: float
+            None if the request was allowed and can be sent right away.
+            Otherwise, the number of seconds to wait before trying again.
+        """
+        with self._lock:
+            bucket = self._buckets[bucket_name]
+
+            if (bucket.reset_time is not None and
+                    bucket.reset_time + self.sleep_buffer <= now):
+                # A new window has started, but its budget isn't known
+                # until the next response comes back.
+                bucket.remaining = None
+                bucket.reset_time = None
+                bucket.next_request_time = 0
+
+            if bucket.remaining is None:
+                bucket.in_flight += 1
+                return None
+
+            available = bucket.available()
+            if available <= 0:
+                if bucket.in_flight > 0:
+                    # Requests still in flight may report that the window
+                    # has reset.
+                    return 1
+
+                logger.warn("Rate limit for %s exhausted.  Waiting until "
+                            "%d" % (bucket_name, bucket.reset_time))
+                return bucket.reset_time + self.sleep_buffer - now
+
+            if self.pace:
+                if bucket.next_request_time > now:
+                    return bucket.next_request_time - now
+
+                interval = float(bucket.reset_time - now) / available
+                bucket.next_request_time = now + interval
+
+            bucket.in_flight += 1
+            return None
+
+    def release(self, bucket_name):
+        """
+        Returns the budget reserved for a request which failed without a
+        response.
+        """
+        with self._lock:
+            bucket = self._buckets[bucket_name]
+            bucket.in_flight = max(bucket.in_flight - 1, 0)
+
+    def update(self, bucket_name, headers):
+        """
+        Records the rate limit state reported by a response.  This also
+        releases the budget reserved for the request.
+
+        Args:
+          bucket_name: str
+          headers: dict-like
+            The response headers.
+
+        Returns: void
+        """
+        try:
+            remaining = int(headers["X-RateLimit-Remaining"])
+            reset_time = int(headers["X-RateLimit-Reset"])
+        except (KeyError, TypeError, ValueError):
+            self.release(bucket_name)
+            return
+
+        with self._lock:
+            bucket = self._buckets[bucket_name]
+            bucket.in_flight = max(bucket.in_flight - 1, 0)
+
+            if bucket.reset_time is None or reset_time > bucket.reset_time:
+                bucket.remaining = remaining
+                bucket.reset_time = reset_time
+            elif reset_time == bucket.reset_time:
+                # Responses can arrive out of order, but within a window
+                # the remaining count only goes down.
+                bucket.remaining = min(bucket.remaining, remaining)
+
+    def sleep(self, seconds):
+        time.sleep(max(seconds, 0))
+
+
+class CredentialPool(object):
+    """
+    Spreads requests across several sets of API credentials.  Each one has
+    its own rate limit, so each gets its own RateLimitBudget, and every
+    request is sent with the credentials that have the most budget left.
+    When one set of credentials runs out the next request simply uses
+    another, and threads only wait once all of them are used up.
+    """
+
+    def __init__(self, credentials, pace=True, sleep_buffer=10):
+        """
+        Constructor.
+
+        Args:
+          credentials: list((str, str))
+            (username, token) pairs.
+          pace: bool
+          sleep_buffer: int
+            Passed through to each credential's RateLimitBudget.
+        """
+        if not credentials:
+            raise ValueError("At least one set of credentials is required.")
+
+        self.credentials = list(credentials)
+        self._budgets = {
+            credential: RateLimitBudget(pace=pace, sleep_buffer=sleep_buffer)
+            for credential in self.credentials
+        }
+
+        # Used to rotate between credentials with equal budgets.
+        self._next_index = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.credentials)
+
+    def get_budget(self, credential):
+        return self._budgets[credential]
+
+    def remaining(self, bucket_name):
+        """
+        Returns the total number of requests left across all credentials
+        whose budget is known, or None if none of them are known yet.
+        """
+        known = [remaining for remaining in
+                 (budget.remaining(bucket_name)
+                  for budget in self._budgets.itervalues())
+                 if remaining is not None]
+
+        return sum(known) if known else None
+
+    def request_rate(self, bucket_name, now=None):
+        """
+        Returns how many requests per second the credentials' remaining
+        budgets allow between them, or None if none of them are known yet.
+        """
+        if now is None:
+            now = time.time()
+
+        known = [rate for rate in
+                 (budget.request_rate(bucket_name, now)
+                  for budget in self._budgets.itervalues())
+                 if rate is not None]
+
+        return sum(known) if known else None
+
+    def has_budget(self, bucket_name):
+        """
+        Returns True if any of the credentials might still be able to make
+        a request against the bucket.
+        """
+        for budget in self._budgets.itervalues():
+            remaining = budget.remaining(bucket_name)
+            if remaining is None or remaining > 0:
+                return True
+
+        return False
+
+    def acquire(self, bucket_name):
+        """
+        Blocks until one of the credentials may be used for a request.
+        Each call must be followed by a call to either update or release
+        with the returned credentials once the request is done.
+
+        Args:
+          bucket_name: str
+            Which rate limit the request counts against.
+
+        Returns:
+          credential: (str, str)
+            The (username, token) to send the request with.
+        """
+        while True:
+            now = time.time()
+            wait_times = []
+
+            for credential in self._by_remaining(bucket_name):
+                wait_time = self._budgets[credential].reserve(bucket_name,
+                                                              now)
+                if wait_time is None:
+                    return credential
+
+                wait_times.append(wait_time)
+
+            self.sleep(min(wait_times))
+
+    def release(self, credential, bucket_name):
+        self._budgets[credential].release(bucket_name)
+
+    def update(self, credential, bucket_name, headers):
+        self._budgets[credential].update(bucket_name, headers)
+
+    def sleep(self, seconds):
+        time.sleep(max(seconds, 0))
+
+    def _by_remaining(self, bucket_name):
+        """
+        Orders the credentials with the most remaining budget first.
+        Credentials whose budget isn't known yet come first so that it
+        gets discovered, and ties are rotated between.
+        """
+        with self._lock:
+            start = self._next_index
+            self._next_index = (start + 1) % len(self.credentials)
+
+        rotated = self.credentials[start:] + self.credentials[:start]
+
+        def remaining(credential):
+            value = self._budgets[credential].remaining(bucket_name)
+            return float("inf") if value is None else value
+
+        # sorted is stable so the rotation breaks ties
+        return sorted(rotated, key=remaining, reverse=True)
@@ -0,0 +1,253 @@
+# Copyright (C) 2014 David Rusk
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+__author__ = "David Rusk <drusk@uvic.ca>"
+
+import collections
+import gzip
+import json
+import logging
+import threading
+import time
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+logger = logging.getLogger(__name__)
+
+# Request headers which are not written to recordings.
+REDACTED_HEADERS = ["Authorization"]
+
+VALIDATOR_HEADERS = ["If-None-Match", "If-Modified-Since"]
+
+
+class ReplayMiss(requests.exceptions.RequestException):
+    """
+    A request was made during a replay which wasn't in the recording, or
+    was made more times than it was recorded.
+    """
+
+    def __init__(self, method, url):
+        super(ReplayMiss, self).__init__(
+            "{} {} was not recorded".format(method, url))
+
+
+class TrafficRecorder(object):
+    """
+    Writes API requests and their responses, including headers, to a gzip
+    compressed file with one JSON object per line.  It is shared by all of
+    the threads making requests.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+        self._file = gzip.open(filename, "wb")
+        self._lock = threading.Lock()
+
+    def record(self, request, response, start_time, elapsed):
+        """
+        Args:
+          request: requests.PreparedRequest
+          response: requests.Response
+          start_time: float
+            When the request was sent.
+          elapsed: float
+            Seconds taken for the response to arrive.
+        """
+        line = json.dumps({
+            "time": start_time,
+            "elapsed": elapsed,
+            "method": request.method,
+            "url": request.url,
+            "request_headers": {
+                name: value for name, value in request.headers.iteritems()
+                if name not in REDACTED_HEADERS
+            },
+            "status": response.status_code,
+            "reason": response.reason,
+            "headers": dict(response.headers),
+            "body": response.content.decode("utf-8")
+        })
+
+        with self._lock:
+            self._file.write(line + "\n")
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class TrafficReplay(object):
+    """
+    Serves the responses from a TrafficRecorder's file.
+
+    Each request gets the next response recorded for the same method and
+    URL, so a URL requested several times during the recording (e.g. a
+    retry after an error) gets its responses back in the same order.
+    """
+
+    def __init__(self, filename, latency=False):
+        """
+        Constructor.
+
+        Args:
+          filename: str
+          latency: bool
+            If True, each response takes as long to come back as it did
+            when it was recorded.  Otherwise they come back immediately.
+        """
+        self.filename = filename
+        self.latency = latency
+
+        self._responses = collections.defaultdict(collections.deque)
+        self._lock = threading.Lock()
+
+        self.load()
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(responses)
+                       for responses in self._responses.itervalues())
+
+    def load(self):
+        """
+        Reads the recorded traffic.  A recording cut short, e.g. by a
+        crash during the crawl, is read up to where it stops.
+        """
+        num_responses = 0
+
+        with gzip.open(self.filename, "rb") as filehandle:
+            try:
+                for line in filehandle:
+                    try:
+                        exchange = json.loads(line)
+                    except ValueError:
+                        # The last line was only partly written.
+                        break
+
+                    self._responses[(exchange["method"],
+                                     exchange["url"])].append(exchange)
+                    num_responses += 1
+            except (EOFError, IOError) as error:
+                logger.warn("Recording {} ends early: {}".format(
+                    self.filename, error))
+
+        logger.info("Loaded {} recorded responses from {}".format(
+            num_responses, self.filename))
+
+    def next_response(self, method, url, conditional):
+        """
+        Takes the next recorded response for a request.
+
+        Args:
+          method: str
+          url: str
+          conditional: bool
+            Whether the request has validators.  "304 Not Modified"
+            responses are skipped for requests which don't, since the
+            cache they were answered from during the recording may not
+            have the response now.
+
+        Returns:
+          exchange: dict
+            The recorded request and response, or None if there aren't
+            any more for the request.
+        """
+        with self._lock:
+            responses = self._responses.get((method, url))
+
+            while responses:
+                exchange = responses.popleft()
+
+                if exchange["status"] != 304 or conditional:
+                    return exchange
+
+            return None
+
+
+class RecordingAdapter(HTTPAdapter):
+    """
+    Sends requests like an HTTPAdapter, writing each one and its response
+    to a TrafficRecorder.
+    """
+
+    def __init__(self, recorder, **kwargs):
+        """
+        Constructor.
+
+        Args:
+          recorder: TrafficRecorder
+          kwargs:
+            Passed through to the HTTPAdapter, e.g. pool_maxsize.
+        """
+        super(RecordingAdapter, self).__init__(**kwargs)
+        self.recorder = recorder
+
+    def send(self, request, **kwargs):
+        start_time = time.time()
+        response = super(RecordingAdapter, self).send(request, **kwargs)
+
+        # Reads the body, which requests would otherwise do later anyway.
+        response.content
+
+        self.recorder.record(request, response, start_time,
+                             time.time() - start_time)
+
+        return response
+
+
+class ReplayAdapter(BaseAdapter):
+    """
+    Answers requests from a TrafficReplay instead of sending them.  A
+    request which wasn't recorded raises ReplayMiss.
+    """
+
+    def __init__(self, replay):
+        super(ReplayAdapter, self).__init__()
+        self.replay = replay
+
+    def send(self, request, **kwargs):
+        conditional = any(header in request.headers
+                          for header in VALIDATOR_HEADERS)
+
+        exchange = self.replay.next_response(request.method, request.url,
+                                             conditional)
+        if exchange is None:
+            raise ReplayMiss(request.method, request.url)
+
+        if self.replay.latency:
+            time.sleep(exchange["elapsed"])
+
+        response = requests.Response()
+        response.status_code = exchange["status"]
+        response.reason = exchange.get("reason")
+        response.headers = CaseInsensitiveDict(exchange["headers"])
+        response.encoding = "utf-8"
+        response._content = exchange["body"].encode("utf-8")
+        response.url = request.url
+        response.request = request
+        response.connection = self
+
+        return response
+
+    def close(self):
+        pass
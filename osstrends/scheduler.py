@@ -0,0 +1,161 @@
+# Copyright (C) 2014 David Rusk
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+__author__ = "David Rusk <drusk@uvic.ca>"
+
+import datetime
+import itertools
+import math
+import Queue
+import time
+
+
+class PriorityWorkQueue(Queue.PriorityQueue):
+    """
+    A drop-in replacement for Queue.Queue which hands out the most urgent
+    task first instead of the oldest.  Tasks of equal urgency come out in
+    the order they were put in.
+    """
+
+    def __init__(self, priority_function, maxsize=0):
+        """
+        Constructor.
+
+        Args:
+          priority_function: function
+            Scores a task's urgency.  Higher scores come out first.
+          maxsize: int
+            As for Queue.Queue.
+        """
+        Queue.PriorityQueue.__init__(self, maxsize)
+
+        self.priority_function = priority_function
+        self._counter = itertools.count()
+
+    def _put(self, task):
+        # heapq puts the smallest item first, and the counter breaks ties
+        # without comparing the tasks themselves.
+        Queue.PriorityQueue._put(self, (-self.priority_function(task),
+                                        next(self._counter), task))
+
+    def _get(self):
+        return Queue.PriorityQueue._get(self)[-1]
+
+
+class StalenessPriority(object):
+    """
+    Scores users by how likely their saved data is to be out of date, so
+    that when the rate limit cuts a refresh short the data left stale is
+    the data least likely to have changed.
+
+    A user's score is the number of days since they were last fetched,
+    scaled up for users who have been active on GitHub recently and for
+    users in more important locations (see Location.priority).  Users who
+    have never been fetched count as NEVER_FETCHED_DAYS stale, so they come
+    before users fetched more recently than that, but not before users
+    left unrefreshed for longer.
+    """
+
+    # The staleness given to users who have never been fetched.  Not
+    # infinite, so that users who haven't been refreshed in longer than this
+    # aren't starved by a steady supply of new users.
+    NEVER_FETCHED_DAYS = 365
+
+    def __init__(self, locations, activity_weight=1.0, activity_days=30):
+        """
+        Constructor.
+
+        Args:
+          locations: list(osstrends.locations.Location)
+          activity_weight: float
+            How much more urgent a user who was active just now is than
+            one who hasn't been active for a long time.
+          activity_days: float
+            How quickly recent activity stops counting.  A user last
+            active this many days ago gets half of the activity weight.
+        """
+        self.activity_weight = activity_weight
+        self.activity_days = activity_days
+
+        self._location_priorities = {location.normalized: location.priority
+                                     for location in locations}
+        self._refresh_info = {}
+        self._now = time.time()
+
+    def load(self, refresh_info, now=None):
+        """
+        Sets what is known about the users' saved data.
+
+        Args:
+          refresh_info: dict
+            As returned by MongoDatabase.get_user_refresh_info.
+          now: float
+            The time scores are calculated at.  Defaults to the current
+            time.
+        """
+        self._refresh_info = refresh_info
+        self._now = time.time() if now is None else now
+
+    def score(self, userid, location=None):
+        """
+        Args:
+          userid: str
+          location: osstrends.locations.Location
+            The location the user was found in, if known.
+
+        Returns:
+          score: float
+            Higher scores should be refreshed sooner.
+        """
+        info = self._refresh_info.get(userid)
+
+        if info is None or info["fetched_at"] is None:
+            staleness = self.NEVER_FETCHED_DAYS
+            recency = 0
+            normalized_locations = []
+        else:
+            staleness = max(self._now - info["fetched_at"], 0) / 86400.0
+            recency = self._recency(info["active_at"])
+            normalized_locations = info["locations"]
+
+        if location is not None:
+            normalized_locations = normalized_locations + [
+                location.normalized]
+
+        location_priority = max([self._location_priorities.get(name, 1.0)
+                                 for name in normalized_locations] or [1.0])
+
+        return (staleness * (1 + self.activity_weight * recency) *
+                location_priority)
+
+    def _recency(self, active_at):
+        """
+        Returns 1 for activity happening now, falling towards 0 the longer
+        ago it was.
+        """
+        if active_at is None:
+            return 0
+
+        active_time = datetime.datetime.strptime(active_at,
+                                                 "%Y-%m-%dT%H:%M:%SZ")
+        idle_days = max((datetime.datetime.utcfromtimestamp(self._now) -
+                         active_time).total_seconds(), 0) / 86400.0
+
+        return math.pow(0.5, idle_days / self.activity_days)
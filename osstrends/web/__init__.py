@@ -20,11 +20,12 @@
 
 __author__ = "David Rusk <drusk@uvic.ca>"
 
-from flask import Flask, redirect, render_template, request
+from flask import (Flask, abort, escape, jsonify, redirect, render_template,
+                   request, url_for)
 from flask.ext.login import (LoginManager, login_required, login_user,
                              logout_user)
 
-from osstrends import auth
+from osstrends import auth, datatables
 from osstrends.admin import Admin, LoginForm, ChangePasswordForm
 from osstrends.database import MongoDatabase
 from osstrends.locations import load_locations
@@ -37,6 +38,14 @@ login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = "/login"
 
+# The only fields of users that lists of them show.
+USER_LIST_FIELDS = [MongoDatabase.USERID_KEY, "name", "company",
+                    MongoDatabase.TOTAL_CODE_SIZE_KEY]
+
+# Locations with more users than this are shown a page at a time, with the
+# tables' paging, sorting and searching done by users_data.
+SERVER_SIDE_THRESHOLD = 500
+
 db = MongoDatabase()
 locations = load_locations()
 admin = Admin(db)
@@ -55,19 +64,34 @@ def about():
 @app.route("/users")
 def users_by_location():
     location = request.args["location"]
-    users = db.get_users(location=location)
-    return render_template("users.html", location=location, users=users)
+
+    if db.count_users(location=location) > SERVER_SIDE_THRESHOLD:
+        return render_template(
+            "users.html", location=location, users=[],
+            data_url=url_for("users_data", location=location))
+
+    users = db.get_users(location=location, fields=USER_LIST_FIELDS)
+    return render_template("users.html", location=location, users=users,
+                           data_url=None)
 
 
 @app.route("/user/languages/<userid>")
 def user_languages(userid):
-    user = db.get_user(userid)
-    language_stats = db.get_user_language_stats(userid)
+    user = db.get_user(userid, fields=[
+        "html_url", MongoDatabase.NORMALIZED_LOCATION_KEY,
+        MongoDatabase.LANGUAGES_KEY])
+    language_stats = user[MongoDatabase.LANGUAGES_KEY]
+
+    # Users can be in several locations, so go back to the one the user
+    # list was for.
+    location = request.args.get("location",
+                                user["location_normalized"][0])
+
     return render_template("user_languages.html",
                            userid=userid,
                            github_page=user["html_url"],
                            language_stats=language_stats,
-                           location=user["location_normalized"])
+                           location=location)
 
 
 @app.route("/location/<location_normalized>")
@@ -86,11 +110,63 @@ def users_by_location_and_language():
     location = request.args["location"]
     language = request.args["language"]
 
-    users = db.get_users(location=location, language=language)
+    if (db.count_users(location=location, language=language) >
+            SERVER_SIDE_THRESHOLD):
+        return render_template(
+            "users_by_location_and_language.html",
+            users=[],
+            location=location,
+            language=language,
+            data_url=url_for("users_data", location=location,
+                             language=language))
+
+    users = db.get_users(
+        location=location, language=language,
+        fields=USER_LIST_FIELDS + [datatables.code_size_field(language)])
     return render_template("users_by_location_and_language.html",
                            users=users,
                            location=location,
-                           language=language)
+                           language=language,
+                           data_url=None)
+
+
+@app.route("/users/data")
+def users_data():
+    """
+    Serves pages of the user tables as JSON, for DataTables' server-side
+    processing.  The language is optional.
+    """
+    location = request.args["location"]
+    language = request.args.get("language")
+
+    try:
+        table_request = datatables.TableRequest.from_args(request.args)
+    except ValueError:
+        abort(400)
+
+    num_total, num_filtered, users = datatables.get_users_page(
+        db, table_request, location, language)
+
+    rows = []
+    for user in users:
+        if language is None:
+            code_size = user.get(MongoDatabase.TOTAL_CODE_SIZE_KEY)
+        else:
+            code_size = user.get(MongoDatabase.LANGUAGES_KEY, {}).get(language)
+
+        # DataTables shows the cells as HTML, so the users' own text is
+        # escaped.
+        rows.append([
+            escape(user.get("name") or ""),
+            u'<a href="{}">{}</a>'.format(
+                escape(url_for("user_languages", userid=user["login"],
+                               location=location)),
+                escape(user["login"])),
+            escape(user.get("company") or ""),
+            code_size
+        ])
+
+    return jsonify(table_request.response(num_total, num_filtered, rows))
 
 
 @login_manager.user_loader
@@ -43,4 +43,34 @@ function createDataTable(elementId, sortColumn, direction) {
     });
 
     dataTable.fnSort([[sortColumn, direction]]);
-}
\ No newline at end of file
+}
+
+/**
+ * Creates a DataTable which gets its rows a page at a time from the
+ * server, which also does the sorting and searching.  Used for tables too
+ * big to send to the browser all at once.
+ *
+ * @param elementId String containing the id of the (empty) table.
+ * @param sortColumn Integer indicating the 0-based index of the column to
+ *        sort on by default.
+ * @param direction String indicating sort direction.  "asc" for ascending
+ *        or "desc" for descending.
+ * @param sourceUrl String containing the URL the rows are retrieved from.
+ */
+function createServerSideDataTable(elementId, sortColumn, direction,
+                                   sourceUrl) {
+    if (elementId[0] != "#") {
+        elementId = "#" + elementId;
+    }
+
+    $(elementId).dataTable({
+        "sPaginationType": "bs_full",
+        "oLanguage": {
+            "sSearch": "Search Fields:"
+        },
+        "bProcessing": true,
+        "bServerSide": true,
+        "sAjaxSource": sourceUrl,
+        "aaSorting": [[sortColumn, direction]]
+    });
+}
@@ -0,0 +1,275 @@
+# Copyright (C) 2014 David Rusk
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+__author__ = "David Rusk <drusk@uvic.ca>"
+
+import heapq
+import itertools
+import logging
+import os
+import socket
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def default_worker_id():
+    """
+    Identifies this process among all of the workers sharing a queue.
+    """
+    return "{}:{}".format(socket.gethostname(), os.getpid())
+
+
+class MongoWorkQueue(object):
+    """
+    A work queue kept in the database instead of in memory, so that a crawl
+    which is interrupted part way through can be resumed.  Each job is
+    leased to the worker processing it; if the worker never finishes it,
+    the lease expires and the job is handed out again.
+
+    Workers in several processes, possibly on different hosts, can share
+    the same queue.  While a worker is processing jobs it periodically
+    renews their leases and records a heartbeat.
+
+    Provides the parts of Queue.Queue's interface used by the pipeline's
+    worker threads.  A task taken with get is marked done by task_done, or
+    returned to the queue by putting it back before calling task_done.  A
+    task which is given up on is marked failed by task_failed instead.
+
+    A task put back with a not_before time isn't leased again until then,
+    so it doesn't need a RetryTimer.
+    """
+
+    DEFAULT_LEASE_SECONDS = 600
+    DEFAULT_POLL_INTERVAL = 1
+
+    def __init__(self, db, to_document, from_document,
+                 lease_seconds=DEFAULT_LEASE_SECONDS,
+                 poll_interval=DEFAULT_POLL_INTERVAL, worker_id=None,
+                 priority_function=None):
+        """
+        Constructor.
+
+        Args:
+          db: osstrends.database.MongoDatabase
+          to_document: function
+            Converts a task to a dict to be stored in the database.  The
+            dict's "_id" must identify the work being done so that the
+            same work is never queued twice.
+          from_document: function
+            Converts a stored dict back into a task.
+          lease_seconds: int
+            How long a worker has to finish a job before it is given to
+            another worker.
+          poll_interval: float
+            Seconds to wait before checking the database again when there
+            is no work available.
+          worker_id: str
+            Identifies this worker process to the others sharing the
+            queue.  Defaults to the host name and process id.
+          priority_function: function
+            If provided, scores each task's urgency when it is queued, and
+            the most urgent jobs are leased first.  Otherwise jobs are
+            leased in no particular order.
+        """
+        self.db = db
+        self.to_document = to_document
+        self.from_document = from_document
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.worker_id = worker_id if worker_id is not None else \
+            default_worker_id()
+        self.priority_function = priority_function
+
+        # The job each worker thread is currently processing.
+        self._local = threading.local()
+
+        # The jobs held by all of this process's threads, whose leases are
+        # renewed by the heartbeat thread.
+        self._held_job_ids = set()
+        self._held_job_ids_lock = threading.Lock()
+        self._heartbeat_thread = None
+
+    def put(self, task):
+        job_id = getattr(task, "job_id", None)
+
+        if job_id is not None and job_id == getattr(self._local, "job_id",
+                                                    None):
+            # The current job is being retried.
+            self.db.release_job(job_id, getattr(task, "attempts", 0),
+                                getattr(task, "not_before", None))
+            self._finish_current_job()
+        else:
+            document = self.to_document(task)
+
+            if self.priority_function is not None:
+                document["priority"] = self.priority_function(task)
+
+            self.db.insert_job(document)
+
+    def get(self):
+        """
+        Leases the next available job, waiting until there is one.
+        """
+        self._start_heartbeat()
+
+        while True:
+            job = self.db.lease_job(self.lease_seconds, self.worker_id,
+                                    self.priority_function is not None)
+
+            if job is not None:
+                task = self.from_document(job)
+                task.job_id = job["_id"]
+                task.attempts = job.get("attempts", 0)
+
+                self._local.job_id = task.job_id
+                with self._held_job_ids_lock:
+                    self._held_job_ids.add(task.job_id)
+
+                return task
+
+            time.sleep(self.poll_interval)
+
+    def task_done(self):
+        job_id = getattr(self._local, "job_id", None)
+
+        if job_id is not None:
+            self.db.complete_job(job_id)
+            self._finish_current_job()
+
+    def task_failed(self):
+        """
+        Like task_done, but records that the job was given up on.
+        """
+        job_id = getattr(self._local, "job_id", None)
+
+        if job_id is not None:
+            self.db.fail_job(job_id)
+            self._finish_current_job()
+
+    def _finish_current_job(self):
+        with self._held_job_ids_lock:
+            self._held_job_ids.discard(self._local.job_id)
+
+        self._local.job_id = None
+
+    def _start_heartbeat(self):
+        with self._held_job_ids_lock:
+            if self._heartbeat_thread is not None:
+                return
+
+            self._heartbeat_thread = threading.Thread(target=self._heartbeat)
+            self._heartbeat_thread.daemon = True
+            self._heartbeat_thread.start()
+
+    def _heartbeat(self):
+        # Renew well before the leases expire.
+        interval = self.lease_seconds / 3.0
+
+        while True:
+            self.send_heartbeat()
+            time.sleep(interval)
+
+    def send_heartbeat(self):
+        """
+        Records that this worker is alive and extends the leases on the
+        jobs it is processing.
+        """
+        with self._held_job_ids_lock:
+            job_ids = list(self._held_job_ids)
+
+        try:
+            self.db.record_worker_heartbeat(self.worker_id)
+
+            if job_ids:
+                self.db.renew_leases(job_ids, self.worker_id,
+                                     self.lease_seconds)
+        except Exception as error:
+            # Try again at the next heartbeat.  If the database stays
+            # unreachable the leases expire and other workers take over.
+            logger.error("Heartbeat failed: {}".format(error))
+
+    def join(self):
+        """
+        Waits until every job in the queue has been completed.
+        """
+        while self.db.count_jobs([self.db.JOB_PENDING,
+                                  self.db.JOB_LEASED]) > 0:
+            time.sleep(self.poll_interval)
+
+    def qsize(self):
+        return self.db.count_jobs([self.db.JOB_PENDING])
+
+
+class RetryTimer(object):
+    """
+    Holds back tasks which are to be retried until their not_before time,
+    then puts them back on an in-memory work queue (e.g. Queue.Queue).  The
+    worker threads which failed them can carry on with other tasks in the
+    meantime instead of sleeping.
+    """
+
+    def __init__(self, work_queue):
+        self.work_queue = work_queue
+
+        # (not_before, counter, task), soonest first.  The counter breaks
+        # ties without comparing the tasks themselves.
+        self._waiting = []
+        self._counter = itertools.count()
+
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def put(self, task):
+        """
+        Puts back a task taken from the work queue once its not_before time
+        has passed.  Replaces both putting the task back and calling
+        task_done, so the task still counts as unfinished while it waits.
+        """
+        with self._condition:
+            heapq.heappush(self._waiting, (task.not_before,
+                                           next(self._counter), task))
+
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    if not self._waiting:
+                        self._condition.wait()
+                        continue
+
+                    delay = self._waiting[0][0] - time.time()
+                    if delay <= 0:
+                        break
+
+                    self._condition.wait(delay)
+
+                _, _, task = heapq.heappop(self._waiting)
+
+            self.work_queue.put(task)
+            self.work_queue.task_done()
@@ -0,0 +1,220 @@
+# Copyright (C) 2014 David Rusk
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+__author__ = "David Rusk <drusk@uvic.ca>"
+
+import logging
+import threading
+import time
+
+from osstrends.database import MongoDatabase
+
+logger = logging.getLogger(__name__)
+
+
+class UserWriteBuffer(object):
+    """
+    Collects writes to users and saves them to the database in bulk from a
+    background thread (write-behind), so the threads making the writes
+    don't wait for the database.  Writes to the same user which are
+    waiting together are merged into a single update.
+
+    Provides the user writing methods of MongoDatabase, plus get_user, so
+    it can be used in place of the database for them.
+
+    Writes are saved once enough are waiting or the oldest has waited long
+    enough.  close must be called once writing is done to save the rest;
+    if the process dies first, the writes still waiting are lost.
+    """
+
+    DEFAULT_MAX_SIZE = 500
+    DEFAULT_MAX_AGE = 5
+
+    def __init__(self, db, max_size=DEFAULT_MAX_SIZE,
+                 max_age=DEFAULT_MAX_AGE):
+        """
+        Constructor.
+
+        Args:
+          db: osstrends.database.MongoDatabase
+          max_size: int
+            Writes are saved once this many users have writes waiting.
+          max_age: float
+            Writes are saved once the oldest has waited this many seconds.
+        """
+        self.db = db
+        self.max_size = max_size
+        self.max_age = max_age
+
+        # Keyed by userid, in the format taken by
+        # MongoDatabase.bulk_update_users.
+        self._pending = {}
+        self._oldest_write_time = None
+
+        self._closed = False
+        self._flusher = None
+        self._condition = threading.Condition()
+
+    def insert_user(self, user, normalized_location):
+        fields = dict(user)
+        fields.pop(MongoDatabase.NORMALIZED_LOCATION_KEY, None)
+        fields[MongoDatabase.FETCHED_AT_KEY] = time.time()
+
+        self._add(fields[MongoDatabase.USERID_KEY], fields,
+                  normalized_location)
+
+    def touch_user(self, userid, normalized_location):
+        self._add(userid, {MongoDatabase.FETCHED_AT_KEY: time.time()},
+                  normalized_location)
+
+    def add_user_location(self, userid, normalized_location):
+        self._add(userid, {}, normalized_location)
+
+    def insert_user_language_stats(self, userid, language_stats):
+        self._add(userid,
+                  MongoDatabase.language_stats_fields(language_stats))
+
+    def get_user(self, userid, fields=None):
+        """
+        Looks up a user as they will be once the waiting writes are saved.
+        The waiting writes are applied in full, so the user may have more
+        than the requested fields.
+        """
+        user = self.db.get_user(userid, fields=fields)
+
+        with self._condition:
+            update = self._pending.get(userid)
+
+            if update is None:
+                return user
+
+            user = dict(user) if user is not None else {
+                MongoDatabase.USERID_KEY: userid}
+            user.update(update["fields"])
+
+            locations = list(user.get(MongoDatabase.NORMALIZED_LOCATION_KEY,
+                                      []))
+            for location in update["locations"]:
+                if location not in locations:
+                    locations.append(location)
+            user[MongoDatabase.NORMALIZED_LOCATION_KEY] = locations
+
+            return user
+
+    def _add(self, userid, fields, normalized_location=None):
+        with self._condition:
+            if self._closed:
+                raise ValueError("Write buffer has been closed.")
+
+            update = self._pending.setdefault(userid, {"fields": {},
+                                                       "locations": set()})
+            update["fields"].update(fields)
+            if normalized_location is not None:
+                update["locations"].add(normalized_location)
+
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._run)
+                self._flusher.daemon = True
+                self._flusher.start()
+
+            if self._oldest_write_time is None:
+                self._oldest_write_time = time.time()
+                # The flusher waits without a timeout while nothing is
+                # waiting, so it must be woken to start timing this write.
+                self._condition.notify()
+            elif len(self._pending) >= self.max_size:
+                self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._closed and not self._is_due():
+                    if self._oldest_write_time is None:
+                        self._condition.wait()
+                    else:
+                        self._condition.wait(max(
+                            self._oldest_write_time + self.max_age -
+                            time.time(), 0))
+
+                if self._closed:
+                    return
+
+            self.flush()
+
+    def _is_due(self):
+        if self._oldest_write_time is None:
+            return False
+
+        return (len(self._pending) >= self.max_size or
+                time.time() - self._oldest_write_time >= self.max_age)
+
+    def flush(self):
+        """
+        Saves all of the waiting writes now.  If saving fails the writes
+        are kept to be tried again.
+        """
+        with self._condition:
+            updates = self._pending
+            self._pending = {}
+            self._oldest_write_time = None
+
+        try:
+            self.db.bulk_update_users(updates)
+        except Exception as error:
+            logger.error("Failed to save {} users, will retry: {}".format(
+                len(updates), error))
+            self._restore(updates)
+            return
+
+        logger.debug("Saved {} users".format(len(updates)))
+
+    def _restore(self, updates):
+        with self._condition:
+            for userid, update in updates.iteritems():
+                newer_update = self._pending.get(userid)
+
+                if newer_update is not None:
+                    # Writes made since the failure take precedence.
+                    update["fields"].update(newer_update["fields"])
+                    update["locations"].update(newer_update["locations"])
+
+                self._pending[userid] = update
+
+            if self._pending and self._oldest_write_time is None:
+                self._oldest_write_time = time.time()
+                self._condition.notify()
+
+    def close(self):
+        """
+        Saves the remaining writes and stops the background thread.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+            flusher = self._flusher
+
+        if flusher is not None:
+            flusher.join()
+
+        self.flush()
+
+        if self._pending:
+            logger.error("Lost writes to {} users".format(
+                len(self._pending)))
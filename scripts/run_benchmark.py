@@ -0,0 +1,128 @@
+# Copyright (C) 2013 David Rusk
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+__author__ = "David Rusk <drusk@uvic.ca>"
+
+import argparse
+
+from osstrends import benchmark
+from osstrends.cache import RepoLanguageCache, ResponseCache
+from osstrends.database import MongoDatabase
+from osstrends.fakegithub import FakeGitHub
+
+BENCHMARK_DB_NAME = "osstrends_benchmark"
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measures the data pipeline's throughput against a "
+                    "local fake of the GitHub API.  Users are saved to "
+                    "the '%s' database, which is cleared before each "
+                    "run." % BENCHMARK_DB_NAME)
+    parser.add_argument("--locations", type=int, default=3,
+                        help="The number of locations to crawl.")
+    parser.add_argument("--users", type=int, default=200,
+                        help="The number of users in each location.")
+    parser.add_argument("--repos", type=int, default=5,
+                        help="The number of repositories each user has.")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="Seconds the fake API takes to answer.")
+    parser.add_argument("--jitter", type=float, default=0.05,
+                        help="Up to this many seconds are added to each "
+                             "answer at random.")
+    parser.add_argument("--error-rate", type=float, default=0,
+                        help="The fraction of requests which fail.")
+    parser.add_argument("--rate-limit", type=int,
+                        help="Requests allowed per credentials per hour.  "
+                             "Unlimited by default.")
+    parser.add_argument("--credentials", type=int, default=1,
+                        help="The number of credentials to use.")
+    parser.add_argument("--threads", type=int, nargs="+", default=[10],
+                        help="The numbers of worker threads to compare.")
+    parser.add_argument("--autoscale", action="store_true",
+                        help="Adjust the number of threads while running, "
+                             "starting from each --threads value.")
+    parser.add_argument("--cache", action="store_true",
+                        help="Cache responses and language statistics.  "
+                             "The caches are kept between runs of the "
+                             "same thread count.")
+    parser.add_argument("--resolve-fork-sources", action="store_true",
+                        help="Look up which repositories unchanged forks "
+                             "were created from, to share their cached "
+                             "language statistics.")
+    parser.add_argument("--write-behind", action="store_true",
+                        help="Save users in bulk from a background thread.")
+    parser.add_argument("--runs", type=int, default=1,
+                        help="The number of runs of each thread count.")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Makes the generated data, latencies and "
+                             "errors repeatable.")
+    args = parser.parse_args()
+
+    search_terms = ["Location{}".format(index)
+                    for index in xrange(args.locations)]
+
+    fake_github = FakeGitHub(latency=args.latency,
+                             latency_jitter=args.jitter,
+                             error_rate=args.error_rate,
+                             rate_limit=args.rate_limit,
+                             seed=args.seed)
+    fake_github.generate(search_terms, args.users, args.repos)
+
+    db = MongoDatabase(db_name=BENCHMARK_DB_NAME)
+
+    print "{:>8} {:>4} {:>6} {:>9} {:>8} {:>10} {:>10}".format(
+        "threads", "run", "users", "api calls", "seconds", "users/sec",
+        "calls/user")
+
+    with fake_github:
+        for num_threads in args.threads:
+            cache = None
+            language_cache = None
+            if args.cache:
+                cache = ResponseCache()
+                language_cache = RepoLanguageCache()
+
+            for run in xrange(1, args.runs + 1):
+                db.delete_users()
+
+                results = benchmark.run_benchmark(
+                    db, fake_github,
+                    benchmark.benchmark_locations(search_terms),
+                    num_threads=num_threads,
+                    autoscale=args.autoscale,
+                    num_credentials=args.credentials,
+                    cache=cache,
+                    language_cache=language_cache,
+                    resolve_fork_sources=args.resolve_fork_sources,
+                    write_behind=args.write_behind)
+
+                print ("{:>8} {:>4} {:>6} {:>9} {:>8.1f} {:>10.2f} "
+                       "{:>10.2f}".format(num_threads, run,
+                                          results["users"],
+                                          results["api_calls"],
+                                          results["seconds"],
+                                          results["users_per_second"],
+                                          results["api_calls_per_user"]
+                                          or 0))
+
+
+if __name__ == "__main__":
+    main()
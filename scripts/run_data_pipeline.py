@@ -20,7 +20,9 @@
 
 __author__ = "David Rusk <drusk@uvic.ca>"
 
+import argparse
 import logging
+import multiprocessing
 import os
 import time
 
@@ -32,7 +34,86 @@ def current_dir():
 
 
 def main():
-    logname = "datapipeline.log"
+    parser = argparse.ArgumentParser(
+        description="Retrieves the application's data from GitHub.")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue the last run from where it stopped "
+                             "instead of starting over.")
+    parser.add_argument("--coordinator", action="store_true",
+                        help="Queue the crawl's work for worker processes "
+                             "and wait for them to finish it.")
+    parser.add_argument("--worker", action="store_true",
+                        help="Process work queued by a coordinator, which "
+                             "may be running on another host.")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="The number of worker processes to start "
+                             "with --worker.")
+    parser.add_argument("--replay-dead-letters", action="store_true",
+                        help="Try the tasks that were given up on in "
+                             "previous runs again.")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Refresh the data saved by previous runs, "
+                             "skipping repositories which haven't "
+                             "changed.")
+    parser.add_argument("--prioritize", action="store_true",
+                        help="Refresh the users whose data is most likely "
+                             "to be out of date first, instead of in the "
+                             "order they are found.")
+    parser.add_argument("--write-behind", action="store_true",
+                        help="Save users to the database in bulk in the "
+                             "background.  Faster, but a crash loses the "
+                             "last few seconds of writes.")
+    parser.add_argument("--metrics-file",
+                        help="Write the crawl's metrics to this file in "
+                             "Prometheus' text format while it runs.  Each "
+                             "worker process writes its own file, numbered "
+                             "before the extension.")
+    parser.add_argument("--metrics-port", type=int,
+                        help="Serve the crawl's metrics for Prometheus at "
+                             "/metrics on this port.  Each worker process "
+                             "uses the next port up.")
+    parser.add_argument("--record",
+                        help="Write every API request and response to this "
+                             "gzip compressed file.  Not supported with "
+                             "--worker.")
+    parser.add_argument("--replay",
+                        help="Serve the API traffic recorded in this file "
+                             "back instead of sending requests to GitHub.")
+    parser.add_argument("--replay-latency", action="store_true",
+                        help="Make replayed responses take as long as they "
+                             "did when they were recorded.")
+    parser.add_argument("--fixed-threads", action="store_true",
+                        help="Keep the number of worker threads fixed "
+                             "instead of adjusting it to the API's latency "
+                             "and rate limit.")
+    parser.add_argument("--slim-users", nargs="?", metavar="FIELDS",
+                        const=",".join(pipeline.DEFAULT_USER_FIELDS),
+                        help="Save only these comma separated fields of "
+                             "each user's details instead of all of them.  "
+                             "Defaults to the fields the web application "
+                             "shows.")
+    parser.add_argument("--resolve-fork-sources", action="store_true",
+                        help="Look up which repositories unchanged forks "
+                             "were created from, so forks of the same "
+                             "project share cached language statistics.  "
+                             "Costs a request per new fork.")
+    parser.add_argument("--rebuild-location-stats", action="store_true",
+                        help="Recompute the locations' language statistics "
+                             "from the saved users instead of crawling, "
+                             "e.g. periodically from cron.")
+    args = parser.parse_args()
+
+    user_fields = None
+    if args.slim_users is not None:
+        user_fields = args.slim_users.split(",")
+
+    if args.coordinator:
+        logname = "coordinator.log"
+    elif args.worker:
+        logname = "worker.log"
+    else:
+        logname = "datapipeline.log"
+
     dir = current_dir()
     fullpath = os.path.join(dir, logname)
 
@@ -42,9 +123,66 @@ def main():
                   os.path.join(dir, "%s.%d" % (logname, int(time.time()))))
 
     logging.basicConfig(filename=logname, level=logging.INFO,
-                        format="%(levelname)s %(asctime)-15s %(message)s")
+                        format="%(levelname)s %(asctime)-15s %(process)d "
+                               "%(message)s")
+
+    if args.rebuild_location_stats:
+        pipeline.rebuild_location_stats()
+    elif args.coordinator:
+        pipeline.coordinate(resume=args.resume,
+                            replay_dead_letters=args.replay_dead_letters,
+                            prioritize=args.prioritize)
+    elif args.worker:
+        # Cache files can't be shared between processes, so workers only
+        # cache in memory.
+        processes = []
+        for index in xrange(args.processes):
+            metrics_filename = None
+            if args.metrics_file is not None:
+                # e.g. crawl.0.prom, since node_exporter only reads files
+                # ending in .prom
+                root, extension = os.path.splitext(args.metrics_file)
+                metrics_filename = "{}.{}{}".format(root, index, extension)
+
+            metrics_port = None
+            if args.metrics_port is not None:
+                metrics_port = args.metrics_port + index
+
+            processes.append(multiprocessing.Process(
+                target=pipeline.work,
+                kwargs={"autoscale": not args.fixed_threads,
+                        "incremental": args.incremental,
+                        "prioritize": args.prioritize,
+                        "write_behind": args.write_behind,
+                        "metrics_filename": metrics_filename,
+                        "metrics_port": metrics_port,
+                        "metrics_labels": {"worker": index},
+                        "user_fields": user_fields,
+                        "resolve_fork_sources": args.resolve_fork_sources}))
+
+        for process in processes:
+            process.start()
 
-    pipeline.execute()
+        for process in processes:
+            process.join()
+    else:
+        pipeline.execute(
+            cache_filename=os.path.join(dir, "response_cache.json"),
+            language_cache_filename=os.path.join(dir, "language_cache.json"),
+            durable=True,
+            resume=args.resume,
+            autoscale=not args.fixed_threads,
+            replay_dead_letters=args.replay_dead_letters,
+            incremental=args.incremental,
+            prioritize=args.prioritize,
+            write_behind=args.write_behind,
+            metrics_filename=args.metrics_file,
+            metrics_port=args.metrics_port,
+            record_filename=args.record,
+            replay_filename=args.replay,
+            replay_latency=args.replay_latency,
+            user_fields=user_fields,
+            resolve_fork_sources=args.resolve_fork_sources)
 
 
 if __name__ == "__main__":
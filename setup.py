@@ -49,5 +49,5 @@ setup(
     include_package_data=True,  # Include data specified in MANIFEST.in
     zip_safe=False,
     install_requires=parse_requirements(),
-    scripts=["scripts/run_data_pipeline.py"]
+    scripts=["scripts/run_data_pipeline.py", "scripts/run_benchmark.py"]
 )
@@ -0,0 +1,87 @@
+# Copyright (C) 2014 David Rusk
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+__author__ = "David Rusk <drusk@uvic.ca>"
+
+import unittest
+
+from hamcrest import assert_that, close_to, equal_to
+from mock import Mock
+
+from osstrends.benchmark import benchmark_locations, run_benchmark
+from osstrends.cache import RepoLanguageCache
+from osstrends.database import MongoDatabase
+from osstrends.fakegithub import FakeGitHub
+
+
+class BenchmarkTest(unittest.TestCase):
+    def test_run_benchmark(self):
+        db = Mock(spec=MongoDatabase)
+        db.verify_location_stats.return_value = []
+        db.remove_duplicate_users.return_value = 0
+        search_terms = ["Victoria", "Vancouver"]
+
+        with FakeGitHub(seed=0) as fake_github:
+            fake_github.generate(search_terms, 5, 2)
+
+            results = run_benchmark(db, fake_github,
+                                    benchmark_locations(search_terms),
+                                    num_threads=2)
+
+        assert_that(results["users"], equal_to(10))
+        assert_that(db.insert_user_language_stats.call_count, equal_to(10))
+
+        # A search for each location, then the details, repositories and
+        # each repository's languages for each user.
+        assert_that(results["api_calls"], equal_to(2 + 10 * 4))
+        assert_that(results["api_calls_per_user"], close_to(4.2, 0.001))
+        assert_that(results["api_calls_by_endpoint"]["repo_languages"],
+                    equal_to(20))
+
+    def test_language_cache_saves_requests(self):
+        db = Mock(spec=MongoDatabase)
+        db.verify_location_stats.return_value = []
+        db.remove_duplicate_users.return_value = 0
+        search_terms = ["Victoria", "Vancouver"]
+
+        with FakeGitHub(seed=0) as fake_github:
+            fake_github.generate(search_terms, 10, 4, fork_fraction=0.5)
+            locations = benchmark_locations(search_terms)
+
+            uncached = run_benchmark(db, fake_github, locations,
+                                     num_threads=2)
+
+            language_cache = RepoLanguageCache()
+            cold = run_benchmark(db, fake_github, locations, num_threads=2,
+                                 language_cache=language_cache)
+            warm = run_benchmark(db, fake_github, locations, num_threads=2,
+                                 language_cache=language_cache)
+
+        # An empty cache costs nothing extra, and a warm one saves every
+        # language lookup.
+        assert_that(cold["api_calls"], equal_to(uncached["api_calls"]))
+        assert_that(warm["api_calls"],
+                    equal_to(uncached["api_calls"] -
+                             uncached["api_calls_by_endpoint"]
+                             ["repo_languages"]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+# Copyright (C) 2013 David Rusk
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+__author__ = "David Rusk <drusk@uvic.ca>"
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from hamcrest import assert_that, equal_to, has_length, none
+import requests
+
+from osstrends.cache import RepoLanguageCache, ResponseCache
+
+
+class ResponseCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def create_response(self, body, etag='"abc"'):
+        response = requests.Response()
+        response.status_code = 200
+        response._content = body
+        if etag is not None:
+            response.headers["ETag"] = etag
+
+        return response
+
+    def test_validators_for_cached_url(self):
+        cache = ResponseCache()
+        assert_that(cache.get_validators("url1"), equal_to({}))
+
+        cache.store("url1", self.create_response('{"a": 1}'))
+
+        assert_that(cache.get_validators("url1"),
+                    equal_to({"If-None-Match": '"abc"'}))
+
+    def test_hits_and_misses(self):
+        cache = ResponseCache()
+
+        cache.store("url1", self.create_response('{"a": 1}'))
+        response = cache.get_response("url1")
+
+        assert_that(response.json(), equal_to({"a": 1}))
+        assert_that(response.headers["ETag"], equal_to('"abc"'))
+        assert_that(cache.get_response("url2"), none())
+        assert_that(cache.hits, equal_to(1))
+        assert_that(cache.misses, equal_to(2))
+
+    def test_responses_without_validators_not_cached(self):
+        cache = ResponseCache()
+
+        cache.store("url1", self.create_response('{"a": 1}', etag=None))
+
+        assert_that(cache, has_length(0))
+
+    def test_least_recently_used_evicted(self):
+        # Each response is 10 bytes, counting the ETag header.
+        cache = ResponseCache(max_bytes=25)
+
+        cache.store("url1", self.create_response("1"))
+        cache.store("url2", self.create_response("2"))
+        cache.get_response("url1")
+        cache.store("url3", self.create_response("3"))
+
+        assert_that(cache, has_length(2))
+        assert_that(cache.num_bytes, equal_to(20))
+        assert_that(cache.get_validators("url2"), equal_to({}))
+        assert_that(cache.get_response("url1").content, equal_to("1"))
+
+    def test_evicted_by_size(self):
+        cache = ResponseCache(max_bytes=25)
+
+        cache.store("url1", self.create_response("1"))
+        cache.store("url2", self.create_response("2"))
+        cache.store("url3", self.create_response("3" * 15))
+
+        assert_that(cache, has_length(1))
+        assert_that(cache.num_bytes, equal_to(24))
+
+        # Too big to be cached at all.
+        cache.store("url4", self.create_response("4" * 20))
+        assert_that(cache.get_validators("url4"), equal_to({}))
+        assert_that(cache.get_response("url3").content,
+                    equal_to("3" * 15))
+
+    def test_replaced_response_not_counted_twice(self):
+        cache = ResponseCache()
+
+        cache.store("url1", self.create_response("1"))
+        cache.store("url1", self.create_response("12"))
+
+        assert_that(cache.num_bytes, equal_to(11))
+
+    def test_save_and_load(self):
+        filename = os.path.join(self.tempdir, "cache.json")
+
+        cache = ResponseCache(filename)
+        cache.store("url1", self.create_response('{"a": 1}'))
+        cache.save()
+
+        loaded_cache = ResponseCache(filename)
+        assert_that(loaded_cache.get_response("url1").json(),
+                    equal_to({"a": 1}))
+
+
+class RepoLanguageCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_stats_keyed_by_name_and_push_time(self):
+        cache = RepoLanguageCache()
+        cache.put("drusk/pml", "2013-08-12T03:56:48Z", {"Python": 100})
+
+        assert_that(cache.get("drusk/pml", "2013-08-12T03:56:48Z"),
+                    equal_to({"Python": 100}))
+        assert_that(cache.get("drusk/pml", "2013-09-01T00:00:00Z"), none())
+        assert_that(cache.hits, equal_to(1))
+        assert_that(cache.misses, equal_to(1))
+
+    def test_least_recently_used_evicted(self):
+        cache = RepoLanguageCache(max_entries=1)
+        cache.put("drusk/pml", "t1", {"Python": 100})
+        cache.put("drusk/algorithms", "t1", {"Java": 100})
+
+        assert_that(cache, has_length(1))
+        assert_that(cache.get("drusk/pml", "t1"), none())
+
+    def test_save_and_load(self):
+        filename = os.path.join(self.tempdir, "languages.json")
+
+        cache = RepoLanguageCache(filename)
+        cache.put("ijiraq/MOP", "t1", {"Python": 100})
+        cache.set_source("drusk/MOP", "ijiraq/MOP")
+        cache.save()
+
+        loaded_cache = RepoLanguageCache(filename)
+        assert_that(loaded_cache.get_source("drusk/MOP"),
+                    equal_to("ijiraq/MOP"))
+        assert_that(loaded_cache.get("ijiraq/MOP", "t1"),
+                    equal_to({"Python": 100}))
+
+
+if __name__ == '__main__':
+    unittest.main()
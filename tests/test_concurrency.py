@@ -0,0 +1,96 @@
+# Copyright (C) 2013 David Rusk
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+__author__ = "David Rusk <drusk@uvic.ca>"
+import threading
+import unittest
+
+from hamcrest import assert_that, equal_to, none, close_to
+
+from osstrends.concurrency import (ConcurrencyController, ConcurrencyLimit,
+                                   MovingAverage)
+
+
+class MovingAverageTest(unittest.TestCase):
+    def test_average(self):
+        average = MovingAverage(weight=0.5)
+        assert_that(average.value(), none())
+
+        average.record(1)
+        average.record(3)
+
+        assert_that(average.value(), close_to(2, 0.001))
+
+
+class ConcurrencyLimitTest(unittest.TestCase):
+    def test_shrinking_holds_threads_back(self):
+        limit = ConcurrencyLimit(2)
+        limit.acquire()
+        limit.acquire()
+        limit.resize(1)
+
+        entered = threading.Event()
+
+        def enter():
+            with limit:
+                entered.set()
+
+        thread = threading.Thread(target=enter)
+        thread.daemon = True
+        thread.start()
+
+        limit.release()
+        assert_that(entered.wait(0.1), equal_to(False))
+
+        limit.release()
+        assert_that(entered.wait(1), equal_to(True))
+
+
+class ConcurrencyControllerTest(unittest.TestCase):
+    def setUp(self):
+        self.controller = ConcurrencyController(10, max_concurrency=20)
+
+    def test_grows_additively_with_backlog(self):
+        assert_that(self.controller.adjust(0.5, 100, None), equal_to(11))
+        assert_that(self.controller.adjust(0.5, 100, None), equal_to(12))
+
+    def test_shrinks_towards_queue_depth(self):
+        assert_that(self.controller.adjust(0.5, 0, None), equal_to(9))
+        assert_that(self.controller.adjust(0.5, 9, None), equal_to(9))
+
+    def test_backs_off_multiplicatively_when_latency_rises(self):
+        self.controller.adjust(0.5, 100, None)
+
+        assert_that(self.controller.adjust(2.0, 100, None), equal_to(8))
+
+    def test_capped_by_rate_limit_budget(self):
+        # 2 requests per second taking 1 second each need 2 in flight
+        assert_that(self.controller.adjust(1.0, 100, 2.0), equal_to(3))
+
+    def test_bounded(self):
+        controller = ConcurrencyController(20, max_concurrency=20)
+        assert_that(controller.adjust(0.5, 100, None), equal_to(20))
+
+        assert_that(controller.adjust(0.5, 0, 0.0), equal_to(1))
+
+
+if __name__ == '__main__':
+    unittest.main()
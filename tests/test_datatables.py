@@ -0,0 +1,122 @@
+# Copyright (C) 2014 David Rusk
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+__author__ = "David Rusk <drusk@uvic.ca>"
+
+import unittest
+
+from hamcrest import assert_that, equal_to
+from mock import Mock
+import pymongo
+
+from osstrends.database import MongoDatabase
+from osstrends.datatables import (MAX_PAGE_SIZE, TableRequest,
+                                  get_users_page)
+
+
+class TableRequestTest(unittest.TestCase):
+    def test_from_args(self):
+        request = TableRequest.from_args({
+            "sEcho": "3", "iDisplayStart": "20", "iDisplayLength": "10",
+            "iSortCol_0": "3", "sSortDir_0": "desc", "sSearch": " rusk "})
+
+        assert_that(request.echo, equal_to(3))
+        assert_that(request.start, equal_to(20))
+        assert_that(request.length, equal_to(10))
+        assert_that(request.sort_column, equal_to(3))
+        assert_that(request.ascending, equal_to(False))
+        assert_that(request.search, equal_to("rusk"))
+
+    def test_page_size_limited(self):
+        assert_that(TableRequest.from_args({"iDisplayLength": "-1"}).length,
+                    equal_to(MAX_PAGE_SIZE))
+        assert_that(TableRequest.from_args({"iDisplayLength": "5000"}).length,
+                    equal_to(MAX_PAGE_SIZE))
+
+    def test_invalid_args(self):
+        self.assertRaises(ValueError, TableRequest.from_args,
+                          {"iDisplayStart": "first"})
+
+    def test_response(self):
+        request = TableRequest(echo=3)
+
+        assert_that(request.response(100, 2, [["David Rusk"]]),
+                    equal_to({"sEcho": 3,
+                              "iTotalRecords": 100,
+                              "iTotalDisplayRecords": 2,
+                              "aaData": [["David Rusk"]]}))
+
+
+class GetUsersPageTest(unittest.TestCase):
+    def setUp(self):
+        self.db = Mock(spec=MongoDatabase)
+        self.db.count_users.return_value = 100
+        self.db.get_users.return_value = [{"login": "drusk"}]
+
+    def test_page_of_location(self):
+        request = TableRequest(start=20, length=10)
+
+        num_total, num_filtered, users = get_users_page(self.db, request,
+                                                        "victoria")
+
+        assert_that(num_total, equal_to(100))
+        assert_that(num_filtered, equal_to(100))
+        assert_that(users, equal_to([{"login": "drusk"}]))
+        self.db.count_users.assert_called_once_with(location="victoria",
+                                                    language=None)
+        self.db.get_users.assert_called_once_with(
+            location="victoria", language=None,
+            fields=["name", "login", "company", "total_code_size"],
+            search="", sort=[("name", pymongo.ASCENDING),
+                             ("login", pymongo.ASCENDING)],
+            skip=20, limit=10)
+
+    def test_page_of_language_searched(self):
+        request = TableRequest(sort_column=3, ascending=False,
+                               search="rusk")
+        self.db.count_users.side_effect = [100, 2]
+
+        num_total, num_filtered, _ = get_users_page(self.db, request,
+                                                    "victoria", "Python")
+
+        assert_that(num_total, equal_to(100))
+        assert_that(num_filtered, equal_to(2))
+        self.db.get_users.assert_called_once_with(
+            location="victoria", language="Python",
+            fields=["name", "login", "company", "languages.Python"],
+            search="rusk", sort=[("languages.Python", pymongo.DESCENDING),
+                                 ("login", pymongo.DESCENDING)],
+            skip=0, limit=10)
+
+    def test_sort_by_login(self):
+        get_users_page(self.db, TableRequest(sort_column=1), "victoria")
+
+        assert_that(self.db.get_users.call_args[1]["sort"],
+                    equal_to([("login", pymongo.ASCENDING)]))
+
+    def test_invalid_sort_column(self):
+        get_users_page(self.db, TableRequest(sort_column=7), "victoria")
+
+        assert_that(self.db.get_users.call_args[1]["sort"][0],
+                    equal_to(("name", pymongo.ASCENDING)))
+
+
+if __name__ == '__main__':
+    unittest.main()
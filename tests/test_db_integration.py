@@ -21,6 +21,7 @@
 __author__ = "David Rusk <drusk@uvic.ca>"
 
 import json
+import time
 import unittest
 
 from hamcrest import assert_that, equal_to, has_length, contains_inanyorder
@@ -33,6 +34,29 @@ from tests import testutil
 TEST_DB_NAME = "test-osstrends"
 
 
+def index_used(explanation):
+    """
+    Finds the name of the index a query used from its explain plan, in
+    either the format of MongoDB 2.x or of 3.0 and later.  Returns None if
+    the query scanned the whole collection.
+    """
+    if "cursor" in explanation:
+        cursor = explanation["cursor"]
+        if cursor.startswith("BtreeCursor "):
+            return cursor.split()[1]
+
+        return None
+
+    stage = explanation["queryPlanner"]["winningPlan"]
+    while stage is not None:
+        if stage["stage"] == "IXSCAN":
+            return stage["indexName"]
+
+        stage = stage.get("inputStage")
+
+    return None
+
+
 class MongoDatabaseIntegrationTest(unittest.TestCase):
     def setUp(self):
         pymongo.MongoClient().drop_database(TEST_DB_NAME)
@@ -56,6 +80,75 @@ class MongoDatabaseIntegrationTest(unittest.TestCase):
         retrieved_users = self.db.get_users(location=location)
         assert_that(retrieved_users, has_length(554))
 
+    def test_bulk_update_users(self):
+        self.db.insert_user({"login": "drusk", "name": "David Rusk"},
+                            "victoria")
+
+        self.db.bulk_update_users({
+            "drusk": {"fields": {"languages": {"Python": 10},
+                                 "total_code_size": 10},
+                      "locations": {"vancouver"}},
+            "rrusk": {"fields": {"name": "Rob Rusk"},
+                      "locations": {"victoria"}}
+        })
+
+        drusk = self.db.get_user("drusk")
+        assert_that(drusk["name"], equal_to("David Rusk"))
+        assert_that(drusk["total_code_size"], equal_to(10))
+        assert_that(drusk["location_normalized"],
+                    equal_to(["victoria", "vancouver"]))
+        assert_that(self.db.get_users(location="victoria"), has_length(2))
+
+    def test_get_users_with_fields(self):
+        self.db.insert_user({"login": "drusk", "name": "David Rusk",
+                             "html_url": "https://github.com/drusk"},
+                            "victoria")
+
+        users = self.db.get_users(location="victoria", fields=["name"])
+        assert_that(users, has_length(1))
+        assert_that(users[0]["name"], equal_to("David Rusk"))
+        assert_that("html_url" in users[0], equal_to(False))
+
+        user = self.db.get_user("drusk", fields=["html_url"])
+        assert_that(user["html_url"], equal_to("https://github.com/drusk"))
+        assert_that("name" in user, equal_to(False))
+
+    def test_get_users_page(self):
+        for userid, name in [("drusk", "David Rusk"), ("rrusk", "Rob Rusk"),
+                             ("bill", "Bill"), ("bob", None)]:
+            self.db.insert_user({"login": userid, "name": name}, "victoria")
+
+        users = self.db.get_users(location="victoria",
+                                  sort=[("login", pymongo.ASCENDING)],
+                                  skip=1, limit=2)
+        assert_that([user["login"] for user in users],
+                    equal_to(["bob", "drusk"]))
+
+        users = self.db.get_users(location="victoria", search="RUSK")
+        assert_that([user["login"] for user in users],
+                    contains_inanyorder("drusk", "rrusk"))
+        assert_that(self.db.count_users(location="victoria", search="rusk"),
+                    equal_to(2))
+        assert_that(self.db.count_users(location="victoria"), equal_to(4))
+
+    def test_user_in_several_locations(self):
+        self.db.insert_user({"login": "drusk"}, "victoria")
+        self.db.insert_user({"login": "drusk"}, "vancouver")
+        self.db.add_user_location("drusk", "victoria")
+
+        assert_that(self.db.get_user("drusk")["location_normalized"],
+                    equal_to(["victoria", "vancouver"]))
+        assert_that(self.db.get_users(location="vancouver"), has_length(1))
+
+    def test_user_locations_converted_to_lists(self):
+        self.db._get_users_collection().insert(
+            {"login": "drusk", "location_normalized": "victoria"})
+
+        self.db.convert_user_locations_to_lists()
+
+        assert_that(self.db.get_user("drusk")["location_normalized"],
+                    equal_to(["victoria"]))
+
     def test_get_user(self):
         for user in json.loads(testutil.read("victoria_users.json")):
             self.db.insert_user(user, "victoria")
@@ -106,6 +199,25 @@ class MongoDatabaseIntegrationTest(unittest.TestCase):
         assert_that(self.db.get_user_language_stats(userid),
                     equal_to(language_stats))
 
+    def test_user_repo_stats(self):
+        self.db.set_user_repo_stats("drusk", "pml", "2013-08-01",
+                                    {"Python": 100})
+        self.db.set_user_repo_stats("drusk", "drusk.github.io", "2013-01-01",
+                                    {"CSS": 10})
+        self.db.set_user_repo_stats("drusk", "pml", "2013-08-02",
+                                    {"Python": 200})
+
+        assert_that(self.db.get_user_repo_stats("drusk"), equal_to({
+            "pml": {"pushed_at": "2013-08-02", "languages": {"Python": 200}},
+            "drusk.github.io": {"pushed_at": "2013-01-01",
+                                "languages": {"CSS": 10}}
+        }))
+
+        self.db.remove_user_repo_stats("drusk", ["drusk.github.io"])
+
+        assert_that(self.db.get_user_repo_stats("drusk").keys(),
+                    equal_to(["pml"]))
+
     def add_user(self, userid, normalized_location, language_stats):
         self.db.insert_user({"login": userid}, normalized_location)
         self.db.insert_user_language_stats(userid, language_stats)
@@ -166,6 +278,189 @@ class MongoDatabaseIntegrationTest(unittest.TestCase):
                         "C++": 2,
                     }))
 
+    def test_location_language_stats_skip_users_not_finished(self):
+        self.add_user("drusk", "victoria", {"Python": 10})
+        self.db.insert_user({"login": "rrusk"}, "victoria")
+
+        language_bytes, developer_count = self.db.get_location_language_stats(
+            "victoria")
+        assert_that(language_bytes, equal_to({"Python": 10}))
+        assert_that(developer_count, equal_to({"Python": 1}))
+
+    def test_language_stats_converted_to_lists(self):
+        self.db._get_users_collection().insert(
+            {"login": "drusk", "location_normalized": ["victoria"],
+             "languages": {"Python": 10, "C": 5}})
+
+        self.db.convert_language_stats_to_lists()
+
+        assert_that(self.db.get_user("drusk")["language_list"],
+                    equal_to([{"name": "C", "bytes": 5},
+                              {"name": "Python", "bytes": 10}]))
+        language_bytes, _ = self.db.get_location_language_stats("victoria")
+        assert_that(language_bytes, equal_to({"Python": 10, "C": 5}))
+
+    def test_location_stats_updated_with_user_language_stats(self):
+        self.add_user("drusk", "victoria", {"Python": 10, "C": 5})
+        self.add_user("rrusk", "victoria", {"Python": 20})
+        self.db.insert_user_language_stats("drusk",
+                                           {"Python": 15, "ASP.NET": 3})
+
+        language_bytes, developer_count = self.db.get_location_language_stats(
+            "victoria")
+        assert_that(language_bytes, equal_to({"Python": 35, "ASP.NET": 3}))
+        assert_that(developer_count, equal_to({"Python": 2, "ASP.NET": 1}))
+        assert_that(self.db.verify_location_stats(), equal_to([]))
+
+    def test_location_stats_updated_with_user_location(self):
+        self.add_user("drusk", "victoria", {"Python": 10})
+        self.db.insert_user({"login": "drusk"}, "vancouver")
+        self.db.touch_user("drusk", "seattle")
+
+        for location in ["victoria", "vancouver", "seattle"]:
+            language_bytes, developer_count = (
+                self.db.get_location_language_stats(location))
+            assert_that(language_bytes, equal_to({"Python": 10}))
+            assert_that(developer_count, equal_to({"Python": 1}))
+
+    def test_location_stats_updated_with_bulk_update(self):
+        self.add_user("drusk", "victoria", {"Python": 10})
+
+        self.db.bulk_update_users({
+            "drusk": {"fields": MongoDatabase.language_stats_fields(
+                {"Python": 5, "C": 2}),
+                "locations": {"vancouver"}},
+            "rrusk": {"fields": MongoDatabase.language_stats_fields(
+                {"C": 4}),
+                "locations": {"victoria"}}
+        })
+
+        language_bytes, developer_count = self.db.get_location_language_stats(
+            "victoria")
+        assert_that(language_bytes, equal_to({"Python": 5, "C": 6}))
+        assert_that(developer_count, equal_to({"Python": 1, "C": 2}))
+
+        language_bytes, _ = self.db.get_location_language_stats("vancouver")
+        assert_that(language_bytes, equal_to({"Python": 5, "C": 2}))
+        assert_that(self.db.verify_location_stats(), equal_to([]))
+
+    def test_location_stats_updated_for_applied_part_of_bulk_update(self):
+        self.add_user("drusk", "victoria", {"Python": 10})
+        # Saved by an old version, with a single location rather than a
+        # list, which can't be added to.
+        self.db._get_users_collection().insert(
+            {"login": "rrusk", "location_normalized": "vancouver"})
+
+        updates = {
+            "drusk": {"fields": MongoDatabase.language_stats_fields(
+                {"Python": 5}),
+                "locations": set()},
+            "rrusk": {"fields": MongoDatabase.language_stats_fields(
+                {"C": 4}),
+                "locations": {"victoria"}}
+        }
+        self.assertRaises(pymongo.errors.BulkWriteError,
+                          self.db.bulk_update_users, updates)
+
+        language_bytes, _ = self.db.get_location_language_stats("victoria")
+        assert_that(language_bytes, equal_to({"Python": 5}))
+
+        # Retrying doesn't count drusk's change twice.
+        updates.pop("rrusk")
+        self.db.bulk_update_users(updates)
+        language_bytes, _ = self.db.get_location_language_stats("victoria")
+        assert_that(language_bytes, equal_to({"Python": 5}))
+
+    def test_location_stats_rebuilt(self):
+        self.add_user("drusk", "victoria", {"Python": 10})
+        self.add_user("rrusk", "vancouver", {"C": 4})
+
+        # Written around the location statistics, e.g. before they existed
+        self.db._get_users_collection().update(
+            {"login": "drusk"},
+            {"$set": MongoDatabase.language_stats_fields({"Java": 7})})
+        self.db._get_users_collection().remove({"login": "rrusk"})
+
+        assert_that(self.db.verify_location_stats(),
+                    equal_to(["vancouver", "victoria"]))
+
+        self.db.rebuild_location_stats()
+
+        assert_that(self.db.verify_location_stats(), equal_to([]))
+        language_bytes, developer_count = self.db.get_location_language_stats(
+            "victoria")
+        assert_that(language_bytes, equal_to({"Java": 7}))
+        assert_that(developer_count, equal_to({"Java": 1}))
+        assert_that(self.db.get_location_language_stats("vancouver"),
+                    equal_to(({}, {})))
+
+    def test_user_queries_use_indexes(self):
+        self.add_user("drusk", "victoria", {"Python": 10})
+        self.add_user("rrusk", "vancouver", {"C": 4})
+        self.db.ensure_indexes()
+
+        users = self.db._get_users_collection()
+        assert_that(index_used(users.find({"login": "drusk"}).explain()),
+                    equal_to("login_1"))
+        assert_that(index_used(
+            users.find({"location_normalized": "victoria"}).explain()),
+            equal_to("location_normalized_1"))
+        assert_that(index_used(
+            users.find({"language_list.name": "Python"}).explain()),
+            equal_to("language_list.name_1"))
+
+    def test_job_queries_use_indexes(self):
+        self.db.ensure_indexes()
+        self.db.reset_crawl_state()
+        self.db.insert_job({"_id": "job1", "priority": 1})
+
+        jobs = self.db._get_jobs_collection()
+        assert_that(index_used(
+            jobs.find({"state": {"$in": ["pending", "leased"]}}).explain()),
+            equal_to("state_1_lease_expires_1"))
+        assert_that(index_used(
+            jobs.find({"state": "pending"}).sort(
+                "priority", pymongo.DESCENDING).explain()),
+            equal_to("state_1_priority_-1"))
+
+    def test_sorted_pages_use_indexes(self):
+        self.add_user("drusk", "victoria", {"Python": 10})
+        self.db.ensure_indexes()
+
+        users = self.db._get_users_collection()
+        explanation = users.find({"location_normalized": "victoria"}).sort(
+            [("total_code_size", pymongo.ASCENDING),
+             ("login", pymongo.ASCENDING)]).limit(10).explain()
+        assert_that(index_used(explanation),
+                    equal_to("location_normalized_1_total_code_size_-1_"
+                             "login_-1"))
+
+    def test_logins_unique(self):
+        self.db.ensure_indexes()
+        self.db.insert_user({"login": "drusk"}, "victoria")
+
+        self.assertRaises(pymongo.errors.DuplicateKeyError,
+                          self.db._get_users_collection().insert,
+                          {"login": "drusk"})
+
+    def test_duplicate_users_removed(self):
+        users = self.db._get_users_collection()
+        users.insert({"login": "drusk", "fetched_at": 1,
+                      "location_normalized": "victoria"})
+        users.insert({"login": "drusk", "fetched_at": 2, "name": "David",
+                      "location_normalized": ["vancouver"]})
+        users.insert({"login": "rrusk", "location_normalized": ["victoria"]})
+
+        assert_that(self.db.remove_duplicate_users(), equal_to(1))
+        self.db.ensure_indexes()
+
+        drusk = users.find({"login": "drusk"})
+        assert_that(drusk.count(), equal_to(1))
+        assert_that(drusk[0]["name"], equal_to("David"))
+        assert_that(drusk[0]["location_normalized"],
+                    equal_to(["vancouver", "victoria"]))
+        assert_that(self.db.remove_duplicate_users(), equal_to(0))
+
     def test_get_users_by_language(self):
         location1 = "Victoria, BC, Canada"
         location2 = "Vancouver, BC, Canada"
@@ -260,6 +555,155 @@ class MongoDatabaseIntegrationTest(unittest.TestCase):
         assert_that(userids,
                     contains_inanyorder("drusk", "rrusk", "bill", "bob"))
 
+    def test_jobs_leased_and_completed(self):
+        self.db.insert_job({"_id": "repos:drusk", "userid": "drusk"})
+        # Queueing the same work again doesn't duplicate it
+        self.db.insert_job({"_id": "repos:drusk", "userid": "drusk"})
+
+        job = self.db.lease_job(600)
+        assert_that(job["userid"], equal_to("drusk"))
+        assert_that(job["state"], equal_to(MongoDatabase.JOB_LEASED))
+        assert_that(self.db.lease_job(600), equal_to(None))
+
+        self.db.complete_job(job["_id"])
+        assert_that(self.db.count_jobs([MongoDatabase.JOB_DONE]),
+                    equal_to(1))
+        assert_that(self.db.count_jobs([MongoDatabase.JOB_PENDING,
+                                        MongoDatabase.JOB_LEASED]),
+                    equal_to(0))
+
+    def test_expired_lease_handed_out_again(self):
+        self.db.insert_job({"_id": "repos:drusk", "userid": "drusk"})
+
+        self.db.lease_job(-1)
+
+        assert_that(self.db.lease_job(600)["_id"], equal_to("repos:drusk"))
+
+    def test_released_jobs_available_again(self):
+        self.db.insert_job({"_id": "repos:drusk", "userid": "drusk"})
+        self.db.lease_job(600)
+
+        self.db.release_leased_jobs()
+
+        assert_that(self.db.lease_job(600)["_id"], equal_to("repos:drusk"))
+
+    def test_released_job_not_leased_before_retry_time(self):
+        self.db.insert_job({"_id": "repos:drusk", "userid": "drusk"})
+        job_id = self.db.lease_job(600)["_id"]
+
+        self.db.release_job(job_id, 1, time.time() + 600)
+        assert_that(self.db.lease_job(600), equal_to(None))
+
+        self.db._get_jobs_collection().update(
+            {"_id": job_id}, {"$set": {"not_before": time.time() - 1}})
+        assert_that(self.db.lease_job(600)["_id"], equal_to(job_id))
+
+    def test_completed_job_requeued(self):
+        self.db.insert_job({"_id": "repos:drusk", "userid": "drusk"})
+        self.db.complete_job(self.db.lease_job(600)["_id"])
+
+        self.db.insert_job({"_id": "repos:drusk", "userid": "drusk"})
+        assert_that(self.db.lease_job(600), equal_to(None))
+
+        self.db.requeue_job({"_id": "repos:drusk", "userid": "drusk"})
+        assert_that(self.db.lease_job(600)["_id"], equal_to("repos:drusk"))
+
+    def test_dead_letters(self):
+        job = {"_id": "user:deleted:victoria", "userid": "deleted"}
+        self.db.insert_dead_letter(job, "GitHubApiException: 404", 1)
+
+        dead_letters = self.db.get_dead_letters()
+        assert_that(dead_letters, has_length(1))
+        assert_that(dead_letters[0]["job"], equal_to(job))
+        assert_that(dead_letters[0]["attempts"], equal_to(1))
+
+        self.db.remove_dead_letter(dead_letters[0]["_id"])
+        assert_that(self.db.get_dead_letters(), has_length(0))
+
+    def test_jobs_leased_by_priority(self):
+        self.db.insert_job({"_id": "repos:drusk", "priority": 1})
+        self.db.insert_job({"_id": "repos:rrusk", "priority": 5})
+
+        assert_that(self.db.lease_job(600, by_priority=True)["_id"],
+                    equal_to("repos:rrusk"))
+
+    def test_user_refresh_info(self):
+        self.db.insert_user({"login": "drusk",
+                             "updated_at": "2013-08-01T00:00:00Z"},
+                            "victoria")
+        self.db.set_user_repo_stats("drusk", "pml", "2013-09-01T00:00:00Z",
+                                    {"Python": 100})
+
+        info = self.db.get_user_refresh_info()["drusk"]
+
+        assert_that(info["active_at"], equal_to("2013-09-01T00:00:00Z"))
+        assert_that(info["locations"], equal_to(["victoria"]))
+        assert_that(info["fetched_at"] is not None, equal_to(True))
+
+    def test_renewed_lease_not_handed_out_again(self):
+        self.db.insert_job({"_id": "repos:drusk", "userid": "drusk"})
+        self.db.lease_job(-1, "worker1")
+
+        self.db.renew_leases(["repos:drusk"], "worker1", 600)
+
+        assert_that(self.db.lease_job(600, "worker2"), equal_to(None))
+
+    def test_expired_leases_reclaimed(self):
+        self.db.insert_job({"_id": "repos:drusk", "userid": "drusk"})
+        self.db.insert_job({"_id": "repos:rrusk", "userid": "rrusk"})
+        self.db.lease_job(-1, "worker1")
+        self.db.lease_job(600, "worker1")
+
+        assert_that(self.db.reclaim_expired_jobs(), equal_to(1))
+        assert_that(self.db.count_jobs([MongoDatabase.JOB_PENDING]),
+                    equal_to(1))
+
+    def test_worker_heartbeats(self):
+        self.db.record_worker_heartbeat("host:1234")
+
+        assert_that(self.db.get_active_workers(60),
+                    equal_to(["host:1234"]))
+
+    def test_checkpoints(self):
+        assert_that(self.db.get_checkpoint("searched:victoria"),
+                    equal_to(None))
+
+        self.db.set_checkpoint("searched:victoria", True)
+
+        assert_that(self.db.get_checkpoint("searched:victoria"),
+                    equal_to(True))
+
+        self.db.reset_crawl_state()
+        assert_that(self.db.get_checkpoint("searched:victoria"),
+                    equal_to(None))
+
+    def test_language_aggregation(self):
+        assert_that(self.db.start_language_aggregation(
+            "drusk", ["pml", "algorithms"]), equal_to(True))
+        assert_that(self.db.start_language_aggregation(
+            "drusk", ["pml"]), equal_to(False))
+
+        assert_that(self.db.add_repo_language_stats(
+            "drusk", "pml", {"Python": 268346, "Shell": 5407}),
+            equal_to(None))
+        # Adding the same repository again has no effect
+        assert_that(self.db.add_repo_language_stats(
+            "drusk", "pml", {"Python": 268346, "Shell": 5407}),
+            equal_to(None))
+
+        assert_that(self.db.add_repo_language_stats(
+            "drusk", "algorithms", {"Java": 150390, "Python": 4713}),
+            equal_to({"Java": 150390, "Python": 273059, "Shell": 5407}))
+
+    def test_language_aggregation_with_dotted_language(self):
+        self.db.start_language_aggregation("drusk", ["site", "api"])
+
+        self.db.add_repo_language_stats("drusk", "site",
+                                        {"ASP.NET": 100, "C#": 10})
+        assert_that(self.db.add_repo_language_stats(
+            "drusk", "api", {"ASP.NET": 50}),
+            equal_to({"ASP.NET": 150, "C#": 10}))
+
     def test_default_admin_account(self):
         assert_that(self.db.is_admin_initialized(), equal_to(False))
 
@@ -0,0 +1,68 @@
+# Copyright (C) 2013 David Rusk
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+__author__ = "David Rusk <drusk@uvic.ca>"
+import json
+import unittest
+
+from hamcrest import assert_that, equal_to, less_than
+
+from osstrends.dedup import BloomFilter, SeenSet
+from tests import testutil
+
+
+class SeenSetTest(unittest.TestCase):
+    def test_add(self):
+        seen = SeenSet()
+
+        assert_that(seen.add("drusk"), equal_to(True))
+        assert_that(seen.add("drusk"), equal_to(False))
+        assert_that("drusk" in seen, equal_to(True))
+        assert_that(len(seen), equal_to(1))
+
+
+class BloomFilterTest(unittest.TestCase):
+    def setUp(self):
+        self.logins = [user["login"] for user in
+                       json.loads(testutil.read("victoria_users.json"))]
+
+    def test_no_false_negatives(self):
+        seen = BloomFilter(1000)
+
+        num_new = sum(1 for login in self.logins if seen.add(login))
+
+        assert_that(num_new, equal_to(554))
+        for login in self.logins:
+            assert_that(login in seen, equal_to(True))
+
+    def test_false_positive_rate(self):
+        seen = BloomFilter(1000, error_rate=0.01)
+        for i in xrange(1000):
+            seen.add("user{}".format(i))
+
+        false_positives = sum(1 for i in xrange(1000)
+                              if "other{}".format(i) in seen)
+
+        assert_that(false_positives, less_than(30))
+
+
+if __name__ == '__main__':
+    unittest.main()
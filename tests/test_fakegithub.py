@@ -0,0 +1,124 @@
+# Copyright (C) 2014 David Rusk
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+__author__ = "David Rusk <drusk@uvic.ca>"
+
+import json
+import unittest
+
+from hamcrest import assert_that, equal_to, has_length
+
+from osstrends.cache import ResponseCache
+from osstrends.fakegithub import FakeGitHub
+from osstrends.github import GitHubApiException, GitHubSearcher
+from osstrends.ratelimit import CORE_BUCKET, CredentialPool
+from tests import testutil
+
+
+class FakeGitHubTest(unittest.TestCase):
+    def setUp(self):
+        self.fake_github = FakeGitHub(seed=0)
+        self.fake_github.start()
+
+        self.searcher = self.create_searcher()
+
+    def tearDown(self):
+        self.fake_github.stop()
+
+    def create_searcher(self, cache=None):
+        return GitHubSearcher(
+            pool_size=1, cache=cache, api_url=self.fake_github.url,
+            credentials=CredentialPool([("user", "token")], pace=False))
+
+    def test_serves_recorded_user(self):
+        repos = json.loads(testutil.read("user_repos.json"))
+        self.fake_github.add_user(
+            json.loads(testutil.read("user_drusk.json")), repos,
+            {"algorithms": json.loads(
+                testutil.read("language_stats_algorithms.json"))})
+
+        user = self.searcher.search_user("drusk")
+        assert_that(user["name"], equal_to("David Rusk"))
+
+        assert_that(self.searcher.search_repos_by_user("drusk"),
+                    has_length(len(repos)))
+        assert_that(self.searcher.get_repo_language_stats("drusk",
+                                                          "algorithms"),
+                    equal_to({"Java": 150390, "Python": 4713}))
+        assert_that(self.searcher.search_users_by_location("victoria"),
+                    equal_to([{"login": "drusk"}]))
+
+    def test_search_limited_like_github(self):
+        self.fake_github.generate(["Bigcity"], 1500, 0)
+
+        assert_that(self.searcher.search_users_by_location("bigcity"),
+                    has_length(FakeGitHub.SEARCH_RESULT_LIMIT))
+
+        users = self.searcher.search_users_by_location("bigcity",
+                                                       sharded=True)
+        assert_that({user["login"] for user in users}, has_length(1500))
+
+    def test_repos_paginated(self):
+        self.fake_github.generate(["Victoria"], 1, 250)
+
+        assert_that(self.searcher.search_repos_by_user("victoria-0"),
+                    has_length(250))
+        assert_that(self.fake_github.request_counts(),
+                    equal_to({"user_repos": 3}))
+
+    def test_forks_resolved_to_source(self):
+        self.fake_github.generate(["Victoria"], 1, 10, fork_fraction=1)
+
+        assert_that(self.searcher.resolve_repo_to_source("victoria-0",
+                                                         "repo-0"),
+                    equal_to(["upstream", "repo-0"]))
+
+    def test_not_modified(self):
+        self.fake_github.generate(["Victoria"], 1, 0)
+        cache = ResponseCache()
+        self.searcher = self.create_searcher(cache)
+
+        self.searcher.search_user("victoria-0")
+        self.searcher.search_user("victoria-0")
+
+        assert_that(cache.hits, equal_to(1))
+
+    def test_rate_limit_headers(self):
+        self.fake_github.rate_limit = 10
+        self.fake_github.generate(["Victoria"], 1, 0)
+
+        self.searcher.search_user("victoria-0")
+
+        assert_that(self.searcher.credentials.remaining(CORE_BUCKET),
+                    equal_to(9))
+
+    def test_errors(self):
+        self.fake_github.error_rate = 1
+        self.fake_github.generate(["Victoria"], 1, 0)
+
+        try:
+            self.searcher.search_user("victoria-0")
+            self.fail("Should have raised GitHubApiException.")
+        except GitHubApiException as exception:
+            assert_that(exception.status_code, equal_to(502))
+
+
+if __name__ == '__main__':
+    unittest.main()
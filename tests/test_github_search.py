@@ -20,6 +20,7 @@
 
 __author__ = "David Rusk <drusk@uvic.ca>"
 
+import base64
 import json
 import unittest
 
@@ -27,7 +28,10 @@ from hamcrest import assert_that, equal_to, has_length, contains_inanyorder, non
 import httpretty
 from mock import Mock
 
-from osstrends.github import GitHubSearcher, RateLimitException
+from osstrends.cache import ResponseCache
+from osstrends.github import (GitHubApiException, GitHubSearcher,
+                              RateLimitException, endpoint_name)
+from osstrends.ratelimit import CredentialPool
 from tests import testutil
 
 
@@ -44,6 +48,39 @@ class GitHubSearcherTest(unittest.TestCase):
 
         assert_that(users, has_length(100))
 
+    @httpretty.activate
+    def test_search_users_by_location_sharded(self):
+        def search_results(request, uri, headers):
+            query = request.querystring["q"][0]
+            page = int(request.querystring["page"][0])
+
+            if "created:" not in query:
+                total_count = 1500
+            elif "created:2007-10-01.." in query:
+                total_count = 600
+            else:
+                total_count = 900
+
+            num_items = max(min(100, total_count - (page - 1) * 100), 0)
+            items = [{"login": "%s-%d-%d" % (query, page, i)}
+                     for i in xrange(num_items)]
+
+            return (200, headers, json.dumps({"total_count": total_count,
+                                              "items": items}))
+
+        httpretty.register_uri(httpretty.GET,
+                               "https://api.github.com/search/users",
+                               body=search_results)
+
+        # httpretty's dynamic responses aren't thread safe, so only fan
+        # out to a single thread.
+        self.searcher = GitHubSearcher(pool_size=1)
+        users = self.searcher.search_users_by_location("bigcity",
+                                                       sharded=True)
+
+        assert_that(users, has_length(1500))
+        assert_that({user["login"] for user in users}, has_length(1500))
+
     @httpretty.activate
     def test_search_repos_by_user(self):
         self.mock_uri("https://api.github.com/users/drusk/repos",
@@ -52,7 +89,7 @@ class GitHubSearcherTest(unittest.TestCase):
         repos = self.searcher.search_repos_by_user("drusk")
 
         assert_that(repos, has_length(16))
-        assert_that(repos, contains_inanyorder(
+        assert_that([repo["name"] for repo in repos], contains_inanyorder(
             "MOP",
             "scratch",
             "fishcounter",
@@ -71,6 +108,38 @@ class GitHubSearcherTest(unittest.TestCase):
             "drusk-gwt-oracle-example"
         ))
 
+        repo = repos[0]
+        assert_that(repo["full_name"], equal_to("drusk/algorithms"))
+        assert_that(repo["fork"], equal_to(False))
+        assert_that(repo["language"], equal_to("Java"))
+        assert_that(repo["pushed_at"], equal_to("2013-08-12T03:56:48Z"))
+
+    @httpretty.activate
+    def test_search_repos_by_user_multiple_pages(self):
+        repos_url = "https://api.github.com/users/drusk/repos"
+
+        def repos_page(request, uri, headers):
+            page = int(request.querystring.get("page", ["1"])[0])
+
+            if page == 1:
+                headers["Link"] = (
+                    '<%s?per_page=100&page=2>; rel="next", '
+                    '<%s?per_page=100&page=3>; rel="last"' % (repos_url,
+                                                              repos_url))
+
+            repos = [{"name": "repo%d-%d" % (page, i)} for i in xrange(100)]
+            return 200, headers, json.dumps(repos)
+
+        httpretty.register_uri(httpretty.GET, repos_url, body=repos_page)
+
+        # httpretty's dynamic responses aren't thread safe, so only fan
+        # out to a single thread.
+        self.searcher = GitHubSearcher(pool_size=1)
+        repos = self.searcher.search_repos_by_user("drusk")
+
+        assert_that(repos, has_length(300))
+        assert_that(repos[-1]["name"], equal_to("repo3-99"))
+
     @httpretty.activate
     def test_resolve_forked_repo_to_source(self):
         self.mock_uri("https://api.github.com/repos/drusk/MOP",
@@ -107,7 +176,8 @@ class GitHubSearcherTest(unittest.TestCase):
 
     @httpretty.activate
     def test_get_user_language_stats(self):
-        self.searcher.search_repos_by_user = Mock(return_value=["algorithms", "pml"])
+        self.searcher.search_repos_by_user = Mock(
+            return_value=[{"name": "algorithms"}, {"name": "pml"}])
 
         self.mock_uri("https://api.github.com/repos/drusk/algorithms/languages",
                       testutil.read("language_stats_algorithms.json"))
@@ -141,6 +211,67 @@ class GitHubSearcherTest(unittest.TestCase):
         assert_that(user["followers"], equal_to(1))
         assert_that(user["following"], equal_to(0))
 
+    @httpretty.activate
+    def test_connections_reused_between_requests(self):
+        self.mock_uri("https://api.github.com/users/drusk",
+                      testutil.read("user_drusk.json"))
+
+        self.searcher.search_user("drusk")
+        self.searcher.search_user("drusk")
+
+        stats = self.searcher.connection_stats()
+        assert_that(stats["requests"], equal_to(2))
+        assert_that(stats["connections"], equal_to(1))
+        assert_that(stats["reused"], equal_to(1))
+
+    @httpretty.activate
+    def test_not_modified_response_served_from_cache(self):
+        self.searcher = GitHubSearcher(cache=ResponseCache())
+
+        httpretty.register_uri(httpretty.GET,
+                               "https://api.github.com/users/drusk",
+                               responses=[
+                                   httpretty.Response(
+                                       body=testutil.read("user_drusk.json"),
+                                       adding_headers={
+                                           "ETag": '"abc"',
+                                           "X-RateLimit-Remaining": 100,
+                                           "X-RateLimit-Reset": 123456789}
+                                   ),
+                                   # Not modified responses don't count
+                                   # against the rate limit, even if it is
+                                   # used up.
+                                   httpretty.Response(
+                                       body="",
+                                       status=304,
+                                       adding_headers={
+                                           "ETag": '"abc"',
+                                           "X-RateLimit-Remaining": 0,
+                                           "X-RateLimit-Reset": 123456789}
+                                   )
+                               ])
+
+        self.searcher.search_user("drusk")
+        user = self.searcher.search_user("drusk")
+
+        assert_that(httpretty.last_request().headers["If-None-Match"],
+                    equal_to('"abc"'))
+        assert_that(user["login"], equal_to("drusk"))
+        assert_that(self.searcher.cache.hits, equal_to(1))
+        assert_that(self.searcher.cache.misses, equal_to(1))
+
+    @httpretty.activate
+    def test_response_using_last_of_rate_limit_is_kept(self):
+        self.mock_uri("https://api.github.com/users/drusk",
+                      testutil.read("user_drusk.json"),
+                      headers={"X-RateLimit-Remaining": 0,
+                               "X-RateLimit-Reset": 1372700873})
+
+        user = self.searcher.search_user("drusk")
+
+        assert_that(user["login"], equal_to("drusk"))
+        assert_that(self.searcher.credentials.remaining("core"), equal_to(0))
+
     @httpretty.activate
     def test_rate_limit_exception_raised(self):
         response = json.dumps({
@@ -159,6 +290,78 @@ class GitHubSearcherTest(unittest.TestCase):
         except RateLimitException as exception:
             assert_that(exception.reset_time, equal_to(1372700873))
 
+    @httpretty.activate
+    def test_error_response_raised(self):
+        self.mock_uri("https://api.github.com/users/deleted",
+                      json.dumps({"message": "Not Found"}), status=404)
+
+        try:
+            self.searcher.search_user("deleted")
+            self.fail("Should have raised GitHubApiException.")
+        except GitHubApiException as exception:
+            assert_that(exception.status_code, equal_to(404))
+            assert_that(exception.transient, equal_to(False))
+
+    @httpretty.activate
+    def test_requests_recorded_by_endpoint(self):
+        self.mock_uri("https://api.github.com/users/drusk",
+                      testutil.read("user_drusk.json"))
+        self.mock_uri("https://api.github.com/users/deleted",
+                      json.dumps({"message": "Not Found"}), status=404)
+
+        self.searcher.search_user("drusk")
+        self.searcher.search_user("drusk")
+        self.assertRaises(GitHubApiException, self.searcher.search_user,
+                          "deleted")
+
+        requests = self.searcher.metrics.get("github_requests_total")
+        assert_that(requests.value(endpoint="user", status=200),
+                    equal_to(2))
+        assert_that(requests.value(endpoint="user", status=404),
+                    equal_to(1))
+
+        latency = self.searcher.metrics.get("github_request_seconds")
+        assert_that(latency.count(endpoint="user"), equal_to(3))
+
+    def test_endpoint_name(self):
+        assert_that(endpoint_name("/search/users"), equal_to("search_users"))
+        assert_that(endpoint_name("/users/drusk"), equal_to("user"))
+        assert_that(endpoint_name("/users/drusk/repos"),
+                    equal_to("user_repos"))
+        assert_that(endpoint_name("/repos/drusk/pml"), equal_to("repo"))
+        assert_that(endpoint_name("/repos/drusk/pml/languages"),
+                    equal_to("repo_languages"))
+        assert_that(endpoint_name("/emojis"), equal_to("other"))
+
+    @httpretty.activate
+    def test_rate_limit_exceeded_fails_over_to_other_credentials(self):
+        self.searcher = GitHubSearcher(credentials=CredentialPool(
+            [("user1", "token1"), ("user2", "token2")]))
+
+        httpretty.register_uri(httpretty.GET,
+                               "https://api.github.com/users/drusk",
+                               responses=[
+                                   httpretty.Response(
+                                       body="{}",
+                                       status=403,
+                                       adding_headers={
+                                           "X-RateLimit-Remaining": 0,
+                                           "X-RateLimit-Reset": 2000000000}
+                                   ),
+                                   httpretty.Response(
+                                       body=testutil.read("user_drusk.json"),
+                                       adding_headers={
+                                           "X-RateLimit-Remaining": 100,
+                                           "X-RateLimit-Reset": 2000000000}
+                                   )
+                               ])
+
+        user = self.searcher.search_user("drusk")
+
+        assert_that(user["login"], equal_to("drusk"))
+        assert_that(httpretty.last_request().headers["Authorization"],
+                    equal_to("Basic " + base64.b64encode("user2:token2")))
+
     def mock_uri(self, uri, response_data, status=200, headers=None):
         if headers is None:
             headers = {"X-RateLimit-Remaining": 100,
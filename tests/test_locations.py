@@ -43,8 +43,10 @@ class LocationTest(unittest.TestCase):
                         "Australia"
                     ))
         assert_that(location1.search_term, equal_to("victoria"))
+        assert_that(location1.priority, equal_to(1.0))
 
         assert_that(location2.normalized, equal_to("Seattle, WA, USA"))
+        assert_that(location2.priority, equal_to(2.0))
 
 
 if __name__ == '__main__':
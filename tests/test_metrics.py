@@ -0,0 +1,117 @@
+# Copyright (C) 2014 David Rusk
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+__author__ = "David Rusk <drusk@uvic.ca>"
+
+import unittest
+
+from hamcrest import assert_that, close_to, equal_to, none
+import requests
+
+from osstrends.metrics import MetricsRegistry, MetricsServer
+
+
+class MetricsRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.metrics = MetricsRegistry()
+
+    def test_counter_by_labels(self):
+        counter = self.metrics.counter("requests_total", "Requests.")
+        counter.inc(endpoint="user")
+        counter.inc(2, endpoint="user")
+        counter.inc(endpoint="repo")
+
+        assert_that(counter.value(endpoint="user"), equal_to(3))
+        assert_that(counter.value(endpoint="other"), equal_to(0))
+        assert_that(counter.total(), equal_to(4))
+
+    def test_declaring_again_returns_same_metric(self):
+        counter = self.metrics.counter("requests_total", "Requests.")
+
+        assert_that(self.metrics.counter("requests_total", "Requests."),
+                    equal_to(counter))
+        self.assertRaises(ValueError, self.metrics.gauge, "requests_total",
+                          "Requests.")
+
+    def test_histogram_quantile(self):
+        histogram = self.metrics.histogram("latency_seconds", "Latency.",
+                                           buckets=(1, 2, 4))
+        assert_that(histogram.quantile(0.5), none())
+
+        for value in (0.5, 1.5, 1.5, 3):
+            histogram.observe(value)
+
+        assert_that(histogram.count(), equal_to(4))
+        assert_that(histogram.sum(), close_to(6.5, 0.001))
+        assert_that(histogram.quantile(0.5), close_to(1.5, 0.001))
+        assert_that(histogram.quantile(1), close_to(4, 0.001))
+
+    def test_render(self):
+        self.metrics = MetricsRegistry(labels={"worker": 0})
+        self.metrics.counter("requests_total", "Requests.").inc(
+            endpoint="user")
+        self.metrics.histogram("latency_seconds", "Latency.",
+                               buckets=(1,)).observe(0.5)
+
+        assert_that(self.metrics.render(), equal_to(
+            '# HELP latency_seconds Latency.\n'
+            '# TYPE latency_seconds histogram\n'
+            'latency_seconds_bucket{worker="0",le="1.0"} 1.0\n'
+            'latency_seconds_bucket{worker="0",le="+Inf"} 1.0\n'
+            'latency_seconds_sum{worker="0"} 0.5\n'
+            'latency_seconds_count{worker="0"} 1.0\n'
+            '# HELP requests_total Requests.\n'
+            '# TYPE requests_total counter\n'
+            'requests_total{worker="0",endpoint="user"} 1.0\n'))
+
+    def test_summary(self):
+        self.metrics.counter("users_total", "Users.").inc(5)
+        self.metrics.histogram("latency_seconds", "Latency.").observe(
+            0.2, endpoint="user")
+
+        summary = self.metrics.summary()
+
+        assert_that(summary[0].startswith(
+            'latency_seconds{endpoint="user"}: count 1, mean 0.200'),
+            equal_to(True))
+        assert_that(summary[1].startswith("users_total: 5 ("),
+                    equal_to(True))
+
+
+class MetricsServerTest(unittest.TestCase):
+    def test_serves_metrics(self):
+        metrics = MetricsRegistry()
+        metrics.gauge("queue_depth", "Queue depth.").set(3)
+
+        server = MetricsServer(metrics, 0)
+        server.start()
+
+        try:
+            response = requests.get(
+                "http://127.0.0.1:{}/metrics".format(server.port))
+        finally:
+            server.stop()
+
+        assert_that(response.status_code, equal_to(200))
+        assert_that(response.text, equal_to(metrics.render()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -20,57 +20,186 @@
 
 __author__ = "David Rusk <drusk@uvic.ca>"
 
+import json
+import os
 import Queue
+import time
 import unittest
 
-from hamcrest import assert_that, contains, equal_to
-from mock import Mock, MagicMock, call
+from hamcrest import assert_that, equal_to
+from mock import ANY, Mock, MagicMock
 
+from osstrends.cache import RepoLanguageCache
 from osstrends.database import MongoDatabase
-from osstrends.github import GitHubSearcher, RateLimitException
+from osstrends.github import (GitHubApiException, GitHubSearcher,
+                              RateLimitException)
 from osstrends.locations import Location, load_locations
-from osstrends.pipeline import DataPipeline, WorkerThread
+from osstrends.metrics import MetricsRegistry
+from osstrends.pipeline import (DataPipeline, LanguageAggregator, Task,
+                                WorkerThread, LOCATION_STAGE, USER_STAGE,
+                                USER_LOCATION_STAGE, REPOS_STAGE,
+                                REPO_LANGUAGES_STAGE)
+from osstrends.workqueue import MongoWorkQueue, RetryTimer
 import testutil
 
 
 class DataPipelineTest(unittest.TestCase):
     def setUp(self):
         self.db = Mock(spec=MongoDatabase)
+        self.db.verify_location_stats.return_value = []
+        self.db.remove_duplicate_users.return_value = 0
         self.searcher = Mock(spec=GitHubSearcher)
         self.locations = load_locations(testutil.path("test_locations.json"))
 
         self.pipeline = DataPipeline(self.db, self.searcher, self.locations)
         self.pipeline._initialize_workers = Mock()
 
+    def queued_tasks(self):
+        return [args[0][0] for args in
+                self.pipeline.queue_task.call_args_list]
+
     def test_execute_pipeline(self):
-        self.pipeline.process_location = Mock()
+        self.pipeline.queue_task = Mock()
+
+        self.pipeline.execute()
+
+        # The searches are retried like any other task if they fail.
+        tasks = self.queued_tasks()
+        assert_that([task.stage for task in tasks],
+                    equal_to([LOCATION_STAGE] * len(self.locations)))
+        assert_that([task.args[0] for task in tasks],
+                    equal_to(self.locations))
+
+    def test_database_prepared_before_run(self):
+        self.pipeline.queue_task = Mock()
 
         self.pipeline.execute()
 
-        assert_that(self.pipeline.process_location.call_args_list,
-                    contains(*[call(location) for location in self.locations]))
+        self.db.remove_duplicate_users.assert_called_once_with()
+        self.db.ensure_indexes.assert_called_once_with()
+
+    def test_location_stats_checked_before_run(self):
+        self.pipeline.queue_task = Mock()
+
+        self.pipeline.execute()
+
+        self.db.verify_location_stats.assert_called_once_with()
+        assert_that(self.db.rebuild_location_stats.called, equal_to(False))
+
+    def test_out_of_date_location_stats_rebuilt(self):
+        self.db.verify_location_stats.return_value = ["victoria"]
+
+        self.pipeline.check_location_stats()
+
+        self.db.rebuild_location_stats.assert_called_once_with()
+
+    def test_metrics_reported(self):
+        metrics_filename = testutil.path("metrics.prom.test")
+        self.pipeline = DataPipeline(self.db, self.searcher, self.locations,
+                                     metrics_filename=metrics_filename)
+        self.pipeline.queue_task(Task(REPOS_STAGE, "drusk", "drusk"))
+
+        try:
+            self.pipeline.report_metrics()
+
+            with open(metrics_filename) as filehandle:
+                assert_that("pipeline_queue_depth 1.0" in filehandle.read(),
+                            equal_to(True))
+        finally:
+            os.remove(metrics_filename)
+
+    def test_write_buffer_closed_after_run(self):
+        self.pipeline = DataPipeline(self.db, self.searcher, self.locations,
+                                     write_behind=True)
+        self.pipeline._initialize_workers = Mock()
+        self.pipeline.queue_task = Mock()
+        self.pipeline._write_buffer.close = Mock()
+
+        self.pipeline.execute()
+
+        self.pipeline._write_buffer.close.assert_called_once_with()
 
     def test_process_location(self):
         self.pipeline.queue_user = Mock()
 
         num_users = 10
         users = [MagicMock() for _ in xrange(num_users)]
-        self.searcher.search_users_by_location.return_value = users
+        self.searcher.iter_users_by_location.return_value = users
 
         location = self.locations[0]
         self.pipeline.process_location(location)
 
-        self.searcher.search_users_by_location.assert_called_once_with(
-            location.search_term
+        self.searcher.iter_users_by_location.assert_called_once_with(
+            location.search_term, sharded=True
         )
 
         assert_that(self.pipeline.queue_user.call_count, equal_to(num_users))
 
+    def test_users_queued_before_search_finishes(self):
+        self.pipeline.queue_user = Mock()
+
+        def search_results():
+            yield {"login": "drusk"}
+            assert_that(self.pipeline.queue_user.call_count, equal_to(1))
+            yield {"login": "rrusk"}
+
+        self.searcher.iter_users_by_location.return_value = search_results()
+
+        self.pipeline.process_location(self.locations[0])
+
+        assert_that(self.pipeline.queue_user.call_count, equal_to(2))
+
+    def test_duplicate_users_queued_once(self):
+        self.pipeline.queue_task = Mock()
+        users = json.loads(testutil.read("victoria_users.json"))
+
+        for user in users:
+            self.pipeline.queue_user(user, self.locations[0])
+
+        tasks = [args[0][0] for args in
+                 self.pipeline.queue_task.call_args_list]
+        assert_that(len(tasks), equal_to(554))
+        assert_that(set(task.stage for task in tasks),
+                    equal_to({USER_STAGE}))
+
+    def test_user_in_second_location_not_fetched_again(self):
+        self.pipeline.queue_task = Mock()
+
+        self.pipeline.queue_user({"login": "drusk"}, self.locations[0])
+        self.pipeline.queue_user({"login": "drusk"}, self.locations[1])
+
+        task = self.pipeline.queue_task.call_args[0][0]
+        assert_that(task.stage, equal_to(USER_LOCATION_STAGE))
+        assert_that(task.args, equal_to(("drusk", self.locations[1])))
+
+    def test_process_user_location(self):
+        self.db.get_user.return_value = {"login": "drusk",
+                                         "location": "Victoria, BC"}
+
+        self.pipeline.process_user_location("drusk", self.locations[1])
+
+        self.db.add_user_location.assert_called_once_with(
+            "drusk", self.locations[1].normalized)
+        assert_that(self.searcher.search_user.called, equal_to(False))
+
+    def test_process_user_location_before_user_saved(self):
+        self.pipeline.queue_task = Mock()
+        self.db.get_user.return_value = None
+        self.searcher.search_user.return_value = {"login": "drusk",
+                                                  "location": "Victoria, BC"}
+
+        self.pipeline.process_user_location("drusk", self.locations[1])
+
+        self.db.insert_user.assert_called_once_with(
+            {"login": "drusk", "location": "Victoria, BC"},
+            self.locations[1].normalized)
+        assert_that(self.pipeline.queue_task.call_count, equal_to(1))
+
     def test_process_user(self):
+        self.pipeline.queue_task = Mock()
+
         full_user_details = {"location": "Victoria, BC"}
-        language_stats = Mock()
         self.searcher.search_user.return_value = full_user_details
-        self.searcher.get_user_language_stats.return_value = language_stats
 
         user = {"login": "drusk"}
         location = self.locations[0]
@@ -81,9 +210,142 @@ class DataPipelineTest(unittest.TestCase):
         self.db.insert_user.assert_called_once_with(full_user_details,
                                                     location.normalized)
 
-        self.searcher.get_user_language_stats.assert_called_once_with("drusk")
+        task = self.pipeline.queue_task.call_args[0][0]
+        assert_that(task.stage, equal_to(REPOS_STAGE))
+        assert_that(task.args, equal_to(("drusk", )))
+
+    def test_process_repos(self):
+        self.pipeline.queue_task = Mock()
+
+        repos = [{"name": "algorithms"}, {"name": "pml"}]
+        self.searcher.search_repos_by_user.return_value = repos
+
+        self.pipeline.process_repos("drusk")
+
+        tasks = [args[0][0] for args in
+                 self.pipeline.queue_task.call_args_list]
+        assert_that([task.stage for task in tasks],
+                    equal_to([REPO_LANGUAGES_STAGE, REPO_LANGUAGES_STAGE]))
+        assert_that([task.args for task in tasks],
+                    equal_to([("drusk", repo) for repo in repos]))
+
+    def test_user_without_repos(self):
+        self.searcher.search_repos_by_user.return_value = []
+
+        self.pipeline.process_repos("drusk")
+
+        self.db.insert_user_language_stats.assert_called_once_with(
+            "drusk", {})
+
+    def test_repo_language_stats_aggregated(self):
+        self.pipeline.queue_task = Mock()
+
+        repos = [{"name": "algorithms"}, {"name": "pml"}]
+        self.searcher.search_repos_by_user.return_value = repos
+        self.searcher.get_repo_language_stats.side_effect = [
+            {"Java": 150390, "Python": 4713},
+            {"Python": 268346, "Shell": 5407}
+        ]
+
+        self.pipeline.process_repos("drusk")
+
+        self.pipeline.process_repo_languages("drusk", repos[0])
+        assert_that(self.db.insert_user_language_stats.called,
+                    equal_to(False))
+
+        self.pipeline.process_repo_languages("drusk", repos[1])
         self.db.insert_user_language_stats.assert_called_once_with(
-            "drusk", language_stats)
+            "drusk", {"Java": 150390, "Python": 273059, "Shell": 5407})
+        assert_that(self.pipeline.metrics.get(
+            "pipeline_users_total").total(), equal_to(1))
+
+    def test_repo_language_stats_saved(self):
+        self.pipeline.incremental = True
+        self.pipeline.queue_task = Mock()
+        repo = {"name": "pml", "pushed_at": "2013-08-12T03:56:48Z"}
+        self.searcher.get_repo_language_stats.return_value = {"Python": 10}
+        self.pipeline._aggregator.start("drusk", ["pml"])
+
+        self.pipeline.process_repo_languages("drusk", repo)
+
+        self.db.set_user_repo_stats.assert_called_once_with(
+            "drusk", "pml", "2013-08-12T03:56:48Z", {"Python": 10})
+
+    def test_repo_language_stats_not_saved_by_full_run(self):
+        self.pipeline.queue_task = Mock()
+        repo = {"name": "pml", "pushed_at": "2013-08-12T03:56:48Z"}
+        self.searcher.get_repo_language_stats.return_value = {"Python": 10}
+        self.pipeline._aggregator.start("drusk", ["pml"])
+
+        self.pipeline.process_repo_languages("drusk", repo)
+
+        assert_that(self.db.set_user_repo_stats.called, equal_to(False))
+        self.db.insert_user_language_stats.assert_called_once_with(
+            "drusk", {"Python": 10})
+
+    def test_incremental_refresh_reuses_unchanged_repos(self):
+        self.pipeline.incremental = True
+        self.pipeline.queue_task = Mock()
+
+        unchanged = {"name": "algorithms", "pushed_at": "2013-01-01"}
+        changed = {"name": "pml", "pushed_at": "2013-08-01"}
+        self.searcher.search_repos_by_user.return_value = [unchanged,
+                                                           changed]
+        self.db.get_user_repo_stats.return_value = {
+            "algorithms": {"pushed_at": "2013-01-01",
+                           "languages": {"Java": 150390}},
+            "pml": {"pushed_at": "2013-07-01",
+                    "languages": {"Python": 100}},
+            "deleted": {"pushed_at": "2012-01-01",
+                        "languages": {"C": 5}}
+        }
+        self.searcher.get_repo_language_stats.return_value = {
+            "Python": 268346}
+
+        self.pipeline.process_repos("drusk")
+
+        self.db.remove_user_repo_stats.assert_called_once_with(
+            "drusk", ["deleted"])
+        task = self.pipeline.queue_task.call_args[0][0]
+        assert_that(self.pipeline.queue_task.call_count, equal_to(1))
+        assert_that(task.args, equal_to(("drusk", changed)))
+
+        self.pipeline.run_task(task)
+
+        assert_that(self.searcher.get_repo_language_stats.call_count,
+                    equal_to(1))
+        self.db.insert_user_language_stats.assert_called_once_with(
+            "drusk", {"Java": 150390, "Python": 268346})
+
+    def test_incremental_refresh_keeps_unchanged_user(self):
+        self.pipeline.incremental = True
+        self.pipeline.queue_task = Mock()
+        self.searcher.search_user.return_value = {
+            "login": "drusk", "updated_at": "2013-08-12T03:56:48Z"}
+        self.db.get_user.return_value = {
+            "login": "drusk", "updated_at": "2013-08-12T03:56:48Z"}
+
+        self.pipeline.process_user({"login": "drusk"}, self.locations[0])
+
+        assert_that(self.db.insert_user.called, equal_to(False))
+        self.db.touch_user.assert_called_once_with(
+            "drusk", self.locations[0].normalized)
+
+    def test_user_details_slimmed(self):
+        self.pipeline = DataPipeline(self.db, self.searcher, self.locations,
+                                     user_fields=["name"])
+        self.pipeline.queue_task = Mock()
+        self.searcher.search_user.return_value = {
+            "login": "drusk", "name": "David Rusk", "location": "Victoria",
+            "updated_at": "2013-08-12T03:56:48Z",
+            "repos_url": "https://api.github.com/users/drusk/repos"}
+
+        self.pipeline.process_user({"login": "drusk"}, self.locations[0])
+
+        self.db.insert_user.assert_called_once_with(
+            {"login": "drusk", "name": "David Rusk", "location": "Victoria",
+             "updated_at": "2013-08-12T03:56:48Z"},
+            self.locations[0].normalized)
 
     def test_user_filtered_due_to_stopword(self):
         location = Location("Victoria, BC, Canada",
@@ -117,28 +379,444 @@ class DataPipelineTest(unittest.TestCase):
         self.db.insert_user.assert_called_once_with(
             {"login": "drusk", "location": "VICTORIA"}, location.normalized)
 
+    def test_user_without_location_inserted(self):
+        self.pipeline.queue_task = Mock()
+        self.searcher.search_user.return_value = {"login": "drusk",
+                                                  "location": None}
+
+        self.pipeline.process_user({"login": "drusk"}, self.locations[0])
+
+        assert_that(self.db.insert_user.called, equal_to(True))
+
+    def fork(self, owner, name, pushed_at="2013-06-01T00:00:00Z",
+             created_at="2013-07-01T00:00:00Z"):
+        return {"name": name,
+                "full_name": "%s/%s" % (owner, name),
+                "fork": True,
+                "pushed_at": pushed_at,
+                "created_at": created_at}
+
+    def test_unchanged_forks_share_source_language_stats(self):
+        self.pipeline.language_cache = RepoLanguageCache()
+        self.pipeline.resolve_fork_sources = True
+        self.searcher.resolve_repo_to_source.return_value = ["ijiraq", "MOP"]
+        self.searcher.get_repo_language_stats.return_value = {"Python": 100}
+
+        stats1 = self.pipeline._get_repo_language_stats(
+            "drusk", self.fork("drusk", "MOP"))
+        stats2 = self.pipeline._get_repo_language_stats(
+            "rrusk", self.fork("rrusk", "MOP"))
+
+        assert_that(stats1, equal_to({"Python": 100}))
+        assert_that(stats2, equal_to({"Python": 100}))
+        self.searcher.get_repo_language_stats.assert_called_once_with(
+            "drusk", "MOP")
+
+        # The source of a fork is only looked up once
+        self.pipeline._get_repo_language_stats(
+            "drusk", self.fork("drusk", "MOP"))
+        assert_that(self.searcher.resolve_repo_to_source.call_count,
+                    equal_to(2))
+
+    def test_fork_source_only_looked_up_if_enabled(self):
+        self.pipeline.language_cache = RepoLanguageCache()
+        self.searcher.get_repo_language_stats.return_value = {"Python": 100}
+
+        self.pipeline._get_repo_language_stats(
+            "drusk", self.fork("drusk", "MOP"))
+
+        assert_that(self.searcher.resolve_repo_to_source.called,
+                    equal_to(False))
+        assert_that(self.pipeline.language_cache.get(
+            "drusk/MOP", "2013-06-01T00:00:00Z"), equal_to({"Python": 100}))
+
+        # Sources already known are still used.
+        self.pipeline.language_cache.set_source("rrusk/MOP", "drusk/MOP")
+        stats = self.pipeline._get_repo_language_stats(
+            "rrusk", self.fork("rrusk", "MOP"))
+
+        assert_that(stats, equal_to({"Python": 100}))
+        assert_that(self.searcher.get_repo_language_stats.call_count,
+                    equal_to(1))
+
+    def test_pushed_fork_not_resolved_to_source(self):
+        self.pipeline.language_cache = RepoLanguageCache()
+        self.searcher.get_repo_language_stats.return_value = {"Python": 100}
+
+        self.pipeline._get_repo_language_stats(
+            "drusk", self.fork("drusk", "MOP",
+                               pushed_at="2013-08-01T00:00:00Z"))
+
+        assert_that(self.searcher.resolve_repo_to_source.called,
+                    equal_to(False))
+
+    def test_forks_excluded(self):
+        self.pipeline.fork_weight = 0
+        self.pipeline.queue_task = Mock()
+        self.searcher.search_repos_by_user.return_value = [
+            self.fork("drusk", "MOP"),
+            {"name": "pml", "fork": False}
+        ]
+
+        self.pipeline.process_repos("drusk")
+
+        task = self.pipeline.queue_task.call_args[0][0]
+        assert_that(self.pipeline.queue_task.call_count, equal_to(1))
+        assert_that(task.args[1]["name"], equal_to("pml"))
+
+    def test_forks_discounted(self):
+        self.pipeline.fork_weight = 0.5
+        self.pipeline.queue_task = Mock()
+        repos = [self.fork("drusk", "MOP"), {"name": "pml", "fork": False}]
+        self.searcher.search_repos_by_user.return_value = repos
+        self.searcher.get_repo_language_stats.return_value = {"Python": 100}
+
+        self.pipeline.process_repos("drusk")
+        for repo in repos:
+            self.pipeline.process_repo_languages("drusk", repo)
+
+        self.db.insert_user_language_stats.assert_called_once_with(
+            "drusk", {"Python": 150})
+
+    def test_durable_task_documents(self):
+        location = self.locations[0]
+        repo = {"name": "pml", "full_name": "drusk/pml", "fork": False,
+                "pushed_at": "t1", "created_at": "t0", "size": 100}
+
+        for task in [Task(LOCATION_STAGE, None, location),
+                     Task(USER_STAGE, "drusk", {"login": "drusk"}, location),
+                     Task(USER_LOCATION_STAGE, "drusk", "drusk", location),
+                     Task(REPOS_STAGE, "drusk", "drusk"),
+                     Task(REPO_LANGUAGES_STAGE, "drusk", "drusk", repo)]:
+            document = self.pipeline._task_to_document(task)
+            restored_task = self.pipeline._document_to_task(document)
+
+            assert_that(restored_task.stage, equal_to(task.stage))
+            assert_that(restored_task.userid, equal_to(task.userid))
+
+        assert_that(restored_task.args[1]["full_name"],
+                    equal_to("drusk/pml"))
+
+    def test_resume_skips_searched_locations(self):
+        self.pipeline = DataPipeline(self.db, self.searcher, self.locations,
+                                     durable=True)
+        self.pipeline._initialize_workers = Mock()
+        self.pipeline._work_queue = Mock()
+        self.pipeline._work_queue.qsize.return_value = 0
+        self.pipeline.queue_task = Mock()
+
+        searched = self.pipeline._search_checkpoint(self.locations[0])
+        self.db.get_checkpoint.side_effect = lambda name: name == searched
+
+        self.pipeline.execute(resume=True)
+
+        self.db.release_leased_jobs.assert_called_once_with()
+        assert_that(self.db.reset_crawl_state.called, equal_to(False))
+        assert_that([task.args[0] for task in self.queued_tasks()],
+                    equal_to([self.locations[1]]))
+
+    def test_new_durable_run_resets_crawl_state(self):
+        self.pipeline = DataPipeline(self.db, self.searcher, self.locations,
+                                     durable=True)
+        self.pipeline._initialize_workers = Mock()
+        self.pipeline._work_queue = Mock()
+        self.pipeline._work_queue.qsize.return_value = 0
+        self.pipeline.queue_task = Mock()
+
+        self.pipeline.execute()
+
+        self.db.reset_crawl_state.assert_called_once_with()
+        assert_that(len(self.queued_tasks()), equal_to(len(self.locations)))
+
+    def test_coordinator_queues_location_searches(self):
+        self.pipeline = DataPipeline(self.db, self.searcher, self.locations,
+                                     durable=True)
+        self.pipeline.queue_task = Mock()
+        self.db.reclaim_expired_jobs.return_value = 0
+        self.db.count_jobs.side_effect = [1, 0]
+        self.db.get_active_workers.return_value = ["host:1234"]
+
+        self.pipeline.coordinate(poll_interval=0)
+
+        tasks = [args[0][0] for args in
+                 self.pipeline.queue_task.call_args_list]
+        assert_that([task.stage for task in tasks],
+                    equal_to([LOCATION_STAGE] * len(self.locations)))
+        assert_that([task.args[0] for task in tasks],
+                    equal_to(self.locations))
+
+        self.db.reset_crawl_state.assert_called_once_with()
+        assert_that(self.db.reclaim_expired_jobs.call_count, equal_to(2))
+        self.db.set_checkpoint.assert_called_with(
+            DataPipeline.FINISHED_CHECKPOINT, True)
+
+    def test_worker_runs_until_crawl_finished(self):
+        self.pipeline = DataPipeline(self.db, self.searcher, self.locations,
+                                     durable=True)
+        self.pipeline._initialize_workers = Mock()
+        self.db.get_checkpoint.side_effect = [False, True]
+        self.db.count_jobs.return_value = 0
+
+        self.pipeline.work(poll_interval=0)
+
+        self.pipeline._initialize_workers.assert_called_once_with()
+        assert_that(self.db.get_checkpoint.call_count, equal_to(2))
+
+    def test_resumed_user_queues_repos_still_pending(self):
+        # The last run stopped after starting the aggregation, before all
+        # of the repositories' tasks were queued.
+        self.pipeline = DataPipeline(self.db, self.searcher, self.locations,
+                                     durable=True)
+        self.pipeline.queue_task = Mock()
+        self.searcher.search_repos_by_user.return_value = [
+            {"name": "pml"}, {"name": "algorithms"}]
+        self.db.start_language_aggregation.return_value = False
+        self.db.get_pending_repos.return_value = ["algorithms", "deleted"]
+        self.db.add_repo_language_stats.return_value = None
+
+        self.pipeline.process_repos("drusk")
+
+        tasks = [args[0][0] for args in
+                 self.pipeline.queue_task.call_args_list]
+        assert_that([task.args for task in tasks],
+                    equal_to([("drusk", {"name": "algorithms"})]))
+        self.db.add_repo_language_stats.assert_called_once_with(
+            "drusk", "deleted", {})
+
+    def test_dead_lettered_repo_completes_aggregation(self):
+        self.pipeline._aggregator.start("drusk", ["pml", "deleted"])
+        self.searcher.get_repo_language_stats.return_value = {"Python": 10}
+        self.pipeline.process_repo_languages("drusk", {"name": "pml"})
+
+        task = Task(REPO_LANGUAGES_STAGE, "drusk", "drusk",
+                    {"name": "deleted"})
+        task.attempts = 1
+        self.pipeline.dead_letter(task, GitHubApiException(404, "url"))
+
+        self.db.insert_dead_letter.assert_called_once_with(
+            self.pipeline._task_to_document(task),
+            "GitHubApiException: GitHub API returned 404 for url", 1)
+        self.db.insert_user_language_stats.assert_called_once_with(
+            "drusk", {"Python": 10})
+
+    def test_replay_dead_letters(self):
+        self.pipeline.queue_task = Mock()
+        self.db.get_dead_letters.return_value = [
+            {"_id": "repo_languages:drusk/deleted",
+             "job": {"_id": "repo_languages:drusk/deleted",
+                     "stage": REPO_LANGUAGES_STAGE,
+                     "userid": "drusk",
+                     "repo": {"name": "deleted"}}}
+        ]
+
+        assert_that(self.pipeline.replay_dead_letters(), equal_to(1))
+
+        task = self.pipeline.queue_task.call_args[0][0]
+        assert_that(task.stage, equal_to(REPOS_STAGE))
+        assert_that(task.args, equal_to(("drusk", )))
+        self.db.remove_dead_letter.assert_called_once_with(
+            "repo_languages:drusk/deleted")
+
+    def test_durable_replayed_dead_letters_prioritized(self):
+        self.pipeline = DataPipeline(self.db, self.searcher, self.locations,
+                                     durable=True, prioritize=True)
+        self.db.get_user_refresh_info.return_value = {}
+        self.pipeline._load_refresh_info()
+        self.db.get_dead_letters.return_value = [
+            {"_id": "repos:drusk",
+             "job": {"_id": "repos:drusk", "stage": REPOS_STAGE,
+                     "userid": "drusk"}}
+        ]
+
+        self.pipeline.replay_dead_letters()
+
+        document = self.db.requeue_job.call_args[0][0]
+        assert_that(document["priority"], equal_to(
+            self.pipeline._task_priority(Task(REPOS_STAGE, "drusk",
+                                              "drusk"))))
+
+    def test_prioritized_tasks(self):
+        self.pipeline = DataPipeline(self.db, self.searcher, self.locations,
+                                     prioritize=True)
+        self.db.get_user_refresh_info.return_value = {
+            "fresh": {"fetched_at": time.time(), "active_at": None,
+                      "locations": []}
+        }
+        self.pipeline._load_refresh_info()
+
+        location = self.locations[0]
+        self.pipeline.queue_task(Task(USER_STAGE, "fresh",
+                                      {"login": "fresh"}, location))
+        self.pipeline.queue_task(Task(USER_STAGE, "new",
+                                      {"login": "new"}, location))
+        self.pipeline.queue_task(Task(LOCATION_STAGE, None, location))
+
+        work_queue = self.pipeline._work_queue
+        assert_that([work_queue.get().userid for _ in xrange(3)],
+                    equal_to([None, "new", "fresh"]))
+
+    def test_adjust_concurrency_starts_workers(self):
+        self.pipeline = DataPipeline(self.db, self.searcher, self.locations,
+                                     num_threads=2, autoscale=True)
+        self.pipeline._add_workers = Mock()
+        self.pipeline._work_queue.qsize = Mock(return_value=100)
+        self.searcher.latency = Mock()
+        self.searcher.latency.value.return_value = 0.5
+        self.searcher.credentials = Mock()
+        self.searcher.credentials.request_rate.return_value = None
+
+        assert_that(self.pipeline.adjust_concurrency(), equal_to(3))
+        assert_that(self.pipeline._concurrency_limit.limit, equal_to(3))
+        self.pipeline._add_workers.assert_called_once_with(3)
+
+
+class LanguageAggregatorTest(unittest.TestCase):
+    def test_repo_counted_once(self):
+        aggregator = LanguageAggregator()
+
+        assert_that(aggregator.start("drusk", ["pml", "algorithms"]),
+                    equal_to(True))
+        assert_that(aggregator.start("drusk", ["pml"]), equal_to(False))
+
+        assert_that(aggregator.add("drusk", "pml", {"Python": 10}),
+                    equal_to(None))
+        assert_that(aggregator.add("drusk", "pml", {"Python": 10}),
+                    equal_to(None))
+        assert_that(aggregator.add("drusk", "algorithms", {"Java": 5}),
+                    equal_to({"Python": 10, "Java": 5}))
+
 
 class WorkerThreadTest(unittest.TestCase):
     def setUp(self):
         self.work_queue = Mock(spec=Queue.Queue)
 
     def test_rate_limit_exception_causes_sleep_and_requeue(self):
-        user = Mock()
-        location = Mock()
+        task = Task(REPOS_STAGE, "drusk", "drusk")
 
-        def work_function(user, location):
+        def work_function(task):
             raise RateLimitException(1372700873)
 
         worker = WorkerThread(self.work_queue, work_function)
         worker.requeue = Mock()
         worker.sleep_until = Mock()
 
-        worker.process(user, location)
+        worker.process(task)
 
-        worker.requeue.assert_called_once_with(user, location)
+        worker.requeue.assert_called_once_with(task)
         worker.sleep_until.assert_called_once_with(
             1372700873 + worker.sleep_buffer)
 
+    def test_transient_error_retried_with_backoff(self):
+        task = Task(REPOS_STAGE, "drusk", "drusk")
+        dead_letter_function = Mock()
+
+        def work_function(task):
+            raise GitHubApiException(502, "url")
+
+        worker = WorkerThread(self.work_queue, work_function,
+                              dead_letter_function=dead_letter_function,
+                              max_attempts=2)
+        worker.requeue = Mock()
+        worker.sleep_until = Mock()
+        worker.backoff = Mock(return_value=10)
+
+        now = time.time()
+        worker.process(task)
+
+        worker.requeue.assert_called_once_with(task)
+        worker.backoff.assert_called_once_with(1)
+        assert_that(dead_letter_function.called, equal_to(False))
+
+        # The worker doesn't wait for the retry itself.
+        assert_that(worker.sleep_until.called, equal_to(False))
+        assert_that(task.not_before >= now + 10, equal_to(True))
+
+        worker.process(task)
+
+        dead_letter_function.assert_called_once_with(task, ANY)
+        assert_that(worker.requeue.call_count, equal_to(1))
+        assert_that(task.attempts, equal_to(2))
+        assert_that(self.work_queue.task_done.call_count, equal_to(1))
+
+    def test_permanent_error_not_retried(self):
+        task = Task(USER_STAGE, "deleted", {"login": "deleted"}, None)
+        dead_letter_function = Mock()
+
+        def work_function(task):
+            raise GitHubApiException(404, "url")
+
+        worker = WorkerThread(self.work_queue, work_function,
+                              dead_letter_function=dead_letter_function)
+        worker.requeue = Mock()
+
+        worker.process(task)
+
+        assert_that(worker.requeue.called, equal_to(False))
+        dead_letter_function.assert_called_once_with(task, ANY)
+        self.work_queue.task_done.assert_called_once_with()
+
+    def test_durable_job_given_up_on_marked_failed(self):
+        work_queue = Mock(spec=MongoWorkQueue)
+
+        def work_function(task):
+            raise GitHubApiException(404, "url")
+
+        worker = WorkerThread(work_queue, work_function)
+        worker.process(Task(USER_STAGE, "deleted", {"login": "deleted"},
+                            None))
+
+        work_queue.task_failed.assert_called_once_with()
+        assert_that(work_queue.task_done.called, equal_to(False))
+
+    def test_task_outcomes_recorded(self):
+        metrics = MetricsRegistry()
+        errors = [GitHubApiException(502, "url"), None]
+
+        def work_function(task):
+            error = errors.pop(0)
+            if error is not None:
+                raise error
+
+        worker = WorkerThread(self.work_queue, work_function,
+                              metrics=metrics)
+        worker.requeue = Mock()
+        worker.sleep_until = Mock()
+
+        task = Task(REPOS_STAGE, "drusk", "drusk")
+        worker.process(task)
+        worker.process(task)
+
+        tasks = metrics.get("pipeline_tasks_total")
+        assert_that(tasks.value(stage=REPOS_STAGE, outcome="retried"),
+                    equal_to(1))
+        assert_that(tasks.value(stage=REPOS_STAGE, outcome="done"),
+                    equal_to(1))
+        assert_that(metrics.get("pipeline_task_seconds").count(
+            stage=REPOS_STAGE), equal_to(2))
+
+    def test_delayed_retry_held_back_by_retry_timer(self):
+        retry_timer = Mock(spec=RetryTimer)
+        worker = WorkerThread(self.work_queue, Mock(),
+                              retry_timer=retry_timer)
+
+        task = Task(REPOS_STAGE, "drusk", "drusk")
+        task.not_before = time.time() + 10
+        worker.requeue(task)
+
+        retry_timer.put.assert_called_once_with(task)
+        assert_that(self.work_queue.put.called, equal_to(False))
+        assert_that(self.work_queue.task_done.called, equal_to(False))
+
+    def test_backoff_bounded(self):
+        worker = WorkerThread(self.work_queue, Mock())
+
+        for attempts in xrange(1, 20):
+            delay = worker.backoff(attempts)
+            assert_that(delay >= 0, equal_to(True))
+            assert_that(delay <= min(worker.backoff_cap,
+                                     worker.backoff_base * 2 ** attempts),
+                        equal_to(True))
+
 
 if __name__ == '__main__':
     unittest.main()
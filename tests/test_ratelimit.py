@@ -0,0 +1,169 @@
+# Copyright (C) 2013 David Rusk
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+__author__ = "David Rusk <drusk@uvic.ca>"
+
+import unittest
+
+from hamcrest import assert_that, equal_to, none, close_to
+from mock import Mock
+
+from osstrends.ratelimit import (CORE_BUCKET, SEARCH_BUCKET, CredentialPool,
+                                 RateLimitBudget)
+
+
+def rate_limit_headers(remaining, reset_time):
+    return {"X-RateLimit-Remaining": str(remaining),
+            "X-RateLimit-Reset": str(reset_time)}
+
+
+class RateLimitBudgetTest(unittest.TestCase):
+    def setUp(self):
+        self.budget = RateLimitBudget(sleep_buffer=10)
+        self.now = 1000
+
+    def update(self, bucket_name, remaining, reset_time):
+        assert_that(self.budget.reserve(bucket_name, self.now), none())
+        self.budget.update(bucket_name,
+                           rate_limit_headers(remaining, reset_time))
+
+    def test_unknown_budget_does_not_wait(self):
+        assert_that(self.budget.reserve(CORE_BUCKET, self.now), none())
+        assert_that(self.budget.remaining(CORE_BUCKET), none())
+
+    def test_requests_paced_over_window(self):
+        self.update(CORE_BUCKET, 10, self.now + 100)
+
+        assert_that(self.budget.reserve(CORE_BUCKET, self.now), none())
+        assert_that(self.budget.reserve(CORE_BUCKET, self.now),
+                    close_to(10, 0.001))
+        assert_that(self.budget.reserve(CORE_BUCKET, self.now + 10), none())
+
+    def test_no_pacing(self):
+        self.budget.pace = False
+        self.update(CORE_BUCKET, 10, self.now + 100)
+
+        assert_that(self.budget.reserve(CORE_BUCKET, self.now), none())
+        assert_that(self.budget.reserve(CORE_BUCKET, self.now), none())
+        assert_that(self.budget.remaining(CORE_BUCKET), equal_to(8))
+
+    def test_exhausted_budget_waits_for_reset(self):
+        self.update(CORE_BUCKET, 0, self.now + 100)
+
+        assert_that(self.budget.reserve(CORE_BUCKET, self.now),
+                    equal_to(110))
+        assert_that(self.budget.reserve(CORE_BUCKET, self.now + 50),
+                    equal_to(60))
+
+        # Once the window resets requests go ahead again
+        assert_that(self.budget.reserve(CORE_BUCKET, self.now + 110),
+                    none())
+
+    def test_buckets_tracked_separately(self):
+        self.update(SEARCH_BUCKET, 0, self.now + 60)
+
+        assert_that(self.budget.reserve(SEARCH_BUCKET, self.now),
+                    equal_to(70))
+        assert_that(self.budget.reserve(CORE_BUCKET, self.now), none())
+
+    def test_in_flight_requests_count_against_budget(self):
+        self.budget.pace = False
+        self.update(CORE_BUCKET, 1, self.now + 100)
+
+        assert_that(self.budget.reserve(CORE_BUCKET, self.now), none())
+
+        # Wait for the response of the request in flight
+        assert_that(self.budget.reserve(CORE_BUCKET, self.now), equal_to(1))
+
+        self.budget.release(CORE_BUCKET)
+        assert_that(self.budget.reserve(CORE_BUCKET, self.now), none())
+
+    def test_stale_response_ignored(self):
+        self.update(CORE_BUCKET, 10, self.now + 100)
+        self.update(CORE_BUCKET, 20, self.now + 100)
+
+        assert_that(self.budget.remaining(CORE_BUCKET), equal_to(10))
+
+    def test_request_rate(self):
+        assert_that(self.budget.request_rate(CORE_BUCKET, self.now), none())
+
+        self.update(CORE_BUCKET, 50, self.now + 100)
+
+        assert_that(self.budget.request_rate(CORE_BUCKET, self.now),
+                    close_to(0.5, 0.001))
+
+
+class CredentialPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.credential1 = ("user1", "token1")
+        self.credential2 = ("user2", "token2")
+        self.pool = CredentialPool([self.credential1, self.credential2],
+                                   pace=False)
+        self.pool.sleep = Mock()
+
+    def update(self, credential, remaining, reset_time):
+        self.pool.get_budget(credential).update(
+            CORE_BUCKET, rate_limit_headers(remaining, reset_time))
+
+    def test_credential_with_most_remaining_used(self):
+        self.update(self.credential1, 10, 2000000000)
+        self.update(self.credential2, 20, 2000000000)
+
+        assert_that(self.pool.acquire(CORE_BUCKET),
+                    equal_to(self.credential2))
+        assert_that(self.pool.remaining(CORE_BUCKET), equal_to(29))
+
+    def test_equal_budgets_rotated(self):
+        self.update(self.credential1, 10, 2000000000)
+        self.update(self.credential2, 10, 2000000000)
+
+        first = self.pool.acquire(CORE_BUCKET)
+        self.pool.release(first, CORE_BUCKET)
+        second = self.pool.acquire(CORE_BUCKET)
+
+        assert_that(first, equal_to(self.credential1))
+        assert_that(second, equal_to(self.credential2))
+
+    def test_exhausted_credential_fails_over_without_sleeping(self):
+        self.update(self.credential1, 0, 2000000000)
+        self.update(self.credential2, 5, 2000000000)
+
+        assert_that(self.pool.acquire(CORE_BUCKET),
+                    equal_to(self.credential2))
+        assert_that(self.pool.sleep.called, equal_to(False))
+        assert_that(self.pool.has_budget(CORE_BUCKET), equal_to(True))
+
+    def test_no_budget_left(self):
+        self.update(self.credential1, 0, 2000000000)
+        self.update(self.credential2, 0, 2000000000)
+
+        assert_that(self.pool.has_budget(CORE_BUCKET), equal_to(False))
+
+    def test_request_rate_combined(self):
+        self.update(self.credential1, 100, 2000000100)
+        self.update(self.credential2, 50, 2000000100)
+
+        assert_that(self.pool.request_rate(CORE_BUCKET, 2000000000),
+                    close_to(1.5, 0.001))
+
+
+if __name__ == '__main__':
+    unittest.main()
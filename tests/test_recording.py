@@ -0,0 +1,123 @@
+# Copyright (C) 2014 David Rusk
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+__author__ = "David Rusk <drusk@uvic.ca>"
+
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from hamcrest import assert_that, equal_to, has_length
+import httpretty
+
+from osstrends.cache import ResponseCache
+from osstrends.github import GitHubSearcher
+from osstrends.ratelimit import CredentialPool
+from osstrends.recording import ReplayMiss, TrafficRecorder, TrafficReplay
+from tests import testutil
+
+
+class RecordingTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "traffic.jsonl.gz")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def create_searcher(self, **kwargs):
+        return GitHubSearcher(
+            credentials=CredentialPool([("user", "token")]), **kwargs)
+
+    @httpretty.activate
+    def record(self, responses):
+        httpretty.register_uri(httpretty.GET,
+                               "https://api.github.com/users/drusk",
+                               responses=[
+                                   httpretty.Response(
+                                       body=body,
+                                       status=status,
+                                       adding_headers={"ETag": '"v1"'})
+                                   for status, body in responses
+                               ])
+
+        recorder = TrafficRecorder(self.filename)
+        searcher = self.create_searcher(recorder=recorder)
+
+        users = []
+        for _ in responses:
+            try:
+                users.append(searcher.search_user("drusk"))
+            except Exception as error:
+                users.append(error)
+
+        recorder.close()
+
+        return users
+
+    def test_replay_serves_recorded_responses_in_order(self):
+        user = testutil.read("user_drusk.json")
+        recorded = self.record([(502, "{}"), (200, user)])
+
+        searcher = self.create_searcher(
+            replay=TrafficReplay(self.filename))
+
+        self.assertRaises(Exception, searcher.search_user, "drusk")
+        assert_that(searcher.search_user("drusk"), equal_to(recorded[1]))
+        self.assertRaises(ReplayMiss, searcher.search_user, "drusk")
+
+    def test_credentials_not_recorded(self):
+        self.record([(200, testutil.read("user_drusk.json"))])
+
+        with gzip.open(self.filename, "rb") as filehandle:
+            exchange = json.loads(filehandle.readline())
+
+        assert_that(exchange["url"],
+                    equal_to("https://api.github.com/users/drusk"))
+        assert_that(exchange["status"], equal_to(200))
+        assert_that("Authorization" in exchange["request_headers"],
+                    equal_to(False))
+
+    def test_not_modified_skipped_without_cached_response(self):
+        user = testutil.read("user_drusk.json")
+        self.record([(304, ""), (200, user)])
+
+        searcher = self.create_searcher(
+            replay=TrafficReplay(self.filename), cache=ResponseCache())
+
+        assert_that(searcher.search_user("drusk"),
+                    equal_to(json.loads(user)))
+
+    def test_truncated_recording_read_up_to_end(self):
+        self.record([(200, testutil.read("user_drusk.json"))] * 2)
+
+        with gzip.open(self.filename, "rb") as filehandle:
+            data = filehandle.read()
+        with gzip.open(self.filename, "wb") as filehandle:
+            filehandle.write(data[:-10])
+
+        assert_that(TrafficReplay(self.filename), has_length(1))
+
+
+if __name__ == '__main__':
+    unittest.main()
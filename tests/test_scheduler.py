@@ -0,0 +1,108 @@
+# Copyright (C) 2013 David Rusk
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+__author__ = "David Rusk <drusk@uvic.ca>"
+import calendar
+import datetime
+import unittest
+
+from hamcrest import assert_that, equal_to, greater_than
+
+from osstrends.locations import Location
+from osstrends.scheduler import PriorityWorkQueue, StalenessPriority
+
+DAY = 86400
+
+
+def timestamp(iso_time):
+    return calendar.timegm(datetime.datetime.strptime(
+        iso_time, "%Y-%m-%dT%H:%M:%SZ").utctimetuple())
+
+
+class PriorityWorkQueueTest(unittest.TestCase):
+    def test_most_urgent_first(self):
+        queue = PriorityWorkQueue(lambda task: task["priority"])
+
+        for name, priority in [("a", 1), ("b", 5), ("c", 1), ("d", 3)]:
+            queue.put({"name": name, "priority": priority})
+
+        names = []
+        while not queue.empty():
+            names.append(queue.get()["name"])
+            queue.task_done()
+
+        # Ties keep the order they were queued in.
+        assert_that(names, equal_to(["b", "d", "a", "c"]))
+
+        # Behaves like Queue.Queue for the worker threads.
+        queue.join()
+
+
+class StalenessPriorityTest(unittest.TestCase):
+    def setUp(self):
+        self.victoria = Location("victoria", [], "victoria")
+        self.seattle = Location("seattle", [], "seattle", priority=2.0)
+
+        self.now = timestamp("2014-03-01T00:00:00Z")
+        self.priority = StalenessPriority([self.victoria, self.seattle])
+
+    def user(self, days_since_fetch, active_at=None, locations=None):
+        return {"fetched_at": self.now - days_since_fetch * DAY,
+                "active_at": active_at,
+                "locations": locations or ["victoria"]}
+
+    def test_staler_users_first(self):
+        self.priority.load({"stale": self.user(20),
+                            "fresh": self.user(1)}, self.now)
+
+        assert_that(self.priority.score("stale"),
+                    greater_than(self.priority.score("fresh")))
+        assert_that(self.priority.score("new"),
+                    greater_than(self.priority.score("stale")))
+
+    def test_users_unrefreshed_for_over_a_year_before_new_users(self):
+        self.priority.load({"forgotten": self.user(400)}, self.now)
+
+        assert_that(self.priority.score("forgotten"),
+                    greater_than(self.priority.score("new")))
+
+    def test_recently_active_users_first(self):
+        self.priority.load({
+            "active": self.user(10, active_at="2014-02-28T00:00:00Z"),
+            "idle": self.user(10, active_at="2012-01-01T00:00:00Z")
+        }, self.now)
+
+        assert_that(self.priority.score("active"),
+                    greater_than(self.priority.score("idle")))
+
+    def test_important_locations_first(self):
+        self.priority.load({"drusk": self.user(10),
+                            "rrusk": self.user(10, locations=["seattle"])},
+                           self.now)
+
+        assert_that(self.priority.score("rrusk"),
+                    equal_to(2 * self.priority.score("drusk")))
+        assert_that(self.priority.score("drusk", self.seattle),
+                    equal_to(self.priority.score("rrusk")))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,187 @@
+# Copyright (C) 2013 David Rusk
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+__author__ = "David Rusk <drusk@uvic.ca>"
+
+import Queue
+import time
+import unittest
+
+from hamcrest import assert_that, equal_to
+from mock import Mock
+
+from osstrends.database import MongoDatabase
+from osstrends.pipeline import Task, REPOS_STAGE
+from osstrends.workqueue import MongoWorkQueue, RetryTimer
+
+
+class MongoWorkQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.db = Mock(spec=MongoDatabase)
+
+        def to_document(task):
+            return {"_id": task.userid, "userid": task.userid}
+
+        def from_document(document):
+            return Task(REPOS_STAGE, document["userid"], document["userid"])
+
+        self.queue = MongoWorkQueue(self.db, to_document, from_document,
+                                    worker_id="host:1234")
+        self.queue._start_heartbeat = Mock()
+
+    def test_put_inserts_job(self):
+        self.queue.put(Task(REPOS_STAGE, "drusk", "drusk"))
+
+        self.db.insert_job.assert_called_once_with(
+            {"_id": "drusk", "userid": "drusk"})
+
+    def test_prioritized_jobs(self):
+        self.queue.priority_function = lambda task: 10
+        self.db.lease_job.return_value = {"_id": "drusk", "userid": "drusk"}
+
+        self.queue.put(Task(REPOS_STAGE, "drusk", "drusk"))
+        self.queue.get()
+
+        self.db.insert_job.assert_called_once_with(
+            {"_id": "drusk", "userid": "drusk", "priority": 10})
+        self.db.lease_job.assert_called_once_with(self.queue.lease_seconds,
+                                                  "host:1234", True)
+
+    def test_get_leases_job(self):
+        self.db.lease_job.return_value = {"_id": "drusk", "userid": "drusk"}
+
+        task = self.queue.get()
+
+        self.db.lease_job.assert_called_once_with(self.queue.lease_seconds,
+                                                  "host:1234", False)
+        assert_that(task.userid, equal_to("drusk"))
+        assert_that(task.job_id, equal_to("drusk"))
+
+    def test_get_waits_for_job(self):
+        self.queue.poll_interval = 0
+        self.db.lease_job.side_effect = [
+            None, {"_id": "drusk", "userid": "drusk"}]
+
+        task = self.queue.get()
+
+        assert_that(task.userid, equal_to("drusk"))
+        assert_that(self.db.lease_job.call_count, equal_to(2))
+
+    def test_task_done_completes_job(self):
+        self.db.lease_job.return_value = {"_id": "drusk", "userid": "drusk"}
+
+        self.queue.get()
+        self.queue.task_done()
+
+        self.db.complete_job.assert_called_once_with("drusk")
+
+    def test_task_failed_fails_job(self):
+        self.db.lease_job.return_value = {"_id": "drusk", "userid": "drusk"}
+
+        self.queue.get()
+        self.queue.task_failed()
+
+        self.db.fail_job.assert_called_once_with("drusk")
+        assert_that(self.db.complete_job.called, equal_to(False))
+
+    def test_requeued_task_released(self):
+        self.db.lease_job.return_value = {"_id": "drusk", "userid": "drusk",
+                                          "attempts": 1}
+
+        task = self.queue.get()
+        assert_that(task.attempts, equal_to(1))
+
+        task.attempts += 1
+        self.queue.put(task)
+        self.queue.task_done()
+
+        self.db.release_job.assert_called_once_with("drusk", 2, None)
+        assert_that(self.db.insert_job.called, equal_to(False))
+        assert_that(self.db.complete_job.called, equal_to(False))
+
+    def test_delayed_retry_recorded_in_job(self):
+        self.db.lease_job.return_value = {"_id": "drusk", "userid": "drusk"}
+
+        task = self.queue.get()
+        task.attempts = 1
+        task.not_before = 1372700873
+        self.queue.put(task)
+        self.queue.task_done()
+
+        self.db.release_job.assert_called_once_with("drusk", 1, 1372700873)
+
+    def test_heartbeat_renews_held_leases(self):
+        self.db.lease_job.return_value = {"_id": "drusk", "userid": "drusk"}
+        self.queue.get()
+
+        self.queue.send_heartbeat()
+
+        self.db.record_worker_heartbeat.assert_called_once_with("host:1234")
+        self.db.renew_leases.assert_called_once_with(
+            ["drusk"], "host:1234", self.queue.lease_seconds)
+
+    def test_finished_jobs_not_renewed(self):
+        self.db.lease_job.return_value = {"_id": "drusk", "userid": "drusk"}
+        self.queue.get()
+        self.queue.task_done()
+
+        self.queue.send_heartbeat()
+
+        assert_that(self.db.renew_leases.called, equal_to(False))
+
+
+class RetryTimerTest(unittest.TestCase):
+    def test_task_put_back_once_due(self):
+        work_queue = Queue.Queue()
+        work_queue.put(Task(REPOS_STAGE, "drusk", "drusk"))
+        task = work_queue.get()
+
+        task.not_before = time.time() + 0.05
+        RetryTimer(work_queue).put(task)
+
+        # Still unfinished while it waits.
+        assert_that(work_queue.empty(), equal_to(True))
+        assert_that(work_queue.unfinished_tasks, equal_to(1))
+
+        assert_that(work_queue.get(timeout=5), equal_to(task))
+        assert_that(time.time() >= task.not_before, equal_to(True))
+        work_queue.task_done()
+        assert_that(work_queue.unfinished_tasks, equal_to(0))
+
+    def test_soonest_task_put_back_first(self):
+        work_queue = Queue.Queue()
+        later = Task(REPOS_STAGE, "drusk", "drusk")
+        later.not_before = time.time() + 0.2
+        sooner = Task(REPOS_STAGE, "rrusk", "rrusk")
+        sooner.not_before = time.time() + 0.05
+
+        # Each was taken from the queue to be worked on.
+        work_queue.unfinished_tasks = 2
+        retry_timer = RetryTimer(work_queue)
+        retry_timer.put(later)
+        retry_timer.put(sooner)
+
+        assert_that(work_queue.get(timeout=5), equal_to(sooner))
+        assert_that(work_queue.get(timeout=5), equal_to(later))
+
+
+if __name__ == '__main__':
+    unittest.main()
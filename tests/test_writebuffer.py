@@ -0,0 +1,127 @@
+# Copyright (C) 2013 David Rusk
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+__author__ = "David Rusk <drusk@uvic.ca>"
+import time
+import unittest
+
+from hamcrest import assert_that, equal_to
+from mock import Mock
+
+from osstrends.database import MongoDatabase
+from osstrends.writebuffer import UserWriteBuffer
+
+
+class UserWriteBufferTest(unittest.TestCase):
+    def setUp(self):
+        self.db = Mock(spec=MongoDatabase)
+        self.buffer = UserWriteBuffer(self.db, max_size=100, max_age=60)
+
+    def saved_updates(self):
+        return [args[0][0] for args in
+                self.db.bulk_update_users.call_args_list]
+
+    def test_writes_to_same_user_merged(self):
+        self.buffer.insert_user({"login": "drusk", "name": "David Rusk"},
+                                "victoria")
+        self.buffer.add_user_location("drusk", "vancouver")
+        self.buffer.insert_user_language_stats("drusk", {"Python": 10,
+                                                         "Java": 5})
+        self.buffer.close()
+
+        updates = self.saved_updates()
+        assert_that(len(updates), equal_to(1))
+
+        update = updates[0]["drusk"]
+        assert_that(update["fields"]["name"], equal_to("David Rusk"))
+        assert_that(update["fields"]["languages"],
+                    equal_to({"Python": 10, "Java": 5}))
+        assert_that(update["fields"]["total_code_size"], equal_to(15))
+        assert_that(update["fields"]["language_list"],
+                    equal_to([{"name": "Java", "bytes": 5},
+                              {"name": "Python", "bytes": 10}]))
+        assert_that(update["locations"],
+                    equal_to({"victoria", "vancouver"}))
+
+    def test_flushed_in_background_when_full(self):
+        self.buffer.max_size = 2
+
+        self.buffer.insert_user_language_stats("drusk", {})
+        assert_that(self.db.bulk_update_users.called, equal_to(False))
+
+        self.buffer.insert_user_language_stats("rrusk", {})
+        for _ in xrange(100):
+            if self.db.bulk_update_users.called:
+                break
+            time.sleep(0.01)
+
+        assert_that(sorted(self.saved_updates()[0].keys()),
+                    equal_to(["drusk", "rrusk"]))
+        self.buffer.close()
+
+    def wait_for_saves(self, count):
+        for _ in xrange(100):
+            if self.db.bulk_update_users.call_count >= count:
+                break
+            time.sleep(0.01)
+
+    def test_flushed_in_background_when_old_after_earlier_flush(self):
+        self.buffer.max_age = 0.1
+
+        self.buffer.insert_user_language_stats("drusk", {})
+        self.wait_for_saves(1)
+        assert_that(self.db.bulk_update_users.call_count, equal_to(1))
+
+        self.buffer.insert_user_language_stats("rrusk", {})
+        self.wait_for_saves(2)
+
+        updates = self.saved_updates()
+        assert_that(len(updates), equal_to(2))
+        assert_that(updates[1].keys(), equal_to(["rrusk"]))
+        self.buffer.close()
+
+    def test_failed_writes_retried(self):
+        self.db.bulk_update_users.side_effect = [Exception("Lost connection"),
+                                                 None]
+
+        self.buffer.insert_user_language_stats("drusk", {"Python": 10})
+        self.buffer.flush()
+        self.buffer.insert_user_language_stats("drusk", {"Python": 20})
+        self.buffer.close()
+
+        updates = self.saved_updates()
+        assert_that(len(updates), equal_to(2))
+        assert_that(updates[1]["drusk"]["fields"]["languages"],
+                    equal_to({"Python": 20}))
+
+    def test_get_user_includes_waiting_writes(self):
+        self.db.get_user.return_value = {"login": "drusk",
+                                         "location_normalized": ["victoria"]}
+
+        self.buffer.add_user_location("drusk", "vancouver")
+
+        assert_that(self.buffer.get_user("drusk")["location_normalized"],
+                    equal_to(["victoria", "vancouver"]))
+        self.buffer.close()
+
+
+if __name__ == '__main__':
+    unittest.main()